@@ -1,4 +1,6 @@
 from .base import BaseDownloader, DownloadResult  # noqa
 from .factory import DownloaderFactory  # noqa
 from .file import FileDownloader  # noqa
-from .http import http_giveup, HttpDownloader  # noqa
+from .http import http_giveup, HttpDownloader, RetryBudget, RetryPolicy  # noqa
+from .mirrors import MirrorSet  # noqa
+from .semaphore import RedisSemaphore  # noqa
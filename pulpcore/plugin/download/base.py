@@ -7,6 +7,7 @@ import tempfile
 
 from pulpcore.app.models import Artifact
 from pulpcore.exceptions import DigestValidationError, SizeValidationError
+from pulpcore.plugin.metrics import DOWNLOAD_BYTES, DOWNLOADS_ACTIVE
 
 
 log = logging.getLogger(__name__)
@@ -94,6 +95,7 @@ class BaseDownloader:
             self.semaphore = asyncio.Semaphore()  # This will always be acquired
         self._digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
         self._size = 0
+        self._stream_q = None
 
     async def handle_data(self, data):
         """
@@ -104,11 +106,18 @@ class BaseDownloader:
         the concatenation of all the arguments: m.handle_data(a); m.handle_data(b) is equivalent to
         m.handle_data(a+b).
 
+        If the download is consumed with :meth:`~pulpcore.plugin.download.BaseDownloader.stream`,
+        `data` is also passed to the consumer. This waits while the consumer is behind by the
+        maximum number of chunks.
+
         Args:
             data (bytes): The data to be handled by the downloader.
         """
         self._writer.write(data)
         self._record_size_and_digests_for_data(data)
+        DOWNLOAD_BYTES.inc(len(data))
+        if self._stream_q is not None:
+            await self._stream_q.put(data)
 
     async def finalize(self):
         """
@@ -144,6 +153,85 @@ class BaseDownloader:
         done, _ = asyncio.get_event_loop().run_until_complete(asyncio.wait([self.run()]))
         return done.pop().result()
 
+    async def stream(self, extra_data=None, max_chunks=8):
+        """
+        Run the download and yield the data while it is downloading.
+
+        This is an asynchronous generator. The download runs as with
+        :meth:`~pulpcore.plugin.download.BaseDownloader.run` and still writes the data to the file
+        object and computes its digests, but each chunk passed to
+        :meth:`~pulpcore.plugin.download.BaseDownloader.handle_data` is yielded too. The download
+        pauses while `max_chunks` chunks are waiting for the consumer, so the memory used is
+        bounded.
+
+        The digests and size are validated after the last chunk was yielded. Data yielded before is
+        not validated yet, so the consumer must not rely on anything derived from it unless the
+        iteration finishes without an exception. If the consumer stops the iteration early, the
+        download is cancelled.
+
+        Example:
+
+            >>> downloader = remote.get_downloader(url=url, expected_digests=digests)
+            >>> async for element in iterparse(decompress(downloader.stream()), tag):
+            >>>     ...  # handle the element
+            >>> # the data is complete and valid, it is saved at downloader.path
+
+        Args:
+            extra_data (dict): Extra data passed to the downloader.
+            max_chunks (int): The maximum number of chunks waiting for the consumer. Defaults to 8.
+
+        Yields:
+            bytes: The next chunk of downloaded data.
+
+        Raises:
+            Exception: Any fatal exception emitted during downloading, including the validation
+                errors raised by :meth:`~pulpcore.plugin.download.BaseDownloader.finalize`.
+        """
+        self._stream_q = asyncio.Queue(maxsize=max_chunks)
+        download = asyncio.ensure_future(self.run(extra_data=extra_data))
+        try:
+            while True:
+                try:
+                    chunk = self._stream_q.get_nowait()
+                except asyncio.QueueEmpty:
+                    if download.done():
+                        download.result()  # raises the exception of the download, if any
+                        break
+                    getter = asyncio.ensure_future(self._stream_q.get())
+                    await asyncio.wait([getter, download], return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        getter.cancel()
+                        continue
+                    chunk = getter.result()
+                yield chunk
+        finally:
+            if not download.done():
+                download.cancel()
+            self._stream_q = None
+
+    def _rewind(self):
+        """
+        Discard the data handled so far, so the download can be tried again.
+
+        Returns:
+            bool: True if the data was discarded, False if it cannot be because it was already
+                passed to the consumer of
+                :meth:`~pulpcore.plugin.download.BaseDownloader.stream` or the file object cannot
+                be truncated.
+        """
+        if not self._size:
+            return True
+        if self._stream_q is not None:
+            return False
+        try:
+            self._writer.seek(0)
+            self._writer.truncate()
+        except (AttributeError, OSError):
+            return False
+        self._digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
+        self._size = 0
+        return True
+
     def _record_size_and_digests_for_data(self, data):
         """
         Record the size and digest for an available chunk of data.
@@ -198,8 +286,8 @@ class BaseDownloader:
         Run the downloader with concurrency restriction.
 
         This method acquires `self.semaphore` before calling the actual download implementation
-        contained in `_run()`. This ensures that the semaphore stays acquired even as the `backoff`
-        decorator on `_run()`, handles backoff-and-retry logic.
+        contained in `_run()`. This ensures that the semaphore stays acquired even as `_run()`
+        handles backoff-and-retry logic.
 
         Args:
             extra_data (dict): Extra data passed to the downloader.
@@ -209,7 +297,11 @@ class BaseDownloader:
 
         """
         async with self.semaphore:
-            return await self._run(extra_data=extra_data)
+            DOWNLOADS_ACTIVE.inc()
+            try:
+                return await self._run(extra_data=extra_data)
+            finally:
+                DOWNLOADS_ACTIVE.dec()
 
     async def _run(self, extra_data=None):
         """
@@ -7,7 +7,8 @@ from urllib.parse import urlparse
 
 import aiohttp
 
-from .http import HttpDownloader
+from .http import HttpDownloader, RetryBudget, RetryPolicy
+from .mirrors import MirrorSet
 from .file import FileDownloader
 
 
@@ -36,8 +37,9 @@ class DownloaderFactory:
         >>> result = downloader.fetch()  # 'result' is a DownloadResult
 
     For http and https urls, in addition to the remote settings, non-default timing values are used.
-    Specifically, the "total" timeout is set to None and the "sock_connect" and "sock_read" are both
-    5 minutes. For more info on these settings, see the aiohttp docs:
+    Specifically, the "total" timeout is set to None and the "sock_connect" is 10 minutes and the
+    "sock_read" is the `read_timeout` of the retry policy, 10 minutes by default. For more info on
+    these settings, see the aiohttp docs:
     http://aiohttp.readthedocs.io/en/stable/client_quickstart.html#timeouts Behaviorally, it should
     allow for an active download to be arbitrarily long, while still detecting dead or closed
     sessions even when TCPKeepAlive is disabled.
@@ -45,9 +47,19 @@ class DownloaderFactory:
     Also for http and https urls, even though HTTP 1.1 is used, the TCP connection is setup and
     closed with each request. This is done for compatibility reasons due to various issues related
     to session continuation implementation in various servers.
+
+    The http and https downloaders built share the ``retry_policy``, and so its
+    :class:`~pulpcore.plugin.download.RetryBudget`, which limits the retries of all the downloads of
+    the factory.
+
+    With ``mirrors``, an ordered list of base URLs, the http and https downloaders built share a
+    :class:`~pulpcore.plugin.download.MirrorSet`. Each try of a download of a URL starting with one
+    of the base URLs goes to the fastest healthy mirror, so a failing mirror is avoided once its
+    circuit breaker opened and the retries of a download go to the other mirrors.
     """
 
-    def __init__(self, remote, downloader_overrides=None):
+    def __init__(self, remote, downloader_overrides=None, semaphore=None, retry_policy=None,
+                 mirrors=None):
         """
         Args:
             remote (:class:`~pulpcore.plugin.models.Remote`): The remote used to populate
@@ -55,16 +67,28 @@ class DownloaderFactory:
             downloader_overrides (dict): Keyed on a scheme name, e.g. 'https' or 'ftp' and the value
                 is the downloader class to be used for that scheme, e.g.
                 {'https': MyCustomDownloader}. These override the default values.
+            semaphore (asyncio.Semaphore): The semaphore limiting the downloads of all built
+                downloaders, e.g. a :class:`~pulpcore.plugin.download.RedisSemaphore` shared by
+                several workers. Defaults to a semaphore of `download_concurrency` of the remote.
+            retry_policy (:class:`~pulpcore.plugin.download.RetryPolicy`): The policy deciding the
+                retries of the http and https downloaders. Defaults to a policy with the default
+                settings and a :class:`~pulpcore.plugin.download.RetryBudget` of its own.
+            mirrors (list): The base URLs of the mirrors of the remote in the order of preference,
+                usually starting with the `url` of the remote. Defaults to None, no mirrors.
         """
         self._remote = remote
         self._download_class_map = copy.copy(PROTOCOL_MAP)
         if downloader_overrides:
             for protocol, download_class in downloader_overrides.items():  # overlay the overrides
                 self._download_class_map[protocol] = download_class
+        self._retry_policy = retry_policy or RetryPolicy(budget=RetryBudget())
+        self._mirrors = MirrorSet(mirrors) if mirrors else None
         self._handler_map = {'https': self._http_or_https, 'http': self._http_or_https,
                              'file': self._generic}
         self._session = self._make_aiohttp_session_from_remote()
-        self._semaphore = asyncio.Semaphore(value=remote.download_concurrency)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(value=remote.download_concurrency)
+        self._semaphore = semaphore
         atexit.register(self._session.close)
 
     def _make_aiohttp_session_from_remote(self):
@@ -109,7 +133,8 @@ class DownloaderFactory:
                 password=self._remote.password
             )
 
-        timeout = aiohttp.ClientTimeout(total=None, sock_connect=600, sock_read=600)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=600,
+                                        sock_read=self._retry_policy.read_timeout)
         return aiohttp.ClientSession(connector=conn, timeout=timeout, **auth_options)
 
     def build(self, url, **kwargs):
@@ -152,7 +177,8 @@ class DownloaderFactory:
             :class:`~pulpcore.plugin.download.HttpDownloader`: A downloader that
             is configured with the remote settings.
         """
-        options = {'session': self._session}
+        options = {'session': self._session, 'retry_policy': self._retry_policy,
+                   'mirrors': self._mirrors}
         if self._remote.proxy_url:
             options['proxy'] = self._remote.proxy_url
 
@@ -1,7 +1,14 @@
+import asyncio
+from datetime import datetime, timezone
+import email.utils
+from gettext import gettext as _
 import logging
+import random
+import warnings
 
 import aiohttp
-import backoff
+
+from pulpcore.plugin.metrics import DOWNLOAD_RETRIES
 
 from .base import BaseDownloader, DownloadResult
 
@@ -9,13 +16,12 @@ from .base import BaseDownloader, DownloadResult
 log = logging.getLogger(__name__)
 
 
-logging.getLogger('backoff').addHandler(logging.StreamHandler())
-
-
 def http_giveup(exc):
     """
     Inspect a raised exception and determine if we should give up.
 
+    Deprecated: use :meth:`RetryPolicy.is_transient` instead, which also retries network errors.
+
     Do not give up when the status code is one of the following:
 
         429 - Too Many Requests
@@ -29,9 +35,202 @@ def http_giveup(exc):
     Returns:
         True if the download should give up, False otherwise
     """
+    warnings.warn(_('http_giveup() is deprecated, use RetryPolicy.is_transient() instead.'),
+                  DeprecationWarning, stacklevel=2)
     return exc.code not in [429, 502, 503, 504]
 
 
+def http_backoff(url, tries, wait, exc):
+    """
+    Log a retry of a download and count it in the `pulp_download_retries` metric.
+
+    Args:
+        url (str): The URL of the download.
+        tries (int): The number of tries so far.
+        wait (float): The number of seconds before the next try.
+        exc (Exception): The exception the last try failed with.
+    """
+    DOWNLOAD_RETRIES.inc()
+    log.info(_('Retrying the download of {url} in {wait:.1f}s after try {tries}: {exc!r}').format(
+        url=url, wait=wait, tries=tries, exc=exc))
+
+
+def retry_after(exc):
+    """
+    Return the delay requested by the `Retry-After` header of an error response.
+
+    Args:
+        exc (Exception): The exception raised by a try of a download.
+
+    Returns:
+        float: The number of seconds to wait, or None if `exc` is not an error response with a
+            valid `Retry-After` header.
+    """
+    headers = getattr(exc, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+TRANSIENT_ERRORS = (
+    aiohttp.ClientConnectionError,  # connection refused or reset, server disconnected
+    aiohttp.ClientPayloadError,  # the body of the response was cut off
+    asyncio.TimeoutError,  # no data was received for `sock_read` seconds
+)
+
+
+class RetryBudget:
+    """
+    A limit of the retries of all the downloads sharing it, e.g. all downloads of a pipeline.
+
+    Each download started adds `ratio` retries to the budget and each retry takes one, beyond the
+    `min_retries` always allowed. A sick upstream then makes the downloads fail fast once the
+    budget is spent, instead of keeping the download slots busy with retries.
+
+    Args:
+        ratio (float): The number of retries allowed per download started. Defaults to 0.2.
+        min_retries (int): The number of retries allowed regardless of the downloads started.
+            Defaults to 100.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=100):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.downloads = 0
+        self.retries = 0
+        self.spent = False
+
+    def deposit(self):
+        """
+        Record a download started.
+        """
+        self.downloads += 1
+
+    def withdraw(self):
+        """
+        Take a retry from the budget.
+
+        Returns:
+            bool: True if the retry is allowed, False if the budget is spent.
+        """
+        if self.retries >= self.min_retries + self.ratio * self.downloads:
+            if not self.spent:
+                log.warning(_('The retry budget is spent, failed downloads are not retried.'))
+                self.spent = True
+            return False
+        self.spent = False
+        self.retries += 1
+        return True
+
+
+class RetryPolicy:
+    """
+    The decision when and how long after a failed try an :class:`HttpDownloader` tries again.
+
+    A try is retried if it failed with an error response with one of the `retry_codes` or with one
+    of the transient network errors: a connection error like a refused or reset connection, a
+    response cut off, or a socket timeout. The downloader waits for the delay of the `Retry-After`
+    header of the response if any, and for an exponential backoff with full jitter otherwise, i.e.
+    for a random delay up to `backoff_factor * 2 ** (tries - 1)` seconds.
+
+    A download is not retried after `max_tries` tries, once the delay would exceed its `deadline`,
+    once the `budget` is spent, or if its data was already passed to the consumer of
+    :meth:`~pulpcore.plugin.download.BaseDownloader.stream`.
+
+    Usage:
+        >>> policy = RetryPolicy(max_tries=5, deadline=3600, budget=RetryBudget())
+        >>> downloader = HttpDownloader(url, retry_policy=policy)
+
+    Args:
+        max_tries (int): The maximum number of tries of a download. Defaults to 10.
+        backoff_factor (float): The maximum delay in seconds after the first try. Defaults to 1.
+        max_backoff (float): The maximum delay in seconds between two tries, unless requested by
+            `Retry-After`. Defaults to 60.
+        jitter (bool): 'True' waits for a random delay up to the backoff, so the downloads failed
+            together are not retried together. 'True' is the default.
+        retry_codes (iterable): The HTTP status codes retried. Defaults to 429, 502, 503 and 504.
+        max_retry_after (float): The maximum delay in seconds requested by `Retry-After` waited
+            for, a longer delay fails the download. Defaults to 300.
+        deadline (float): The maximum number of seconds a download takes including all its tries
+            and delays, or None for no limit. Defaults to None.
+        read_timeout (float): The number of seconds without receiving any data after which a
+            try fails with a socket timeout, set on the sessions created for the downloaders.
+            Defaults to 600.
+        budget (RetryBudget): The budget shared with other downloads, or None for no limit.
+            Defaults to None.
+    """
+
+    def __init__(self, max_tries=10, backoff_factor=1, max_backoff=60, jitter=True,
+                 retry_codes=(429, 502, 503, 504), max_retry_after=300, deadline=None,
+                 read_timeout=600, budget=None):
+        self.max_tries = max_tries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_codes = frozenset(retry_codes)
+        self.max_retry_after = max_retry_after
+        self.deadline = deadline
+        self.read_timeout = read_timeout
+        self.budget = budget
+
+    def is_transient(self, exc):
+        """
+        Return whether a try failed with `exc` is worth retrying.
+
+        Args:
+            exc (Exception): The exception raised by the try.
+
+        Returns:
+            bool: True for error responses with one of the `retry_codes` and transient network
+                errors, False otherwise.
+        """
+        if isinstance(exc, aiohttp.ClientResponseError):
+            return exc.status in self.retry_codes
+        if isinstance(exc, aiohttp.ClientSSLError):
+            return False
+        return isinstance(exc, TRANSIENT_ERRORS)
+
+    def wait(self, exc, tries, remaining=None):
+        """
+        Return the delay before the next try of a download, or None to give up.
+
+        This does not take a retry from the `budget`.
+
+        Args:
+            exc (Exception): The exception raised by the last try.
+            tries (int): The number of tries so far.
+            remaining (float): The number of seconds left until the deadline of the download, or
+                None without a deadline.
+
+        Returns:
+            float: The number of seconds to wait, or None if the download should not be retried.
+        """
+        if tries >= self.max_tries or not self.is_transient(exc):
+            return None
+        delay = retry_after(exc)
+        if delay is not None:
+            if delay > self.max_retry_after:
+                return None
+        else:
+            delay = min(self.max_backoff, self.backoff_factor * 2 ** (tries - 1))
+            if self.jitter:
+                delay = random.uniform(0, delay)
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
+
+
 class HttpDownloader(BaseDownloader):
     """
     An HTTP/HTTPS Downloader built on `aiohttp`.
@@ -90,9 +289,10 @@ class HttpDownloader(BaseDownloader):
         >>>     except Exception as error:
         >>>         pass  # fatal exceptions are raised by result()
 
-    The HTTPDownloaders contain automatic retry logic if the server responds with HTTP 429 response.
-    The coroutine will automatically retry 10 times with exponential backoff before allowing a
-    final exception to be raised.
+    The HTTPDownloaders contain automatic retry logic if the server responds with HTTP 429 or some
+    5XX responses, or if the connection fails or times out. The retries are decided by the
+    :class:`RetryPolicy` of the downloader, which by default tries 10 times with jittered
+    exponential backoff before allowing a final exception to be raised.
 
     Attributes:
         session (aiohttp.ClientSession): The session to be used by the downloader.
@@ -104,13 +304,15 @@ class HttpDownloader(BaseDownloader):
             as its argument. The callback will be called when the response headers are
             available. The dictionary passed has the header names as the keys and header values
             as its values. e.g. `{'Transfer-Encoding': 'chunked'}`. This can also be None.
+        retry_policy (RetryPolicy): The policy deciding the retries of the download.
+        mirrors (:class:`~pulpcore.plugin.download.MirrorSet`): The mirrors of the `url`, or None.
 
     This downloader also has all of the attributes of
     :class:`~pulpcore.plugin.download.BaseDownloader`
     """
 
     def __init__(self, url, session=None, auth=None, proxy=None, proxy_auth=None,
-                 headers_ready_callback=None, **kwargs):
+                 headers_ready_callback=None, retry_policy=None, mirrors=None, **kwargs):
         """
         Args:
             url (str): The url to download.
@@ -124,14 +326,22 @@ class HttpDownloader(BaseDownloader):
                 as its argument. The callback will be called when the response headers are
                 available. The dictionary passed has the header names as the keys and header values
                 as its values. e.g. `{'Transfer-Encoding': 'chunked'}`
+            retry_policy (RetryPolicy): The policy deciding the retries of the download. Defaults
+                to a :class:`RetryPolicy` with the default settings and no budget.
+            mirrors (:class:`~pulpcore.plugin.download.MirrorSet`): The mirrors to download from
+                if the `url` starts with the base URL of one of them. Each try goes to the mirror
+                chosen by :meth:`~pulpcore.plugin.download.MirrorSet.choose`, avoiding the mirrors
+                that failed before, and its outcome is recorded in the mirror set. (optional)
             kwargs (dict): This accepts the parameters of
                 :class:`~pulpcore.plugin.download.BaseDownloader`.
         """
+        self.retry_policy = retry_policy or RetryPolicy()
         if session:
             self.session = session
             self._close_session_on_finalize = False
         else:
-            timeout = aiohttp.ClientTimeout(total=None, sock_connect=600, sock_read=600)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=600,
+                                            sock_read=self.retry_policy.read_timeout)
             conn = aiohttp.TCPConnector({'force_close': True})
             self.session = aiohttp.ClientSession(connector=conn, timeout=timeout)
             self._close_session_on_finalize = True
@@ -139,6 +349,8 @@ class HttpDownloader(BaseDownloader):
         self.proxy = proxy
         self.proxy_auth = proxy_auth
         self.headers_ready_callback = headers_ready_callback
+        self.mirrors = mirrors
+        self._failed_mirrors = set()
         super().__init__(url, **kwargs)
 
     async def _handle_response(self, response):
@@ -163,15 +375,12 @@ class HttpDownloader(BaseDownloader):
         return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
                               url=self.url, headers=response.headers)
 
-    @backoff.on_exception(backoff.expo, aiohttp.ClientResponseError,
-                          max_tries=10, giveup=http_giveup)
     async def _run(self, extra_data=None):
         """
         Download, validate, and compute digests on the `url`. This is a coroutine.
 
-        This method is decorated with a backoff-and-retry behavior to retry HTTP 429 and
-        some 5XX errors. It retries with exponential backoff 10 times before allowing
-        a final exception to be raised.
+        Failed tries are retried as decided by the `retry_policy`. The data handled by a failed try
+        is discarded before the next try.
 
         This method provides the same return object type and documented in
         :meth:`~pulpcore.plugin.download.BaseDownloader._run`.
@@ -179,10 +388,57 @@ class HttpDownloader(BaseDownloader):
         Args:
             extra_data (dict): Extra data passed by the downloader.
         """
-        async with self.session.get(self.url) as response:
-            response.raise_for_status()
-            to_return = await self._handle_response(response)
-            await response.release()
-        if self._close_session_on_finalize:
-            await self.session.close()
+        policy = self.retry_policy
+        loop = asyncio.get_event_loop()
+        deadline = None if policy.deadline is None else loop.time() + policy.deadline
+        if policy.budget:
+            policy.budget.deposit()
+        tries = 0
+        try:
+            while True:
+                tries += 1
+                try:
+                    if deadline is None:
+                        return await self._get()
+                    return await asyncio.wait_for(self._get(), deadline - loop.time())
+                except Exception as exc:
+                    remaining = None if deadline is None else deadline - loop.time()
+                    wait = policy.wait(exc, tries, remaining)
+                    if wait is None or not self._rewind():
+                        raise
+                    if policy.budget and not policy.budget.withdraw():
+                        raise
+                    http_backoff(self.url, tries, wait, exc)
+                    await asyncio.sleep(wait)
+        finally:
+            if self._close_session_on_finalize:
+                await self.session.close()
+
+    async def _get(self):
+        """
+        Try to download the `url` once, from the mirror chosen if the `url` belongs to a mirror.
+
+        Returns:
+             DownloadResult: The result of the download.
+        """
+        url, base_url = self.url, None
+        if self.mirrors and self.mirrors.base_url_of(self.url) is not None:
+            base_url = self.mirrors.choose(exclude=self._failed_mirrors)
+            url = self.mirrors.rewrite(self.url, base_url)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            async with self.session.get(url) as response:
+                response.raise_for_status()
+                latency = loop.time() - start
+                to_return = await self._handle_response(response)
+                await response.release()
+        except Exception as exc:
+            if base_url is not None and self.retry_policy.is_transient(exc):
+                self.mirrors.record_failure(base_url)
+                self._failed_mirrors.add(base_url)
+            raise
+        # only a complete body is a success, the latency is the time until the headers
+        if base_url is not None:
+            self.mirrors.record_success(base_url, latency)
         return to_return
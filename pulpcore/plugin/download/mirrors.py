@@ -0,0 +1,182 @@
+from gettext import gettext as _
+import logging
+import math
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class _Mirror:
+    """
+    The health of one mirror: its error rate, its latency and the state of its circuit breaker.
+    """
+
+    __slots__ = ('base_url', 'requests', 'error_rate', 'latency', 'opened_at')
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.requests = 0
+        self.error_rate = 0.0
+        self.latency = None
+        self.opened_at = None
+
+
+class MirrorSet:
+    """
+    An ordered list of mirrors of a remote, with a circuit breaker per mirror.
+
+    The downloaders share a mirror set to send each try of a download to the fastest healthy
+    mirror. The mirror set tracks an exponentially weighted moving average of the error rate and of
+    the latency, the time until the response headers are received, of each mirror. Once a mirror
+    had at least `min_requests` requests and its error rate reaches `failure_threshold`, its circuit
+    opens and it gets no requests for `reset_timeout` seconds. Then its circuit is half-open: the
+    mirror gets requests again, the next success closes the circuit and the next failure opens it
+    again.
+
+    A URL starting with the base URL of one of the mirrors is rewritten to the mirror chosen, the
+    mirror with the lowest latency among the healthy ones, or the first one of the list among those
+    without requests yet. If all circuits are open, the mirror whose circuit opened first is used.
+
+        >>> mirrors = MirrorSet(['http://a.example.com/repo/', 'http://b.example.com/repo/'])
+        >>> base_url = mirrors.choose()
+        >>> mirrors.rewrite('http://a.example.com/repo/x.rpm', base_url)
+        'http://b.example.com/repo/x.rpm'  # if b.example.com was faster
+
+    Args:
+        base_urls (list): The base URLs of the mirrors, in the order of preference.
+        failure_threshold (float): The error rate opening the circuit of a mirror. Defaults to 0.5.
+        min_requests (int): The number of requests of a mirror before its circuit can open.
+            Defaults to 5.
+        reset_timeout (float): The number of seconds a circuit stays open. Defaults to 30.
+        alpha (float): The weight of the last request in the moving averages. Defaults to 0.2.
+    """
+
+    def __init__(self, base_urls, failure_threshold=0.5, min_requests=5, reset_timeout=30,
+                 alpha=0.2):
+        if not base_urls:
+            raise ValueError(_('A MirrorSet needs at least one base URL.'))
+        self.mirrors = [_Mirror(base_url) for base_url in base_urls]
+        self._by_url = {mirror.base_url: mirror for mirror in self.mirrors}
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.alpha = alpha
+
+    @property
+    def base_urls(self):
+        """
+        The base URLs of the mirrors, in the order of preference.
+        """
+        return [mirror.base_url for mirror in self.mirrors]
+
+    def is_available(self, base_url):
+        """
+        Return whether the circuit of a mirror is closed or half-open.
+
+        Args:
+            base_url (str): The base URL of the mirror.
+
+        Returns:
+            bool: True if the mirror can get requests.
+        """
+        mirror = self._by_url[base_url]
+        return mirror.opened_at is None or \
+            time.monotonic() - mirror.opened_at >= self.reset_timeout
+
+    def choose(self, exclude=()):
+        """
+        Choose the mirror for the next request.
+
+        Args:
+            exclude (iterable): Base URLs of mirrors to avoid if another one is available, e.g. the
+                mirrors that failed before for the same download.
+
+        Returns:
+            str: The base URL of the mirror.
+        """
+        available = [mirror for mirror in self.mirrors if self.is_available(mirror.base_url)]
+        if not available:
+            return min(self.mirrors, key=lambda mirror: mirror.opened_at).base_url
+        preferred = [mirror for mirror in available if mirror.base_url not in exclude]
+        candidates = preferred or available
+        untried = [mirror for mirror in candidates if not mirror.requests]
+        if untried:
+            return untried[0].base_url
+        return min(candidates, key=self._latency).base_url
+
+    def base_url_of(self, url):
+        """
+        Return the base URL of the mirror `url` belongs to.
+
+        Args:
+            url (str): A URL.
+
+        Returns:
+            str: The longest base URL `url` starts with, or None if it belongs to no mirror.
+        """
+        matches = [base_url for base_url in self._by_url if url.startswith(base_url)]
+        return max(matches, key=len) if matches else None
+
+    def rewrite(self, url, base_url):
+        """
+        Rewrite `url` to the mirror with `base_url`.
+
+        Args:
+            url (str): A URL of any mirror.
+            base_url (str): The base URL of the mirror to use.
+
+        Returns:
+            str: `url` on the mirror with `base_url`, or `url` unchanged if it belongs to no mirror.
+        """
+        current = self.base_url_of(url)
+        if current is None:
+            return url
+        return base_url + url[len(current):]
+
+    def record_success(self, base_url, latency):
+        """
+        Record a successful request to a mirror, closing its circuit if it is half-open.
+
+        Args:
+            base_url (str): The base URL of the mirror.
+            latency (float): The number of seconds until the response headers were received.
+        """
+        mirror = self._by_url[base_url]
+        self._record(mirror, 0.0)
+        if mirror.latency is None:
+            mirror.latency = latency
+        else:
+            mirror.latency += self.alpha * (latency - mirror.latency)
+        if mirror.opened_at is not None and self.is_available(base_url):
+            log.info(_('The mirror {url} recovered.').format(url=base_url))
+            mirror.opened_at = None
+            mirror.error_rate = 0.0
+
+    def record_failure(self, base_url):
+        """
+        Record a failed request to a mirror, opening its circuit if it fails too often.
+
+        Args:
+            base_url (str): The base URL of the mirror.
+        """
+        mirror = self._by_url[base_url]
+        self._record(mirror, 1.0)
+        half_open = mirror.opened_at is not None and self.is_available(base_url)
+        tripped = mirror.requests >= self.min_requests and \
+            mirror.error_rate >= self.failure_threshold
+        if half_open or (tripped and mirror.opened_at is None):
+            log.warning(_('The mirror {url} is failing, it is not used for {timeout}s.').format(
+                url=base_url, timeout=self.reset_timeout))
+            mirror.opened_at = time.monotonic()
+
+    @staticmethod
+    def _latency(mirror):
+        return math.inf if mirror.latency is None else mirror.latency
+
+    def _record(self, mirror, error):
+        mirror.requests += 1
+        if mirror.requests == 1:
+            mirror.error_rate = error
+        else:
+            mirror.error_rate += self.alpha * (error - mirror.error_rate)
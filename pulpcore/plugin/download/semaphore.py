@@ -0,0 +1,107 @@
+import asyncio
+from collections import deque
+import math
+import time
+import uuid
+
+from pulpcore.tasking.connection import get_redis_connection
+
+
+# Drop the expired leases and take one if fewer than the limit are held.
+ACQUIRE_SCRIPT = """
+local key, now, lease, value, token = KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]),
+    tonumber(ARGV[3]), ARGV[4]
+redis.call('zremrangebyscore', key, '-inf', now - lease)
+if redis.call('zcard', key) < value then
+    redis.call('zadd', key, now, token)
+    redis.call('expire', key, ARGV[5])
+    return 1
+end
+return 0
+"""
+
+
+class RedisSemaphore:
+    """
+    A semaphore shared by all processes using the same Redis server and `name`.
+
+    It can be used wherever an :class:`asyncio.Semaphore` is accepted by the downloaders, e.g. the
+    `semaphore` of a :class:`~pulpcore.plugin.download.DownloaderFactory`, to limit the downloads
+    of all workers together.
+
+    Each acquisition is a lease stored in a sorted set in Redis. A lease held longer than `lease`
+    seconds is dropped, so the leases of a crashed process do not block the others forever. A
+    process polls Redis every `poll_interval` seconds while all leases are taken and never asks for
+    more leases than `value` at a time. The Redis commands run in the default executor of the loop,
+    so they do not block it.
+
+    Args:
+        name (str): The name of the semaphore, processes using the same name share it.
+        value (int): The number of leases that can be held at the same time.
+        lease (float): The number of seconds after which a lease is dropped. Defaults to 3600.
+        poll_interval (float): The seconds to wait before trying again to acquire a lease.
+            Defaults to 0.1.
+        connection (redis.StrictRedis): The Redis connection. Defaults to the connection of the
+            tasking system.
+    """
+
+    def __init__(self, name, value, lease=3600, poll_interval=0.1, connection=None):
+        self.key = 'pulp:semaphore:{name}'.format(name=name)
+        self.value = value
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._connection = connection
+        self._script = None
+        self._local = asyncio.Semaphore(value)
+        self._tokens = deque()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = get_redis_connection()
+        return self._connection
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    def _try_acquire(self, token):
+        if self._script is None:
+            self._script = self.connection.register_script(ACQUIRE_SCRIPT)
+        args = [time.time(), self.lease, self.value, token, math.ceil(self.lease)]
+        return bool(self._script(keys=[self.key], args=args))
+
+    async def acquire(self):
+        """
+        Acquire a lease, waiting until one is available.
+
+        Each lease acquired must be released by one call of :meth:`release`.
+        """
+        await self._local.acquire()
+        loop = asyncio.get_event_loop()
+        token = uuid.uuid4().hex
+        try:
+            while not await loop.run_in_executor(None, self._try_acquire, token):
+                await asyncio.sleep(self.poll_interval)
+        except BaseException:
+            self._local.release()
+            raise
+        self._tokens.append(token)
+        return True
+
+    def release(self):
+        """
+        Release a lease acquired by this semaphore.
+
+        The leases are interchangeable, so the oldest lease held is given back, which keeps the
+        leases still held from being dropped early.
+
+        Returns:
+            asyncio.Future: Done when the lease was removed from Redis.
+        """
+        token = self._tokens.popleft()
+        self._local.release()
+        return asyncio.get_event_loop().run_in_executor(None, self.connection.zrem, self.key,
+                                                        token)
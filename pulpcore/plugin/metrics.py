@@ -0,0 +1,340 @@
+"""
+Metrics of running pipelines and downloads, exposed in the OpenMetrics text format.
+
+The metrics are updated by the Stages API and the downloaders in every process, which only costs an
+addition per update. They are exported if the `METRICS_TEXTFILE_DIRECTORY` setting names a
+directory: each running pipeline then writes the metrics of its process to a
+`pulp_worker_<hostname>_<pid>.prom` file in that directory every `METRICS_INTERVAL` seconds
+(defaults to 10) and when it is finished. The files can be collected with a textfile collector,
+e.g. the one of the Prometheus node exporter.
+"""
+import asyncio
+from gettext import gettext as _
+import os
+import socket
+import tempfile
+
+from django.conf import settings
+
+
+class _Value:
+    """
+    The value of a metric for one combination of label values.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue:
+    """
+    The buckets, sum and count of a histogram for one combination of label values.
+    """
+
+    __slots__ = ('upper_bounds', 'buckets', 'sum', 'count')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.buckets = [0] * len(upper_bounds)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for num, upper_bound in enumerate(self.upper_bounds):
+            if value <= upper_bound:
+                self.buckets[num] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """
+    A metric family with a value for each combination of label values.
+
+    Args:
+        name (str): The name of the metric family.
+        documentation (str): The help text of the metric family.
+        labelnames (tuple): The names of the labels.
+        registry (:class:`Registry`): The registry to add the metric to. Defaults to
+            :data:`REGISTRY`.
+    """
+
+    type = 'unknown'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        (registry or REGISTRY).register(self)
+
+    def _new_value(self):
+        return _Value()
+
+    def labels(self, *labelvalues):
+        """
+        The value for `labelvalues`, keep it to update the metric without a lookup.
+
+        Args:
+            labelvalues: A string value for each of the label names.
+
+        Returns:
+            The value with `inc()`, `dec()`, `set()` or `observe()` methods depending on the type of
+            the metric.
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(_('{name} expects the labels {labels}').format(
+                name=self.name, labels=self.labelnames))
+        try:
+            return self._values[labelvalues]
+        except KeyError:
+            value = self._values[labelvalues] = self._new_value()
+            return value
+
+    def samples(self):
+        """
+        Yields:
+            tuple: The suffix, the labels and the value of each sample of the metric.
+        """
+        for labelvalues, value in sorted(self._values.items()):
+            yield '', dict(zip(self.labelnames, labelvalues)), value.value
+
+
+class Counter(Metric):
+    """
+    A metric that only increases.
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1):
+        """
+        Increase the value of a counter without labels by `amount`.
+        """
+        self.labels().inc(amount)
+
+    def samples(self):
+        for suffix, labels, value in super().samples():
+            yield '_total', labels, value
+
+
+class Gauge(Metric):
+    """
+    A metric that can increase and decrease.
+    """
+
+    type = 'gauge'
+
+    def inc(self, amount=1):
+        """
+        Increase the value of a gauge without labels by `amount`.
+        """
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        """
+        Decrease the value of a gauge without labels by `amount`.
+        """
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    """
+    A metric counting observations in buckets.
+
+    Args:
+        buckets (tuple): The upper bounds of the buckets, in increasing order. A bucket for
+            infinity is added.
+        args: positional arguments passed along to :class:`Metric`.
+        kwargs: keyword arguments passed along to :class:`Metric`.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, *args, buckets, **kwargs):
+        self.upper_bounds = tuple(buckets) + (float('inf'),)
+        super().__init__(*args, **kwargs)
+
+    def _new_value(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def samples(self):
+        for labelvalues, value in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for upper_bound, count in zip(self.upper_bounds, value.buckets):
+                cumulative += count
+                le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                yield '_bucket', dict(labels, le=le), cumulative
+            yield '_count', labels, value.count
+            yield '_sum', labels, value.sum
+
+
+class Registry:
+    """
+    A collection of metrics rendered together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self, labels=None):
+        """
+        Render all metrics in the OpenMetrics text format.
+
+        Args:
+            labels (dict): Labels added to every sample, e.g. identifying the process.
+
+        Returns:
+            str: The metrics, ending with `# EOF`.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# TYPE {name} {type}'.format(name=metric.name, type=metric.type))
+            lines.append('# HELP {name} {help}'.format(name=metric.name,
+                                                       help=_escape(metric.documentation)))
+            for suffix, sample_labels, value in metric.samples():
+                sample_labels = dict(labels or {}, **sample_labels)
+                lines.append('{name}{suffix}{labels} {value}'.format(
+                    name=metric.name,
+                    suffix=suffix,
+                    labels=_format_labels(sample_labels),
+                    value=repr(float(value)) if isinstance(value, float) else value,
+                ))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{name}="{value}"'.format(name=name, value=_escape(str(value)))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+REGISTRY = Registry()
+"""The registry of the metrics of pulpcore and plugins."""
+
+
+STAGE_ITEMS_IN = Counter(
+    'pulp_stage_items_in', 'Items received by a stage.', ('num', 'stage'))
+STAGE_ITEMS_OUT = Counter(
+    'pulp_stage_items_out', 'Items passed on by a stage.', ('num', 'stage'))
+STAGE_QUEUE_DEPTH = Gauge(
+    'pulp_stage_queue_depth', 'Items waiting in the input queue of a stage.', ('num', 'stage'))
+STAGE_BATCH_SIZE = Histogram(
+    'pulp_stage_batch_size', 'Sizes of the batches handled by a stage.', ('num', 'stage'),
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+DOWNLOAD_BYTES = Counter(
+    'pulp_download_bytes', 'Bytes downloaded.')
+DOWNLOADS_ACTIVE = Gauge(
+    'pulp_downloads_active', 'Downloads running.')
+DOWNLOAD_RETRIES = Counter(
+    'pulp_download_retries', 'Downloads retried after a failed try.')
+
+
+class StageMetrics:
+    """
+    The metrics of one stage of a running pipeline.
+
+    Args:
+        num (int): The position of the stage in the pipeline, starting at 0.
+        stage (:class:`~pulpcore.plugin.stages.Stage`): The stage.
+        in_q (asyncio.Queue): The input queue of the stage, or None for the first stage.
+    """
+
+    __slots__ = ('items_in', 'items_out', 'batch_size', 'queue_depth', 'in_q')
+
+    def __init__(self, num, stage, in_q):
+        labels = (str(num), stage.__class__.__name__)
+        self.items_in = STAGE_ITEMS_IN.labels(*labels)
+        self.items_out = STAGE_ITEMS_OUT.labels(*labels)
+        self.batch_size = STAGE_BATCH_SIZE.labels(*labels)
+        self.queue_depth = STAGE_QUEUE_DEPTH.labels(*labels)
+        self.in_q = in_q
+
+    def update_queue_depth(self):
+        self.queue_depth.set(self.in_q.qsize() if self.in_q else 0)
+
+
+class TextfileExporter:
+    """
+    Write :data:`REGISTRY` to a file periodically while a pipeline is running.
+
+    The file is replaced atomically, so a collector never reads a partial file. It is removed when
+    the pipeline is finished: every task runs in a new process, and the files of the finished ones
+    would pile up otherwise.
+
+    Args:
+        directory (str): The directory to write `pulp_worker_<hostname>_<pid>.prom` to.
+        stage_metrics (list): The :class:`StageMetrics` of the pipeline, used to update the queue
+            depths before writing.
+        interval (float): The seconds between two writes.
+    """
+
+    def __init__(self, directory, stage_metrics, interval):
+        worker = '{hostname}_{pid}'.format(hostname=socket.gethostname(), pid=os.getpid())
+        self.path = os.path.join(directory, 'pulp_worker_{worker}.prom'.format(worker=worker))
+        self.labels = {'worker': worker}
+        self.stage_metrics = stage_metrics
+        self.interval = interval
+
+    @classmethod
+    def from_settings(cls, stage_metrics):
+        """
+        Returns:
+            :class:`TextfileExporter`: An exporter configured by the `METRICS_TEXTFILE_DIRECTORY`
+                and `METRICS_INTERVAL` settings, or None if metrics are not exported.
+        """
+        directory = getattr(settings, 'METRICS_TEXTFILE_DIRECTORY', None)
+        if not directory:
+            return None
+        return cls(directory, stage_metrics, getattr(settings, 'METRICS_INTERVAL', 10))
+
+    def write(self):
+        """
+        Write the metrics to the file.
+        """
+        for metrics in self.stage_metrics:
+            metrics.update_queue_depth()
+        text = REGISTRY.render(self.labels)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path), suffix='.tmp',
+                                         delete=False) as f_handle:
+            f_handle.write(text)
+        os.rename(f_handle.name, self.path)
+
+    def remove(self):
+        """
+        Remove the file, if it was written.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def run(self):
+        """
+        A coroutine writing the metrics every `interval` seconds until it is cancelled.
+        """
+        while True:
+            self.write()
+            await asyncio.sleep(self.interval)
@@ -3,7 +3,8 @@ from gettext import gettext as _
 from pulpcore.app.models import Artifact as PlatformArtifact
 from pulpcore.app.models import Remote as PlatformRemote
 
-from pulpcore.plugin.download import DownloaderFactory
+from pulpcore.plugin.download import DownloaderFactory, RetryBudget, RetryPolicy
+from pulpcore.plugin.tasking import SyncGroup
 
 
 class Remote(PlatformRemote):
@@ -25,12 +26,48 @@ class Remote(PlatformRemote):
     class Meta:
         abstract = True
 
+    @property
+    def retry_policy(self):
+        """
+        Return the RetryPolicy deciding the retries of the http and https downloads of this remote.
+
+        The policy is used by the DownloaderFactory, so all downloaders of the remote share its
+        :class:`~pulpcore.plugin.download.RetryBudget`.
+
+        Plugin writers are expected to override when the retries should be configured, e.g. with
+        a longer `deadline` for remotes serving large files.
+
+        Returns:
+            RetryPolicy: A :class:`~pulpcore.plugin.download.RetryPolicy` with the default
+                settings and a budget of its own.
+        """
+        return RetryPolicy(budget=RetryBudget())
+
+    @property
+    def mirror_urls(self):
+        """
+        Return the base URLs of the mirrors of this remote, in the order of preference.
+
+        The DownloaderFactory sends the downloads of URLs starting with one of them to the fastest
+        healthy mirror, see :class:`~pulpcore.plugin.download.MirrorSet`.
+
+        Plugin writers are expected to override when their remotes have mirrors, e.g. from a
+        mirror list of the repository.
+
+        Returns:
+            list: The base URLs, usually starting with `url`, or None for no mirrors.
+        """
+        return None
+
     @property
     def download_factory(self):
         """
         Return the DownloaderFactory which can be used to generate asyncio capable downloaders.
 
-        Upon first access, the DownloaderFactory is instantiated and saved internally.
+        Upon first access, the DownloaderFactory is instantiated and saved internally. If the
+        currently executing task is a member of a :class:`~pulpcore.plugin.tasking.SyncGroup`, the
+        factory shares the download limit of the group. The factory uses the `retry_policy` and the
+        `mirror_urls`.
 
         Plugin writers are expected to override when additional configuration of the
         DownloaderFactory is needed.
@@ -42,7 +79,12 @@ class Remote(PlatformRemote):
         try:
             return self._download_factory
         except AttributeError:
-            self._download_factory = DownloaderFactory(self)
+            options = {'retry_policy': self.retry_policy, 'mirrors': self.mirror_urls}
+            group = SyncGroup.current()
+            if group is None:
+                self._download_factory = DownloaderFactory(self, **options)
+            else:
+                self._download_factory = group.downloader_factory(self, **options)
             return self._download_factory
 
     def get_downloader(self, remote_artifact=None, url=None, **kwargs):
@@ -10,7 +10,21 @@ from .association_stages import (  # noqa
     ContentUnassociation,
     RemoveDuplicates
 )
-from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures  # noqa
+from .content_stages import (  # noqa
+    ContentSaver,
+    QueryExistingContents,
+    QueryUnchangedContents,
+    ResolveContentFutures,
+)
 from .declarative_version import DeclarativeVersion  # noqa
+from .keyset import BloomFilter, UUIDSet  # noqa
 from .models import DeclarativeArtifact, DeclarativeContent  # noqa
-from .profiler import ProfilingQueue, create_profile_db_and_connection  # noqa
+from .process_pool import ProcessPoolStage  # noqa
+from .profiler import (  # noqa
+    create_profile_db_and_connection,
+    ProfilingQueue,
+    QueryRecorder,
+    QueryStats,
+)
+from .sharding import download_share, natural_key_shard, ShardedStages  # noqa
+from .streaming import decompress, iterparse, read_chunks, read_lines, StreamingStage  # noqa
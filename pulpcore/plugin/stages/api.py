@@ -1,11 +1,17 @@
 import asyncio
+from collections import deque
 import logging
+import sys
+import weakref
 
 from gettext import gettext as _
 
 from django.conf import settings
+from django.db import connection
 
-from .profiler import ProfilingQueue
+from pulpcore.plugin.metrics import StageMetrics, TextfileExporter
+
+from .profiler import ProfilingQueue, QueryRecorder
 
 
 log = logging.getLogger(__name__)
@@ -16,8 +22,25 @@ class Stage:
     The base class for all Stages API stages.
 
     To make a stage, inherit from this class and implement :meth:`run` on the subclass.
+
+    Stages that set the class attribute `skip_unchanged` to `True` never see
+    :class:`~pulpcore.plugin.stages.DeclarativeContent` marked as `unchanged` by the
+    :class:`~pulpcore.plugin.stages.QueryUnchangedContents` stage. :meth:`items` and
+    :meth:`batches` pass these units on to the next stage directly instead of yielding them.
+
+    If query instrumentation is enabled, the `query_stats` attribute of a stage is a
+    :class:`~pulpcore.plugin.stages.QueryStats` counting the database queries of its :meth:`run`
+    coroutine, see :func:`~pulpcore.plugin.stages.create_pipeline`.
     """
 
+    skip_unchanged = False
+
+    query_stats = None
+
+    _budget = None
+
+    _metrics = None
+
     def __init__(self):
         self._in_q = None
         self._out_q = None
@@ -78,6 +101,13 @@ class Stage:
             content = await self._in_q.get()
             if content is None:
                 break
+            if self._metrics is not None:
+                self._metrics.items_in.inc()
+            if self._budget is not None and self._out_q is None:
+                self._budget.release(content)
+            if self.skip_unchanged and content.unchanged:
+                await self.put(content)
+                continue
             log.debug(_('%(name)s - next: %(content)s.'), {'name': self, 'content': content})
             yield content
 
@@ -121,6 +151,10 @@ class Stage:
                 if not content.does_batch:
                     no_block = True
                 batch.append(content)
+                if self._metrics is not None:
+                    self._metrics.items_in.inc()
+                if self._budget is not None and self._out_q is None:
+                    self._budget.release(content)
 
         while not shutdown:
             content = await self._in_q.get()
@@ -133,7 +167,16 @@ class Stage:
                 else:
                     add_to_batch(content)
 
+            if self.skip_unchanged:
+                batch = await self._put_unchanged(batch)
+
+            # waiting for more items would wait forever while the budget of the pipeline is used up
+            if self._budget is not None and self._budget.exhausted:
+                no_block = True
+
             if batch and (len(batch) >= minsize or shutdown or no_block):
+                if self._metrics is not None:
+                    self._metrics.batch_size.observe(len(batch))
                 log.debug(
                     _('%(name)s - next batch[%(length)d].'),
                     {
@@ -144,6 +187,24 @@ class Stage:
                 batch = []
                 no_block = False
 
+    async def _put_unchanged(self, batch):
+        """
+        Pass the unchanged units of `batch` on to the next stage.
+
+        Args:
+            batch (list): A list of :class:`DeclarativeContent` instances.
+
+        Returns:
+            list: The :class:`DeclarativeContent` instances of `batch` that are not unchanged.
+        """
+        remaining = []
+        for d_content in batch:
+            if d_content.unchanged:
+                await self.put(d_content)
+            else:
+                remaining.append(d_content)
+        return remaining
+
     async def put(self, item):
         """
         Coroutine to pass items to the next stage.
@@ -156,14 +217,111 @@ class Stage:
         """
         if item is None:
             raise ValueError(_('(None) not permitted.'))
+        if self._budget is not None and self._in_q is None:
+            await self._budget.charge(item)
         await self._out_q.put(item)
+        if self._metrics is not None:
+            self._metrics.items_out.inc()
         log.debug(_('%(name)s - put: %(content)s'), {'name': self, 'content': item})
 
     def __str__(self):
         return '[{id}] {name}'.format(id=id(self), name=self.__class__.__name__)
 
 
-async def create_pipeline(stages, maxsize=100):
+class _ByteBudget:
+    """
+    The number of bytes the items in a pipeline may use.
+
+    Items are charged with their approximate size when the first stage puts them into the pipeline,
+    and released when the last stage receives them. Items dropped by a stage in between are
+    released when they are garbage collected.
+
+    While the budget is used up, :meth:`~pulpcore.plugin.stages.Stage.batches` yields the batches
+    it has without waiting for `minsize` items, so stages waiting for more items don't stall the
+    pipeline. A warning is logged every `warn_interval` seconds the first stage waits for the
+    budget.
+
+    Args:
+        max_bytes (int): The number of bytes the items in the pipeline may use.
+    """
+
+    warn_interval = 60
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._charges = {}
+        self._waiters = deque()
+
+    @property
+    def exhausted(self):
+        """
+        Whether the first stage waits for the budget.
+        """
+        return bool(self._waiters)
+
+    async def charge(self, item):
+        """
+        Charge the budget with the approximate size of `item`, waiting until it's available.
+
+        An item is admitted to an unused budget even if it is larger than the budget. Items that
+        don't support weak references are not charged.
+
+        Args:
+            item: The item entering the pipeline.
+        """
+        approximate_size = getattr(item, 'approximate_size', None)
+        size = approximate_size() if approximate_size else sys.getsizeof(item)
+        waited = 0
+        while self.used and self.used + size > self.max_bytes:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), self.warn_interval)
+            except asyncio.TimeoutError:
+                waited += self.warn_interval
+                log.warning(_('The pipeline waits for %(waited)d seconds for %(used)d bytes of its '
+                              'budget of %(max_bytes)d bytes to be released. A stage may keep '
+                              'too many items.'),
+                            {'waited': waited, 'used': self.used, 'max_bytes': self.max_bytes})
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        key = id(item)
+        try:
+            self._charges[key] = weakref.finalize(item, self._release, key, size)
+        except TypeError:
+            return
+        self.used += size
+
+    def release(self, item):
+        """
+        Release the budget charged for `item`, which leaves the pipeline.
+
+        Args:
+            item: The item received by the last stage.
+        """
+        finalizer = self._charges.get(id(item))
+        if finalizer is not None:
+            finalizer()
+
+    def _release(self, key, size):
+        """
+        Release `size` bytes of the budget and wake up the waiting producers.
+
+        Args:
+            key (int): The id of the item charged.
+            size (int): The number of bytes to release.
+        """
+        del self._charges[key]
+        self.used -= size
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+async def create_pipeline(stages, maxsize=100, max_bytes=None):
     """
     A coroutine that builds a Stages API linear pipeline from the list `stages` and runs it.
 
@@ -181,6 +339,27 @@ async def create_pipeline(stages, maxsize=100):
         stages (list of coroutines): A list of Stages API compatible coroutines.
         maxsize (int): The maximum amount of items a queue between two stages should hold. Optional
             and defaults to 100.
+        max_bytes (int): The maximum approximate number of bytes used by all items in the
+            pipeline, including the items held by stages. Optional and defaults to None, which means
+            unlimited. Items are charged when the first stage puts them into the pipeline, which
+            waits while the budget is used up, and released when the last stage receives them or
+            when they are garbage collected if a stage drops them. While the budget is used up,
+            :meth:`~pulpcore.plugin.stages.Stage.batches` yields smaller batches, so a stage must
+            not wait for more items than that in another way or the pipeline stalls, which is
+            logged as a warning every minute. The size is computed with the `approximate_size()`
+            method of an item, e.g.
+            :meth:`~pulpcore.plugin.stages.DeclarativeContent.approximate_size`, or
+            :func:`sys.getsizeof` if it doesn't have one.
+
+    With the `PROFILE_STAGES_API` or `PROFILE_STAGES_API_QUERIES` setting enabled, the number of
+    database queries, the rows they returned or affected and their execution time are recorded for
+    each stage in its `query_stats` attribute. When the pipeline finished, these totals are saved as
+    completed progress reports of the task, named after the stages. With `PROFILE_STAGES_API`, they
+    are also written to the profile database, see :ref:`stages-api-profiling-docs`.
+
+    The items received and passed on, the batch sizes and the queue depth of each stage are
+    recorded in :mod:`pulpcore.plugin.metrics`, which the pipeline exports while it runs if the
+    `METRICS_TEXTFILE_DIRECTORY` setting is set.
 
     Returns:
         A single coroutine that can be used to run, wait, or cancel the entire pipeline with.
@@ -202,11 +381,33 @@ async def create_pipeline(stages, maxsize=100):
         else:
             out_q = None
         stage._connect(in_q, out_q)
-        futures.append(asyncio.ensure_future(stage()))
+        stage._metrics = StageMetrics(i, stage, in_q)
         in_q = out_q
 
+    if max_bytes is not None:
+        budget = _ByteBudget(max_bytes)
+        for stage in stages:
+            stage._budget = budget
+    recorder = None
+    if settings.PROFILE_STAGES_API or getattr(settings, 'PROFILE_STAGES_API_QUERIES', False):
+        recorder = QueryRecorder()
+    for stage in stages:
+        futures.append(asyncio.ensure_future(stage()))
+        if recorder:
+            recorder.add(stage, futures[-1])
+    exporter = TextfileExporter.from_settings([stage._metrics for stage in stages])
+    if exporter:
+        exporting = asyncio.ensure_future(exporter.run())
+
     try:
-        await asyncio.gather(*futures)
+        if recorder:
+            with connection.execute_wrapper(recorder):
+                await asyncio.gather(*futures)
+            recorder.save_progress_reports()
+            if settings.PROFILE_STAGES_API:
+                recorder.record_profile()
+        else:
+            await asyncio.gather(*futures)
     except Exception:
         # One of the stages raised an exception, cancel all stages...
         pending = []
@@ -218,6 +419,10 @@ async def create_pipeline(stages, maxsize=100):
         if pending:
             await asyncio.wait(pending, timeout=60)
         raise
+    finally:
+        if exporter:
+            exporting.cancel()
+            exporter.remove()
 
 
 class EndStage(Stage):
@@ -4,8 +4,10 @@ import logging
 from django.db.models import Q
 
 from pulpcore.plugin.models import Artifact, ContentArtifact, ProgressBar, RemoteArtifact
+from pulpcore.plugin.tasking import SyncGroup
 
 from .api import Stage
+from .keyset import BloomFilter
 
 log = logging.getLogger(__name__)
 
@@ -31,8 +33,70 @@ class QueryExistingArtifacts(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    With `digest_filter`, the digests of all saved Artifacts are loaded into a
+    :class:`~pulpcore.plugin.stages.BloomFilter` once per digest type, when the first unsaved
+    Artifact with such a digest is received. The sha256 digest is used if it is known, the
+    strongest known digest otherwise. Artifacts whose digest is not in the filter certainly
+    didn't exist then and are not searched, so a batch of new Artifacts, e.g. in an initial sync,
+    needs no query. This pays off if many Artifacts are received compared to the size of the
+    Artifact table. Artifacts saved by other tasks after the filter was built are not found and
+    downloaded again, :class:`~pulpcore.plugin.stages.ArtifactSaver` then uses the saved ones.
+
+    Args:
+        digest_filter (bool): Whether to search only the Artifacts whose digest is in a bloom
+            filter of the saved digests. Defaults to `False`.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
+    skip_unchanged = True
+
+    def __init__(self, *args, digest_filter=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.digest_filter = digest_filter
+        self._digest_filters = {}
+
+    def _filter(self, digest_name):
+        """
+        Get the bloom filter of the `digest_name` digests of the saved Artifacts, building it if
+        needed.
+
+        Args:
+            digest_name (str): The name of a digest field of Artifact.
+
+        Returns:
+            :class:`~pulpcore.plugin.stages.BloomFilter`: The filter of the digests.
+        """
+        try:
+            return self._digest_filters[digest_name]
+        except KeyError:
+            pass
+        digests = Artifact.objects.values_list(digest_name, flat=True)
+        digest_filter = BloomFilter(digests.count())
+        digest_filter.update(digests.iterator())
+        self._digest_filters[digest_name] = digest_filter
+        return digest_filter
+
+    def _may_exist(self, artifact):
+        """
+        Check the digest filter for `artifact`.
+
+        Args:
+            artifact (:class:`~pulpcore.plugin.models.Artifact`): A declared Artifact.
+
+        Returns:
+            bool: False if `artifact` is certainly not saved.
+        """
+        if not self.digest_filter or artifact.pk:
+            return True
+        # sha256 first, the digest every saved Artifact has, then by strength
+        for digest_name in sorted(artifact.DIGEST_FIELDS, key=lambda name: name != 'sha256'):
+            digest_value = getattr(artifact, digest_name)
+            if digest_value:
+                return digest_value in self._filter(digest_name)
+        return True
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -42,13 +106,18 @@ class QueryExistingArtifacts(Stage):
         """
         async for batch in self.batches():
             all_artifacts_q = Q(pk=None)
+            search = False
             for d_content in batch:
                 for d_artifact in d_content.d_artifacts:
+                    if not self._may_exist(d_artifact.artifact):
+                        continue
                     one_artifact_q = d_artifact.artifact.q()
                     if one_artifact_q:
                         all_artifacts_q |= one_artifact_q
+                        search = True
 
-            for artifact in Artifact.objects.filter(all_artifacts_q):
+            existing_artifacts = Artifact.objects.filter(all_artifacts_q) if search else []
+            for artifact in existing_artifacts:
                 for d_content in batch:
                     for d_artifact in d_content.d_artifacts:
                         for digest_name in artifact.DIGEST_FIELDS:
@@ -75,11 +144,17 @@ class ArtifactDownloader(Stage):
     its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
 
     This stage creates a ProgressBar named 'Downloading Artifacts' that counts the number of
-    downloads completed. Since it's a stream the total count isn't known until it's finished.
+    downloads completed. Since it's a stream the total count isn't known until it's finished. The
+    ProgressBar is used as a context manager, so its updates are written to the database at most
+    every 500 milliseconds and once more when the stage finishes.
 
     This stage drains all available items from `self._in_q` and starts as many downloaders as
     possible (up to `download_concurrency` set on a Remote)
 
+    If the task is a member of a :class:`~pulpcore.plugin.tasking.SyncGroup`, artifacts another
+    member is downloading are not downloaded again, see
+    :meth:`~pulpcore.plugin.tasking.SyncGroup.download`.
+
     Args:
         max_concurrent_content (int): The maximum number of
             :class:`~pulpcore.plugin.stages.DeclarativeContent` instances to handle simultaneously.
@@ -88,9 +163,12 @@ class ArtifactDownloader(Stage):
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
+    skip_unchanged = True
+
     def __init__(self, max_concurrent_content=200, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_concurrent_content = max_concurrent_content
+        self._sync_group = None
 
     async def run(self):
         """
@@ -99,6 +177,8 @@ class ArtifactDownloader(Stage):
         Returns:
             The coroutine for this stage.
         """
+        self._sync_group = SyncGroup.current()
+
         def _add_to_pending(coro):
             nonlocal pending
             task = asyncio.ensure_future(coro)
@@ -134,7 +214,7 @@ class ArtifactDownloader(Stage):
                     if content_get_task and content_get_task not in pending:  # not yet shutdown
                         if len(pending) < self.max_concurrent_content:
                             content_get_task = _add_to_pending(content_iterator.__anext__())
-            except asyncio.CancelledError:
+            except BaseException:
                 # asyncio.wait does not cancel its tasks when cancelled, we need to do this
                 for future in pending:
                     future.cancel()
@@ -147,7 +227,7 @@ class ArtifactDownloader(Stage):
             The number of downloads
         """
         downloaders_for_content = [
-            d_artifact.download() for d_artifact in d_content.d_artifacts
+            self._download(d_artifact) for d_artifact in d_content.d_artifacts
             if d_artifact.artifact.pk is None
         ]
         if downloaders_for_content:
@@ -155,6 +235,21 @@ class ArtifactDownloader(Stage):
         await self.put(d_content)
         return len(downloaders_for_content)
 
+    def _download(self, d_artifact):
+        """
+        Download the artifact of `d_artifact`, through the sync group of the task if any.
+
+        Args:
+            d_artifact (:class:`~pulpcore.plugin.stages.DeclarativeArtifact`): The artifact to
+                download.
+
+        Returns:
+            The coroutine downloading the artifact.
+        """
+        if self._sync_group is None:
+            return d_artifact.download()
+        return self._sync_group.download(d_artifact)
+
 
 class ArtifactSaver(Stage):
     """
@@ -171,8 +266,13 @@ class ArtifactSaver(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    If the task is a member of a :class:`~pulpcore.plugin.tasking.SyncGroup`, any claims of artifact
+    downloads left are released when this stage finishes or fails.
     """
 
+    skip_unchanged = True
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -180,21 +280,24 @@ class ArtifactSaver(Stage):
         Returns:
             The coroutine for this stage.
         """
-        async for batch in self.batches():
-            da_to_save = []
-            for d_content in batch:
-                for d_artifact in d_content.d_artifacts:
-                    if d_artifact.artifact.pk is None:
-                        d_artifact.artifact.file = str(d_artifact.artifact.file)
-                        da_to_save.append(d_artifact)
+        try:
+            async for batch in self.batches():
+                da_to_save = []
+                for d_content in batch:
+                    for d_artifact in d_content.d_artifacts:
+                        if d_artifact.artifact.pk is None:
+                            d_artifact.artifact.file = str(d_artifact.artifact.file)
+                            da_to_save.append(d_artifact)
 
-            if da_to_save:
-                for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
-                        d_artifact.artifact for d_artifact in da_to_save)):
-                    d_artifact.artifact = artifact
+                if da_to_save:
+                    for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
+                            d_artifact.artifact for d_artifact in da_to_save)):
+                        d_artifact.artifact = artifact
 
-            for d_content in batch:
-                await self.put(d_content)
+                for d_content in batch:
+                    await self.put(d_content)
+        finally:
+            await asyncio.get_event_loop().run_in_executor(None, SyncGroup.release_claims)
 
 
 class RemoteArtifactSaver(Stage):
@@ -205,6 +308,8 @@ class RemoteArtifactSaver(Stage):
     :class:`~pulpcore.plugin.stages.DeclarativeArtifact`.
     """
 
+    skip_unchanged = True
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -1,8 +1,35 @@
-from django.db.models import Q
+from collections import OrderedDict
+from itertools import chain, islice
+
+from django.db import connection
+from django.db.models import Q, QuerySet
+from django.db.models.expressions import RawSQL
 
 from pulpcore.plugin.models import Content, ProgressBar
 
 from .api import Stage
+from .keyset import UUIDSet
+
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def _chunks(iterable, size):
+    """
+    Split `iterable` into lists of at most `size` items.
+
+    Args:
+        iterable (iterable): The items to split.
+        size (int): The maximum number of items per list.
+
+    Returns:
+        generator: A generator of lists.
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
 
 
 class ContentAssociation(Stage):
@@ -10,22 +37,33 @@ class ContentAssociation(Stage):
     A Stages API stage that associates content units with `new_version`.
 
     This stage stores all content unit primary keys in memory before running. This is done to
-    compute the units already associated but not received from `self._in_q`. These units are passed
-    via `self._out_q` to the next stage as a :class:`django.db.models.query.QuerySet`.
+    compute the units already associated but not received from `self._in_q`. The primary keys are
+    kept in a :class:`~pulpcore.plugin.stages.UUIDSet` to keep memory usage low for large
+    repositories. The primary keys of these units are passed via `self._out_q` to the next stage as
+    :class:`~pulpcore.plugin.stages.UUIDSet` objects of at most `chunk_size` keys each, so the next
+    stage can start unassociating while the remaining chunks are being sent.
+
+    Units are associated with one query per chunk of at most `chunk_size` units, which keeps the
+    number of SQL parameters per statement bounded.
 
     This stage creates a ProgressBar named 'Associating Content' that counts the number of units
-    associated. Since it's a stream the total count isn't known until it's finished.
+    associated. Since it's a stream the total count isn't known until it's finished. The
+    ProgressBar is used as a context manager, so its updates are written to the database at most
+    every 500 milliseconds and once more when the stage finishes.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage associates content with.
+        chunk_size (int): The maximum number of primary keys per query and per chunk sent to the
+            next stage. Defaults to 10000.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, new_version, *args, **kwargs):
+    def __init__(self, new_version, *args, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
         super().__init__(*args, **kwargs)
         self.new_version = new_version
+        self.chunk_size = chunk_size
 
     async def run(self):
         """
@@ -35,7 +73,7 @@ class ContentAssociation(Stage):
             The coroutine for this stage.
         """
         with ProgressBar(message='Associating Content') as pb:
-            to_delete = set(self.new_version.content.values_list('pk', flat=True))
+            to_delete = UUIDSet(self.new_version.content.values_list('pk', flat=True).iterator())
             async for batch in self.batches():
                 to_add = set()
                 for d_content in batch:
@@ -44,32 +82,45 @@ class ContentAssociation(Stage):
                     except KeyError:
                         to_add.add(d_content.content.pk)
 
-                if to_add:
-                    self.new_version.add_content(Content.objects.filter(pk__in=to_add))
-                    pb.done = pb.done + len(to_add)
+                for chunk in _chunks(to_add, self.chunk_size):
+                    self.new_version.add_content(Content.objects.filter(pk__in=chunk))
+                    pb.done = pb.done + len(chunk)
                     pb.save()
 
-            if to_delete:
-                await self.put(Content.objects.filter(pk__in=to_delete))
+            for chunk in _chunks(to_delete, self.chunk_size):
+                await self.put(UUIDSet(chunk))
 
 
 class ContentUnassociation(Stage):
     """
     A Stages API stage that unassociates content units from `new_version`.
 
+    This stage expects collections of content unit primary keys from `self._in_q`, e.g. the
+    :class:`~pulpcore.plugin.stages.UUIDSet` sent by
+    :class:`~pulpcore.plugin.stages.ContentAssociation`. Each collection is passed on via
+    `self._out_q` after its units are unassociated. A :class:`django.db.models.query.QuerySet` of
+    content units is accepted too, its primary keys are fetched before any unit is unassociated.
+
+    Units are unassociated with one query per chunk of at most `chunk_size` units, which keeps the
+    number of SQL parameters per statement bounded.
+
     This stage creates a ProgressBar named 'Un-Associating Content' that counts the number of units
-    un-associated. Since it's a stream the total count isn't known until it's finished.
+    un-associated. The ProgressBar is updated after each chunk, but as it is used as a context
+    manager, the updates are written to the database at most every 500 milliseconds and once more
+    when the stage finishes. Since it's a stream the total count isn't known until it's finished.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage unassociates content from.
+        chunk_size (int): The maximum number of primary keys per query. Defaults to 10000.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, new_version, *args, **kwargs):
+    def __init__(self, new_version, *args, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
         super().__init__(*args, **kwargs)
         self.new_version = new_version
+        self.chunk_size = chunk_size
 
     async def run(self):
         """
@@ -79,12 +130,17 @@ class ContentUnassociation(Stage):
             The coroutine for this stage.
         """
         with ProgressBar(message='Un-Associating Content') as pb:
-            async for queryset_to_unassociate in self.items():
-                self.new_version.remove_content(queryset_to_unassociate)
-                pb.done = pb.done + queryset_to_unassociate.count()
-                pb.save()
+            async for to_unassociate in self.items():
+                pks = to_unassociate
+                if isinstance(to_unassociate, QuerySet):
+                    pks = UUIDSet(to_unassociate.values_list('pk', flat=True).iterator())
+
+                for chunk in _chunks(pks, self.chunk_size):
+                    self.new_version.remove_content(Content.objects.filter(pk__in=chunk))
+                    pb.done = pb.done + len(chunk)
+                    pb.save()
 
-                await self.put(queryset_to_unassociate)
+                await self.put(to_unassociate)
 
 
 class RemoveDuplicates(Stage):
@@ -92,6 +148,15 @@ class RemoveDuplicates(Stage):
     Stage allows plugins to remove content that would break repository uniqueness constraints.
 
     This stage is expected to be added by the DeclarativeVersion. See that class for example usage.
+
+    Each batch is handled with one query that is built from the units of that batch only, so the
+    query size is bounded by the batch size. On PostgreSQL the uniqueness field values of the batch
+    are sent as a `VALUES` list that is joined with the content table, which PostgreSQL plans much
+    better than a large tree of `OR` clauses. Other databases, and batches with `NULL` values in a
+    uniqueness field, use an `OR` query instead.
+
+    Units of one batch conflicting with each other are collapsed to the last of them. The earlier
+    units are removed from the repository version and are not passed on to the next stage.
     """
 
     def __init__(self, new_version, model, field_names):
@@ -115,18 +180,90 @@ class RemoveDuplicates(Stage):
         Returns:
             The coroutine for this stage.
         """
-        rm_q = Q()
         async for batch in self.batches():
+            # the last unit of the batch wins over earlier units with the same field values
+            latest = OrderedDict()
             for d_content in batch:
                 if isinstance(d_content.content, self.model):
-                    unit_q_dict = {field: getattr(d_content.content, field)
-                                   for field in self.field_names}
-                    # Don't remove *this* object if it is already in the repository version.
-                    not_this = ~Q(pk=d_content.content.pk)
-                    dupe = Q(**unit_q_dict)
-                    rm_q |= Q(dupe & not_this)
-            queryset_to_unassociate = self.model.objects.filter(rm_q)
-            self.new_version.remove_content(queryset_to_unassociate)
+                    latest[self._key(d_content.content)] = d_content
+            units = [d_content.content for d_content in latest.values()]
+            if units:
+                self.new_version.remove_content(self._duplicates(units))
 
             for d_content in batch:
+                content = d_content.content
+                if isinstance(content, self.model) and latest[self._key(content)] is not d_content:
+                    continue
                 await self.put(d_content)
+
+    def _key(self, unit):
+        """
+        Return the values of `unit` for `self.field_names`.
+
+        Args:
+            unit (:class:`pulpcore.plugin.models.Content`): An instance of `self.model`.
+
+        Returns:
+            tuple: The uniqueness field values of `unit`.
+        """
+        return tuple(getattr(unit, field) for field in self.field_names)
+
+    def _duplicates(self, units):
+        """
+        Build a QuerySet of content conflicting with `units` on `self.field_names`.
+
+        Each unit is excluded only from the content conflicting with itself, so a unit is not
+        removed if it is already in the repository version, but units of `units` conflicting with
+        each other would remove each other.
+
+        Args:
+            units (list): Saved instances of `self.model`.
+
+        Returns:
+            :class:`django.db.models.query.QuerySet`: The content conflicting with `units`.
+        """
+        values = [self._key(unit) for unit in units]
+        if connection.vendor == 'postgresql' and None not in chain.from_iterable(values):
+            return Content.objects.filter(pk__in=RawSQL(*self._values_join(units)))
+
+        rm_q = Q()
+        for unit, unit_values in zip(units, values):
+            rm_q |= Q(**dict(zip(self.field_names, unit_values))) & ~Q(pk=unit.pk)
+        return self.model.objects.filter(rm_q)
+
+    def _values_join(self, units):
+        """
+        Build SQL selecting the primary keys of content conflicting with `units` with a VALUES join.
+
+        Args:
+            units (list): Saved instances of `self.model`.
+
+        Returns:
+            tuple: The SQL string and its list of parameters.
+        """
+        quote_name = connection.ops.quote_name
+        pk_field = self.model._meta.pk
+        fields = [self.model._meta.get_field(name) for name in self.field_names]
+        aliases = ['f{num}'.format(num=num) for num in range(len(fields))]
+        row = '({placeholders})'.format(placeholders=', '.join(['%s'] * (len(fields) + 1)))
+
+        sql = (
+            'SELECT c.{pk} FROM {table} AS c '
+            'INNER JOIN (VALUES {rows}) AS batch (pk, {aliases}) ON {join} '
+            'WHERE c.{pk} <> batch.pk'
+        ).format(
+            pk=quote_name(pk_field.column),
+            table=quote_name(self.model._meta.db_table),
+            rows=', '.join([row] * len(units)),
+            aliases=', '.join(aliases),
+            join=' AND '.join(
+                'c.{column} = batch.{alias}'.format(column=quote_name(field.column), alias=alias)
+                for field, alias in zip(fields, aliases)
+            ),
+        )
+        params = []
+        for unit in units:
+            params.append(pk_field.get_db_prep_value(unit.pk, connection))
+            params.extend(field.get_db_prep_value(getattr(unit, field.attname), connection)
+                          for field in fields)
+        return sql, params
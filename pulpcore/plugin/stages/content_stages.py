@@ -3,9 +3,245 @@ from collections import defaultdict
 from django.db import IntegrityError, transaction
 from django.db.models import Q
 
-from pulpcore.plugin.models import ContentArtifact
+from pulpcore.plugin.models import Artifact, ContentArtifact, RemoteArtifact
 
 from .api import Stage
+from .keyset import BloomFilter
+
+
+class QueryUnchangedContents(Stage):
+    """
+    A Stages API stage that marks :class:`~pulpcore.plugin.stages.DeclarativeContent` units that are
+    unchanged since the last repository version.
+
+    This stage expects :class:`~pulpcore.plugin.stages.DeclarativeContent` units from `self._in_q`.
+    A unit is unchanged if `new_version` already contains a Content unit with the same natural key,
+    and each of its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects matches a saved
+    :class:`~pulpcore.plugin.models.ContentArtifact` with the same `relative_path`, a saved
+    :class:`~pulpcore.plugin.models.RemoteArtifact` for the same remote and url, and the declared
+    digests and size. When `download_artifacts` is `True` the
+    :class:`~pulpcore.plugin.models.Artifact` also has to be downloaded already.
+
+    The saved Content unit and Artifacts replace their unsaved counterparts of an unchanged unit and
+    it is marked as `unchanged`. Stages with `skip_unchanged` set, e.g.
+    :class:`~pulpcore.plugin.stages.QueryExistingArtifacts`,
+    :class:`~pulpcore.plugin.stages.ArtifactDownloader`,
+    :class:`~pulpcore.plugin.stages.ArtifactSaver`,
+    :class:`~pulpcore.plugin.stages.QueryExistingContents`,
+    :class:`~pulpcore.plugin.stages.ContentSaver` and
+    :class:`~pulpcore.plugin.stages.RemoteArtifactSaver`, pass unchanged units on without handling
+    them, so the `_pre_save` and `_post_save` hooks of a ContentSaver are not called for them.
+
+    The natural keys of the Content units in `new_version` are indexed the first time a unit of a
+    given type is received. The index only stores a hash of each natural key, candidates found in
+    it are verified with three queries per batch. If `new_version` has more than
+    `bloom_filter_threshold` units of the type, the index is a
+    :class:`~pulpcore.plugin.stages.BloomFilter` of the natural keys instead, which uses about one
+    hundredth of the memory. Units not found in it are certainly new and passed on right away, the
+    primary keys of the others are looked up with one more query per batch.
+
+    Each :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to `self._out_q` after it has
+    been handled.
+
+    This stage is added by the :class:`~pulpcore.plugin.stages.DeclarativeVersion` when
+    `incremental` is `True`.
+
+    Args:
+        new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version being
+            built. Its content has to be the content of the last repository version.
+        download_artifacts (bool): Whether the pipeline downloads Artifacts. Defaults to `True`.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    bloom_filter_threshold = 100000
+
+    def __init__(self, new_version, download_artifacts=True, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.new_version = new_version
+        self.download_artifacts = download_artifacts
+        self._indexes = {}
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        async for batch in self.batches():
+            candidates = {}
+            probable = defaultdict(list)
+            for d_content in batch:
+                model = type(d_content.content)
+                index = self._index(model)
+                natural_key = self._natural_key(d_content.content)
+                if isinstance(index, BloomFilter):
+                    if natural_key in index:
+                        probable[model].append(d_content)
+                    continue
+                pk = index.get(hash(natural_key))
+                if pk is not None:
+                    candidates[d_content] = pk
+            for model, d_contents in probable.items():
+                candidates.update(self._lookup(model, d_contents))
+            if candidates:
+                self._mark_unchanged(candidates)
+            for d_content in batch:
+                await self.put(d_content)
+
+    @staticmethod
+    def _natural_key(content):
+        """
+        Get the natural key of `content` using the attribute names of its fields.
+
+        Args:
+            content (:class:`~pulpcore.plugin.models.Content`): A Content unit, possibly unsaved.
+
+        Returns:
+            tuple: The natural key, with primary keys in place of related objects.
+        """
+        return tuple(
+            getattr(content, content._meta.get_field(name).attname)
+            for name in content.natural_key_fields()
+        )
+
+    def _index(self, model):
+        """
+        Get the index of the Content units of `model` in `new_version`, building it if needed.
+
+        Args:
+            model (:class:`~pulpcore.plugin.models.Content`): A subclass of Content.
+
+        Returns:
+            dict: The primary keys of the Content units keyed by the hash of their natural key,
+                or a :class:`~pulpcore.plugin.stages.BloomFilter` of their natural keys.
+        """
+        try:
+            return self._indexes[model]
+        except KeyError:
+            pass
+        index = {}
+        attnames = self._attnames(model)
+        if attnames:
+            contents = model.objects.filter(pk__in=self.new_version.content)
+            count = contents.count()
+            if count > self.bloom_filter_threshold:
+                index = BloomFilter(count)
+                index.update(contents.values_list(*attnames).iterator())
+            else:
+                for row in contents.values_list('pk', *attnames).iterator():
+                    index[hash(row[1:])] = row[0]
+        self._indexes[model] = index
+        return index
+
+    @staticmethod
+    def _attnames(model):
+        return [model._meta.get_field(name).attname for name in model.natural_key_fields()]
+
+    def _lookup(self, model, d_contents):
+        """
+        Look up the primary keys of the Content units in `new_version` with the natural keys of
+        `d_contents` in one query.
+
+        Args:
+            model (:class:`~pulpcore.plugin.models.Content`): The type of the Content units.
+            d_contents (list): :class:`~pulpcore.plugin.stages.DeclarativeContent` objects of
+                `model` that are probably in `new_version`.
+
+        Returns:
+            dict: The primary keys keyed by the DeclarativeContent of the units found.
+        """
+        attnames = self._attnames(model)
+        query = Q()
+        for d_content in d_contents:
+            query |= Q(**dict(zip(attnames, self._natural_key(d_content.content))))
+        rows = model.objects.filter(pk__in=self.new_version.content).filter(query).values_list(
+            'pk', *attnames)
+        pks = {row[1:]: row[0] for row in rows}
+        return {
+            d_content: pks[self._natural_key(d_content.content)]
+            for d_content in d_contents if self._natural_key(d_content.content) in pks
+        }
+
+    def _mark_unchanged(self, candidates):
+        """
+        Verify the `candidates` with the database and mark the unchanged ones.
+
+        Args:
+            candidates (dict): Primary keys of Content units in `new_version` keyed by the
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` that may be unchanged.
+        """
+        pks_by_type = defaultdict(list)
+        for d_content, pk in candidates.items():
+            pks_by_type[type(d_content.content)].append(pk)
+        contents = {}
+        for model_type, pks in pks_by_type.items():
+            for content in model_type.objects.filter(pk__in=pks):
+                contents[content.pk] = content
+
+        content_artifacts = defaultdict(dict)
+        for content_artifact in ContentArtifact.objects.filter(
+                content__in=list(contents)).select_related('artifact'):
+            content_artifacts[content_artifact.content_id][content_artifact.relative_path] = \
+                content_artifact
+
+        remote_artifacts = {}
+        for remote_artifact in RemoteArtifact.objects.filter(
+                content_artifact__content__in=list(contents)):
+            key = (remote_artifact.content_artifact_id, remote_artifact.remote_id)
+            remote_artifacts[key] = remote_artifact
+
+        for d_content, pk in candidates.items():
+            content = contents.get(pk)
+            if content is None or self._natural_key(content) != \
+                    self._natural_key(d_content.content):
+                continue
+            matched = self._match_artifacts(d_content, content_artifacts[pk], remote_artifacts)
+            if matched is None:
+                continue
+            d_content.content = content
+            for d_artifact, content_artifact in matched:
+                if content_artifact.artifact is not None:
+                    d_artifact.artifact = content_artifact.artifact
+            d_content.unchanged = True
+
+    def _match_artifacts(self, d_content, content_artifacts, remote_artifacts):
+        """
+        Match the :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects of `d_content` with
+        saved ContentArtifacts.
+
+        Args:
+            d_content (:class:`~pulpcore.plugin.stages.DeclarativeContent`): The unit to match.
+            content_artifacts (dict): The saved ContentArtifacts of the Content unit keyed by
+                `relative_path`.
+            remote_artifacts (dict): Saved RemoteArtifacts keyed by (ContentArtifact pk, Remote pk).
+
+        Returns:
+            list: Tuples of each DeclarativeArtifact and its matching ContentArtifact, or None if
+                any of them doesn't match.
+        """
+        if len(content_artifacts) != len(d_content.d_artifacts):
+            return None
+        matched = []
+        for d_artifact in d_content.d_artifacts:
+            content_artifact = content_artifacts.get(d_artifact.relative_path)
+            if content_artifact is None:
+                return None
+            if content_artifact.artifact is None and self.download_artifacts:
+                return None
+            remote_artifact = remote_artifacts.get((content_artifact.pk, d_artifact.remote.pk))
+            if remote_artifact is None or remote_artifact.url != d_artifact.url:
+                return None
+            for saved in (content_artifact.artifact, remote_artifact):
+                if saved is None:
+                    continue
+                for field in ('size',) + Artifact.DIGEST_FIELDS:
+                    declared_value = getattr(d_artifact.artifact, field)
+                    if declared_value and declared_value != getattr(saved, field):
+                        return None
+            matched.append((d_artifact, content_artifact))
+        return matched
 
 
 class QueryExistingContents(Stage):
@@ -29,6 +265,8 @@ class QueryExistingContents(Stage):
     call to the db for efficiency.
     """
 
+    skip_unchanged = True
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -80,6 +318,8 @@ class ContentSaver(Stage):
     call to the db for efficiency.
     """
 
+    skip_unchanged = True
+
     async def run(self):
         """
         The coroutine for this stage.
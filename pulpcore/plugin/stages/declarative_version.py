@@ -1,7 +1,13 @@
 import asyncio
+from contextlib import contextmanager
+import json
+import logging
+
+from gettext import gettext as _
 
 from pulpcore.plugin.models import RepositoryVersion
 from pulpcore.plugin.tasking import WorkingDirectory
+from pulpcore.tasking import connection
 
 from .api import create_pipeline, EndStage
 from .artifact_stages import (
@@ -11,13 +17,26 @@ from .artifact_stages import (
     RemoteArtifactSaver,
 )
 from .association_stages import ContentAssociation, ContentUnassociation, RemoveDuplicates
-from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures
+from .content_stages import (
+    ContentSaver,
+    QueryExistingContents,
+    QueryUnchangedContents,
+    ResolveContentFutures,
+)
+from .sharding import ShardedStages
+
+
+log = logging.getLogger(__name__)
+
+# seconds the upstream state of a repository is kept
+UPSTREAM_STATE_TTL = 30 * 24 * 60 * 60
 
 
 class DeclarativeVersion:
 
     def __init__(self, first_stage, repository, mirror=True, download_artifacts=True,
-                 remove_duplicates=None):
+                 remove_duplicates=None, incremental=False, upstream_token=None, resumable=False,
+                 max_bytes=None, shards=None, remote=None):
         """
         A pipeline that creates a new :class:`~pulpcore.plugin.models.RepositoryVersion` from a
         stream of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
@@ -38,6 +57,23 @@ class DeclarativeVersion:
            :class:`~pulpcore.plugin.models.RepositoryVersion`.
         8. Unassociate any content units not declared in the stream (only when sync_mode='mirror')
 
+        With `incremental=True`, content units declared by the first stage are compared with the
+        previous :class:`~pulpcore.plugin.models.RepositoryVersion` first. Units that are unchanged
+        skip steps 2 to 6, see :class:`~pulpcore.plugin.stages.QueryUnchangedContents`.
+
+        With `resumable=True`, the new :class:`~pulpcore.plugin.models.RepositoryVersion` is kept
+        in an incomplete state if the sync fails. The next sync of the repository with
+        `resumable=True` continues to build this version: the content units associated with it
+        before the failure skip steps 2 to 6 like unchanged content units in the incremental mode.
+        Artifacts that were saved before the failure are not downloaded again either. Downloads
+        that completed but weren't saved yet are lost with the working directory of the failed
+        task.
+
+        With `shards`, steps 2 to 6 run in that many child processes in parallel, see
+        :class:`~pulpcore.plugin.stages.ShardedStages`. The content units are partitioned by their
+        natural key, and the units saved by all processes are associated with the new
+        :class:`~pulpcore.plugin.models.RepositoryVersion` by the task process.
+
         To do this, the plugin writer should subclass the
         :class:`~pulpcore.plugin.stages.Stage` class and define its
         :meth:`run()` interface which returns a coroutine. This coroutine should
@@ -60,6 +96,9 @@ class DeclarativeVersion:
         >>>             dc = DeclarativeContent(content=unit, d_artifacts=[da])
         >>>             await self.put(dc)
 
+        For large metadata, subclass :class:`~pulpcore.plugin.stages.StreamingStage` instead to
+        parse the metadata incrementally with bounded memory.
+
         To use your first stage with the pipeline you have to instantiate the subclass and pass it
         to :class:`~pulpcore.plugin.stages.DeclarativeVersion`.
 
@@ -74,6 +113,13 @@ class DeclarativeVersion:
         >>> first_stage = MyFirstStage(remote)
         >>> DeclarativeVersion(first_stage, repository).create()
 
+        Example using upstream_token:
+
+        # This will not create a new version if the upstream metadata didn't change since the
+        # latest version was created with the same token.
+        >>> token = compute_my_metadata_checksum_somehow(remote)
+        >>> DeclarativeVersion(first_stage, repository, upstream_token=token).create()
+
         Example using remove_duplicates:
 
         # This will enforce that within a repository version, `FileContent.relative_path` is
@@ -103,6 +149,31 @@ class DeclarativeVersion:
                 pipeline. Each dict should have 2 keys, `model`, which is a subclass of
                 :class:`pulpcore.plugin.models.Content` and `field_names` which is a list of
                 strings corresponding to fields on the provided model.
+            incremental (bool): 'True' lets content units that are unchanged since the previous
+                :class:`~pulpcore.plugin.models.RepositoryVersion` skip the Artifact and Content
+                query and saving stages. 'False' is the default.
+            upstream_token (str): An optional string identifying the state of the upstream
+                repository, e.g. a checksum of its metadata. It is stored in Redis for
+                `repository`, together with the new
+                :class:`~pulpcore.plugin.models.RepositoryVersion` and the sync options, and
+                expires after 30 days. If the latest version of `repository` was created with the
+                same token, `remote`, `mirror`, `download_artifacts` and `remove_duplicates`
+                values, :meth:`create` returns without building a pipeline or a new version.
+            resumable (bool): 'True' keeps the incomplete
+                :class:`~pulpcore.plugin.models.RepositoryVersion` if the sync fails, and resumes
+                building an incomplete latest version left by a failed sync. It implies
+                `incremental`. An incomplete version is deleted by a sync that is not resumable,
+                and by a resumable sync if it is not the latest version anymore. 'False' is the
+                default.
+            max_bytes (int): An optional limit of the approximate number of bytes used by the
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects in the pipeline. See
+                :func:`~pulpcore.plugin.stages.create_pipeline`. The default is no limit.
+            shards (int): An optional number of child processes downloading and saving the
+                Artifacts and Content units in parallel. The declared content must be picklable.
+                The default is to do everything in the task process.
+            remote (:class:`~pulpcore.plugin.models.Remote`): The remote synced from. It is only
+                used to tell with `upstream_token` whether the upstream state is unchanged, a
+                changed remote always creates a new version.
 
         """
         self.first_stage = first_stage
@@ -110,13 +181,21 @@ class DeclarativeVersion:
         self.mirror = mirror
         self.download_artifacts = download_artifacts
         self.remove_duplicates = remove_duplicates or []
+        self.incremental = incremental
+        self.upstream_token = upstream_token
+        self.resumable = resumable
+        self.max_bytes = max_bytes
+        self.shards = shards
+        self.remote = remote
 
     def pipeline_stages(self, new_version):
         """
         Build the list of pipeline stages feeding into the ContentAssociation stage.
 
-        If the `self.download_artifacts` is False the pipeline will not include Artifact downloading
-        and saving stages.
+        If `self.incremental` or `self.resumable` is True the pipeline includes the
+        :class:`~pulpcore.plugin.stages.QueryUnchangedContents` stage right after the first stage.
+        The stages of :meth:`save_stages` follow, run by a
+        :class:`~pulpcore.plugin.stages.ShardedStages` stage if `self.shards` is set.
 
         Plugin-writers may override this method to build a custom pipeline. This
         can be achieved by returning a list with different stages or by extending
@@ -131,6 +210,32 @@ class DeclarativeVersion:
 
         """
         pipeline = [self.first_stage]
+        if self.incremental or self.resumable:
+            pipeline.append(QueryUnchangedContents(new_version, self.download_artifacts))
+        if self.shards:
+            pipeline.extend([ShardedStages(self.shards, self.save_stages), ResolveContentFutures()])
+        else:
+            pipeline.extend(self.save_stages())
+        for dupe_query_dict in self.remove_duplicates:
+            pipeline.extend([RemoveDuplicates(new_version, **dupe_query_dict)])
+
+        return pipeline
+
+    def save_stages(self):
+        """
+        Build the list of stages downloading and saving the Artifacts and Content units.
+
+        If the `self.download_artifacts` is False the list will not include Artifact downloading
+        and saving stages.
+
+        Plugin-writers may override this method to customize these stages, e.g. to save related
+        objects of their Content units. With `self.shards`, it is called in each child process.
+
+        Returns:
+            list: List of :class:`~pulpcore.plugin.stages.Stage` instances
+
+        """
+        pipeline = []
         if self.download_artifacts:
             pipeline.extend([
                 QueryExistingArtifacts(),
@@ -144,22 +249,155 @@ class DeclarativeVersion:
             RemoteArtifactSaver(),
             ResolveContentFutures(),
         ])
-        for dupe_query_dict in self.remove_duplicates:
-            pipeline.extend([RemoveDuplicates(new_version, **dupe_query_dict)])
-
         return pipeline
 
+    def _upstream_state(self, version):
+        """
+        Build the upstream state to store with `version`.
+
+        Args:
+            version (:class:`~pulpcore.plugin.models.RepositoryVersion`): A complete repository
+                version of `self.repository`.
+
+        Returns:
+            str: The JSON encoded upstream state.
+        """
+        remote = None
+        if self.remote is not None:
+            remote = {
+                'pk': str(self.remote.pk),
+                'url': self.remote.url,
+                # changes with any change of the configuration of the remote
+                'last_updated': str(self.remote._last_updated),
+            }
+        return json.dumps({
+            'token': self.upstream_token,
+            'version': str(version.pk),
+            'remote': remote,
+            'mirror': self.mirror,
+            'download_artifacts': self.download_artifacts,
+            'remove_duplicates': [
+                {'model': dupe['model']._meta.label, 'field_names': list(dupe['field_names'])}
+                for dupe in self.remove_duplicates
+            ],
+        }, sort_keys=True)
+
+    def _upstream_state_key(self):
+        """
+        Returns:
+            str: The redis key of the upstream state of `self.repository`.
+        """
+        return 'pulp:upstream_state:{pk}'.format(pk=self.repository.pk)
+
+    def _upstream_unchanged(self):
+        """
+        Check if the latest repository version was created from the same upstream state.
+
+        Returns:
+            bool: True if `self.upstream_token`, the remote and the sync options match the ones
+                stored with the latest version of `self.repository`.
+        """
+        latest = RepositoryVersion.latest(self.repository)
+        if latest is None:
+            return False
+        stored = connection.get_redis_connection().get(self._upstream_state_key())
+        return stored is not None and stored.decode() == self._upstream_state(latest)
+
+    def _incomplete_version(self):
+        """
+        Returns:
+            :class:`~pulpcore.plugin.models.RepositoryVersion`: The incomplete version of
+                `self.repository` left by a failed resumable sync, or None.
+        """
+        return RepositoryVersion.objects.filter(
+            repository=self.repository, complete=False
+        ).order_by('-number').first()
+
+    def _delete_incomplete_version(self, version):
+        """
+        Delete an incomplete version left by a failed resumable sync, with its content changes.
+
+        Args:
+            version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The incomplete version.
+        """
+        log.info(_('Deleting incomplete version %(number)d of repository %(name)s.'),
+                 {'number': version.number, 'name': self.repository.name})
+        last_version = self.repository.last_version
+        version.delete()
+        # delete() sets the last version of the repository as if `version` was the latest one
+        if version.number < last_version:
+            self.repository.last_version = last_version
+        else:
+            self.repository.last_version = version.number - 1
+        self.repository.save()
+
+    @contextmanager
+    def _new_version(self):
+        """
+        A context manager creating the new repository version.
+
+        An incomplete version left by a failed resumable sync is resumed if `self.resumable` is
+        True and it is still the latest version of `self.repository`. Otherwise it is deleted
+        before a new version is created.
+
+        If `self.resumable` is False, this is the
+        :class:`~pulpcore.plugin.models.RepositoryVersion` context manager, which deletes the new
+        version on failure. Otherwise the new version is kept if an exception is raised.
+
+        Yields:
+            :class:`~pulpcore.plugin.models.RepositoryVersion`: The new repository version.
+        """
+        new_version = self._incomplete_version()
+        if new_version is not None and \
+                (not self.resumable or new_version.number != self.repository.last_version):
+            self._delete_incomplete_version(new_version)
+            new_version = None
+
+        if not self.resumable:
+            with RepositoryVersion.create(self.repository) as new_version:
+                yield new_version
+            return
+
+        if new_version is None:
+            new_version = RepositoryVersion.create(self.repository)
+        else:
+            log.info(_('Resuming incomplete version %(number)d of repository %(name)s.'),
+                     {'number': new_version.number, 'name': self.repository.name})
+        try:
+            yield new_version
+        except BaseException:
+            # keep the incomplete version, the next resumable sync resumes it
+            raise
+        else:
+            # mark the version complete
+            new_version.__exit__(None, None, None)
+
     def create(self):
         """
         Perform the work. This is the long-blocking call where all syncing occurs.
+
+        If `self.upstream_token` is set and the upstream state is unchanged since the latest
+        repository version, no work is done.
         """
+        if self.upstream_token is not None:
+            if self._upstream_unchanged():
+                log.info(_('Upstream of repository %(name)s is unchanged, no new version created.'),
+                         {'name': self.repository.name})
+                return
+            connection.get_redis_connection().delete(self._upstream_state_key())
+
         with WorkingDirectory():
-            with RepositoryVersion.create(self.repository) as new_version:
+            with self._new_version() as new_version:
                 loop = asyncio.get_event_loop()
                 stages = self.pipeline_stages(new_version)
                 stages.append(ContentAssociation(new_version))
                 if self.mirror:
                     stages.append(ContentUnassociation(new_version))
                 stages.append(EndStage())
-                pipeline = create_pipeline(stages)
+                pipeline = create_pipeline(stages, max_bytes=self.max_bytes)
                 loop.run_until_complete(pipeline)
+
+        if self.upstream_token is not None:
+            connection.get_redis_connection().set(
+                self._upstream_state_key(), self._upstream_state(new_version),
+                ex=UPSTREAM_STATE_TTL)
@@ -0,0 +1,290 @@
+from array import array
+from bisect import bisect_left
+from gettext import gettext as _
+from heapq import merge
+import math
+import uuid
+
+
+_LOW_MASK = (1 << 64) - 1
+
+
+class UUIDSet:
+    """
+    A compact, mutable set of :class:`uuid.UUID` or non-negative integer keys.
+
+    Stages often keep sets of primary keys for the lifetime of a pipeline, e.g. all content units of
+    a repository version. A builtin `set` of :class:`uuid.UUID` objects built from a query costs
+    roughly 260 bytes per key. This set stores each key as two unsigned 64 bit integers in sorted
+    arrays and a one byte tombstone, so it costs roughly 21 bytes per key, as measured by
+    `pulpcore/tests/performance/bench_keyset.py`. Lookups use binary search.
+
+    The type of the keys is the type of the first key added: integer keys, e.g. the primary keys
+    of an `AutoField`, are stored as they are, other keys are converted to :class:`uuid.UUID`.
+    Iterating yields keys of that type.
+
+    New keys are collected in a buffer that is merged into the sorted arrays once it grows beyond
+    `buffer_size` keys or half of the sorted keys, whichever is larger. Removed keys are marked with
+    a tombstone and dropped during the next merge.
+
+    The set supports the subset of the builtin `set` interface used by the Stages API stages:
+
+        >>> keys = UUIDSet(repository_version.content.values_list('pk', flat=True).iterator())
+        >>> keys.remove(d_content.content.pk)  # raises KeyError if missing
+        >>> Content.objects.filter(pk__in=keys)
+
+    Args:
+        iterable (iterable): An optional iterable of keys to add to the set.
+        buffer_size (int): The minimum number of keys to buffer before merging them into the sorted
+            arrays. Defaults to 65536.
+    """
+
+    def __init__(self, iterable=None, buffer_size=65536):
+        self._high = array('Q')
+        self._low = array('Q')
+        self._removed = bytearray()
+        self._removed_count = 0
+        self._buffer = set()
+        self._buffer_size = buffer_size
+        self._int_keys = None
+        if iterable is not None:
+            self.update(iterable)
+
+    def _as_int(self, key):
+        """
+        Return the integer value of a key, choosing the type of the keys on the first call.
+
+        Args:
+            key (uuid.UUID, str or int): The key to convert.
+
+        Returns:
+            int: The integer value of `key`.
+
+        Raises:
+            ValueError: If `key` is not a valid key of the type of the keys.
+        """
+        if self._int_keys is None:
+            self._int_keys = isinstance(key, int)
+        if self._int_keys:
+            value = int(key)
+            if not 0 <= value < 1 << 128:
+                raise ValueError(_('An integer key must be between 0 and 2**128 - 1.'))
+            return value
+        if isinstance(key, uuid.UUID):
+            return key.int
+        return uuid.UUID(str(key)).int
+
+    def _key(self, value):
+        if self._int_keys:
+            return value
+        return uuid.UUID(int=value)
+
+    def _locate(self, value):
+        """
+        Find the index of `value` in the sorted arrays.
+
+        Args:
+            value (int): The integer value of a key.
+
+        Returns:
+            int: The index of `value` in the sorted arrays or -1 if it isn't stored there.
+        """
+        high = value >> 64
+        low = value & _LOW_MASK
+        index = bisect_left(self._high, high)
+        while index < len(self._high) and self._high[index] == high:
+            if self._low[index] == low:
+                return index
+            index += 1
+        return -1
+
+    def _merge(self):
+        """
+        Merge the buffered keys into the sorted arrays and drop all tombstones.
+        """
+        existing = (
+            (high << 64) | low
+            for high, low, removed in zip(self._high, self._low, self._removed) if not removed
+        )
+        highs = array('Q')
+        lows = array('Q')
+        for value in merge(existing, sorted(self._buffer)):
+            highs.append(value >> 64)
+            lows.append(value & _LOW_MASK)
+        self._high = highs
+        self._low = lows
+        self._removed = bytearray(len(highs))
+        self._removed_count = 0
+        self._buffer = set()
+
+    def add(self, key):
+        """
+        Add `key` to the set.
+
+        Args:
+            key (uuid.UUID or int): The key to add.
+        """
+        value = self._as_int(key)
+        if value in self._buffer:
+            return
+        index = self._locate(value)
+        if index >= 0:
+            if self._removed[index]:
+                self._removed[index] = 0
+                self._removed_count -= 1
+            return
+        self._buffer.add(value)
+        if len(self._buffer) >= max(self._buffer_size, len(self._high) // 2):
+            self._merge()
+
+    def update(self, iterable):
+        """
+        Add all keys of `iterable` to the set.
+
+        Args:
+            iterable (iterable): An iterable of keys.
+        """
+        for key in iterable:
+            self.add(key)
+
+    def discard(self, key):
+        """
+        Remove `key` from the set if it is present.
+
+        Args:
+            key (uuid.UUID or int): The key to remove.
+
+        Returns:
+            bool: True if `key` was removed, False if it wasn't present.
+        """
+        if not self:
+            return False
+        value = self._as_int(key)
+        if value in self._buffer:
+            self._buffer.remove(value)
+            return True
+        index = self._locate(value)
+        if index < 0 or self._removed[index]:
+            return False
+        self._removed[index] = 1
+        self._removed_count += 1
+        if self._removed_count > len(self._high) // 2:
+            self._merge()
+        return True
+
+    def remove(self, key):
+        """
+        Remove `key` from the set.
+
+        Args:
+            key (uuid.UUID or int): The key to remove.
+
+        Raises:
+            KeyError: When `key` is not present.
+        """
+        if not self.discard(key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if not self:
+            return False
+        value = self._as_int(key)
+        if value in self._buffer:
+            return True
+        index = self._locate(value)
+        return index >= 0 and not self._removed[index]
+
+    def __iter__(self):
+        for high, low, removed in zip(self._high, self._low, self._removed):
+            if not removed:
+                yield self._key((high << 64) | low)
+        for value in list(self._buffer):
+            yield self._key(value)
+
+    def __len__(self):
+        return len(self._high) - self._removed_count + len(self._buffer)
+
+    def __repr__(self):
+        return '<{name}: {length} keys>'.format(name=self.__class__.__name__, length=len(self))
+
+
+class BloomFilter:
+    """
+    A compact set of hashable keys that can have false positives but no false negatives.
+
+    Stages use it to skip database queries for keys that are certainly unknown, e.g. the natural
+    keys of the content units of a large repository version. It needs roughly 1.2 bytes per key
+    for a false positive rate of 1%, independently of the size of the keys.
+
+    The keys are hashed with the builtin `hash()`, so a filter is only valid in the process that
+    built it.
+
+        >>> known = BloomFilter(capacity=1000000)
+        >>> known.update(Content.objects.values_list('relative_path', 'digest').iterator())
+        >>> ('a.iso', digest) in known  # False means certainly not added, True probably added
+
+    Args:
+        capacity (int): The number of keys the filter is sized for. The false positive rate grows
+            beyond `error_rate` if more keys are added.
+        error_rate (float): The false positive rate at `capacity` keys. Defaults to 0.01.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        # small filters get 64 bits, so the positions of a key do not collide on a few bits
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 64)
+        self.hash_count = max(int(round(-math.log(error_rate) / math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, key):
+        """
+        Compute the bit positions of `key` by double hashing.
+
+        Args:
+            key: A hashable key.
+
+        Returns:
+            generator: The `hash_count` bit positions of `key`.
+        """
+        # the finalizer of MurmurHash3 spreads the hashes of similar keys, e.g. of small integers
+        value = hash(key) & _LOW_MASK
+        value = ((value ^ (value >> 33)) * 0xff51afd7ed558ccd) & _LOW_MASK
+        value = ((value ^ (value >> 33)) * 0xc4ceb9fe1a85ec53) & _LOW_MASK
+        value ^= value >> 33
+        first = value & 0xffffffff
+        second = (value >> 32) | 1
+        return ((first + num * second) % self.size for num in range(self.hash_count))
+
+    def add(self, key):
+        """
+        Add `key` to the filter.
+
+        Args:
+            key: A hashable key.
+        """
+        bits = self._bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def update(self, iterable):
+        """
+        Add all keys of `iterable` to the filter.
+
+        Args:
+            iterable (iterable): Hashable keys.
+        """
+        for key in iterable:
+            self.add(key)
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return '<{name}: {count} keys, {size} bits>'.format(
+            name=self.__class__.__name__, count=self._count, size=self.size)
@@ -1,10 +1,37 @@
 from gettext import gettext as _
 
 import asyncio
+import sys
 
 from pulpcore.plugin.models import Artifact
 
 
+def _approximate_size(obj, seen=None):
+    """
+    Compute the approximate size of `obj` including the containers and strings it contains.
+
+    Args:
+        obj: The object to compute the size of, e.g. an `extra_data` dictionary.
+        seen (set): The ids of the objects already counted.
+
+    Returns:
+        int: The approximate size in bytes.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _approximate_size(key, seen) + _approximate_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += _approximate_size(value, seen)
+    return size
+
+
 class DeclarativeArtifact:
     """
     Relates an :class:`~pulpcore.plugin.models.Artifact`, how to download it, and its
@@ -101,12 +128,18 @@ class DeclarativeContent:
             :class:`~pulpcore.plugin.models.Content` in the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage. See the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage for example usage.
+        unchanged (bool): Set to `True` by the
+            :class:`~pulpcore.plugin.stages.QueryUnchangedContents` stage if `content` and its
+            Artifacts are unchanged since the last repository version. Stages with
+            `skip_unchanged` set pass such units on without handling them. Defaults to `False`.
 
     Raises:
         ValueError: If `content` is not specified.
     """
 
-    __slots__ = ('content', 'd_artifacts', 'extra_data', 'does_batch', 'future')
+    __slots__ = (
+        'content', 'd_artifacts', 'extra_data', 'does_batch', 'future', 'unchanged', '__weakref__'
+    )
 
     def __init__(self, content=None, d_artifacts=None, extra_data=None, does_batch=True):
         if not content:
@@ -116,6 +149,7 @@ class DeclarativeContent:
         self.extra_data = extra_data or {}
         self.does_batch = does_batch
         self.future = None
+        self.unchanged = False
 
     def get_or_create_future(self):
         """
@@ -133,5 +167,25 @@ class DeclarativeContent:
             self.future = asyncio.get_event_loop().create_future()
         return self.future
 
+    def approximate_size(self):
+        """
+        Compute the approximate memory size of this object.
+
+        This includes the field values of `content`, the
+        :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects with their
+        :class:`~pulpcore.plugin.models.Artifact` field values and all `extra_data`. It is used by
+        the byte budget of :func:`~pulpcore.plugin.stages.create_pipeline`.
+
+        Returns:
+            int: The approximate size in bytes.
+        """
+        seen = set()
+        size = sys.getsizeof(self) + _approximate_size(vars(self.content), seen)
+        size += _approximate_size(self.extra_data, seen)
+        for d_artifact in self.d_artifacts:
+            size += sys.getsizeof(d_artifact) + _approximate_size(vars(d_artifact.artifact), seen)
+            size += _approximate_size(d_artifact.extra_data, seen)
+        return size
+
     def __str__(self):
         return str(self.content.__class__.__name__)
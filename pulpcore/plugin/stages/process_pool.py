@@ -0,0 +1,156 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from .api import Stage
+
+
+class ProcessPoolStage(Stage):
+    """
+    A Stages API stage mapping a function over its items in a pool of processes.
+
+    CPU-heavy work like parsing, decompressing or checksumming blocks the event loop of the whole
+    pipeline when it is done in :meth:`run`, and is limited to one core. This stage calls `func` in
+    a :class:`~concurrent.futures.ProcessPoolExecutor` instead, for each item received or, with
+    `batch`, for each batch of items. At most `max_in_flight` calls run or wait in the pool at a
+    time, so a fast previous stage cannot fill the memory.
+
+    The argument of `func` is built from the item by :meth:`prepare`, and the item passed on from
+    the item and the result by :meth:`finish`. By default the item itself is the argument and the
+    result is passed on. Both the argument and the result are pickled to pass them between the
+    processes. Subclasses can override the two methods, e.g. to pass only the fields of a
+    :class:`~pulpcore.plugin.stages.DeclarativeContent` to `func` and set the result on it:
+
+    >>> def parse(path):  # a module level function can be pickled
+    >>>     return [dict(entry) for entry in read_my_metadata_file_somehow(path)]
+    >>>
+    >>> class ParseMetadata(ProcessPoolStage):
+    >>>
+    >>>     def prepare(self, d_content):
+    >>>         return d_content.d_artifacts[0].artifact.file.path
+    >>>
+    >>>     def finish(self, d_content, entries):
+    >>>         d_content.extra_data['entries'] = entries
+    >>>         return d_content
+    >>>
+    >>> ParseMetadata(parse)
+
+    Args:
+        func (callable): A picklable function called with the argument built from an item, or a
+            list of arguments with `batch`.
+        max_workers (int): The number of processes of the pool. Defaults to the number of CPUs.
+        max_in_flight (int): The maximum number of calls of `func` running or waiting in the pool.
+            Defaults to twice the number of processes.
+        ordered (bool): 'True' passes the items on in the order they were received. 'False'
+            passes each item on as soon as its call finished. 'True' is the default.
+        batch (bool): 'True' calls `func` once per batch of items with the list of arguments, and
+            expects a list with a result for each argument. 'False' is the default.
+        minsize (int): The minimum batch size with `batch`, see
+            :meth:`~pulpcore.plugin.stages.Stage.batches`. Defaults to 50.
+        executor (concurrent.futures.Executor): An executor to use instead of a new pool of
+            `max_workers` processes, e.g. to share a pool between stages. It is not shut down by
+            this stage.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, func, *args, max_workers=None, max_in_flight=None, ordered=True,
+                 batch=False, minsize=50, executor=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.func = func
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.max_workers
+        self.ordered = ordered
+        self.batch = batch
+        self.minsize = minsize
+        self.executor = executor
+
+    def prepare(self, item):
+        """
+        Build the argument of `func` for `item`.
+
+        Args:
+            item: An item received by this stage.
+
+        Returns:
+            The picklable argument of `func`, `item` itself by default.
+        """
+        return item
+
+    def finish(self, item, result):
+        """
+        Build the item passed on to the next stage.
+
+        Args:
+            item: An item received by this stage.
+            result: The result of `func` for `item`.
+
+        Returns:
+            The item passed on to the next stage, `result` by default.
+        """
+        return result
+
+    def _work(self):
+        if self.batch:
+            return self.batches(self.minsize)
+        return self.items()
+
+    def _submit(self, executor, work):
+        loop = asyncio.get_event_loop()
+        if self.batch:
+            argument = [self.prepare(item) for item in work]
+        else:
+            argument = self.prepare(work)
+        return loop.run_in_executor(executor, self.func, argument)
+
+    async def _finish(self, work, future):
+        if self.batch:
+            for item, result in zip(work, future.result()):
+                await self.put(self.finish(item, result))
+        else:
+            await self.put(self.finish(work, future.result()))
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        executor = self.executor or ProcessPoolExecutor(self.max_workers)
+        work_iterator = self._work()
+        get_work = asyncio.ensure_future(work_iterator.__anext__())
+        in_flight = deque()
+        try:
+            while get_work or in_flight:
+                waiting = {future for work, future in in_flight}
+                if get_work and len(in_flight) < self.max_in_flight:
+                    waiting.add(get_work)
+                done, pending = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if get_work in done:
+                    try:
+                        work = get_work.result()
+                    except StopAsyncIteration:
+                        get_work = None
+                    else:
+                        in_flight.append((work, self._submit(executor, work)))
+                        get_work = asyncio.ensure_future(work_iterator.__anext__())
+                if self.ordered:
+                    while in_flight and in_flight[0][1].done():
+                        await self._finish(*in_flight.popleft())
+                else:
+                    for entry in [entry for entry in in_flight if entry[1].done()]:
+                        in_flight.remove(entry)
+                        await self._finish(*entry)
+        except BaseException:
+            if get_work:
+                get_work.cancel()
+            for work, future in in_flight:
+                future.cancel()
+            if self.executor is None:
+                executor.shutdown(wait=False)
+            raise
+        if self.executor is None:
+            # wait for the processes of the pool, so none of them is left behind at exit
+            await asyncio.get_event_loop().run_in_executor(None, executor.shutdown)
@@ -1,16 +1,37 @@
+import asyncio
 from asyncio import Queue
+from gettext import gettext as _
 import pathlib
 import time
 import uuid
 
 from rq.job import get_current_job
 
+from pulpcore.constants import TASK_STATES
+from pulpcore.plugin.models import ProgressBar
 from pulpcore.tasking import connection
 
 
 CONN = None
 
 
+def _current_task():
+    """
+    Return the task running in the current thread, or None.
+
+    `asyncio.Task.current_task` is deprecated since Python 3.7, `asyncio.current_task` is used
+    instead where it is available.
+    """
+    try:
+        current_task = asyncio.current_task
+    except AttributeError:  # Python 3.6
+        return asyncio.Task.current_task()
+    try:
+        return current_task()
+    except RuntimeError:  # no running event loop
+        return None
+
+
 class ProfilingQueue(Queue):
     """
     A customized subclass of asyncio.Queue that records time in the queue and between queues.
@@ -116,11 +137,101 @@ class ProfilingQueue(Queue):
         return in_q
 
 
+class QueryStats:
+    """
+    The database queries run by a stage.
+
+    Attributes:
+        count (int): The number of queries.
+        rows (int): The number of rows returned or affected by the queries, as far as the database
+            reports them.
+        seconds (float): The time spent executing the queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+
+class QueryRecorder:
+    """
+    A Django execute wrapper attributing the queries of a pipeline to its stages.
+
+    Each query is attributed to the stage whose asyncio task runs it, and added to the
+    :class:`QueryStats` in the `query_stats` attribute of that stage. Queries of other tasks, e.g.
+    tasks started by a stage itself, are not recorded.
+
+    Usage:
+        >>> recorder = QueryRecorder()
+        >>> recorder.add(stage, asyncio.ensure_future(stage()))
+        >>> with connection.execute_wrapper(recorder):
+        >>>     await pipeline
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._stage_of_task = {}
+
+    def add(self, stage, task):
+        """
+        Record the queries of `stage`, which runs in `task`.
+
+        Args:
+            stage (:class:`~pulpcore.plugin.stages.Stage`): The stage.
+            task (asyncio.Task): The task running the stage.
+        """
+        stage.query_stats = QueryStats()
+        self.stages.append(stage)
+        self._stage_of_task[task] = stage
+
+    def __call__(self, execute, sql, params, many, context):
+        stage = self._stage_of_task.get(_current_task())
+        if stage is None:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats = stage.query_stats
+            stats.count += 1
+            stats.seconds += time.perf_counter() - start
+            stats.rows += max(context['cursor'].rowcount, 0)
+
+    def save_progress_reports(self):
+        """
+        Save the query statistics of each stage as a completed progress report of the task.
+        """
+        for num, stage in enumerate(self.stages):
+            stats = stage.query_stats
+            ProgressBar(
+                message=_('Queries of stage {num} ({name})').format(
+                    num=num, name=stage.__class__.__name__),
+                state=TASK_STATES.COMPLETED,
+                done=stats.count,
+                suffix=_('{rows} rows in {seconds:.3f}s').format(
+                    rows=stats.rows, seconds=stats.seconds),
+            ).save()
+
+    def record_profile(self):
+        """
+        Write the query statistics of each stage to the `queries` table of the profile database.
+        """
+        if CONN is None:
+            create_profile_db_and_connection()
+        sql = "INSERT INTO queries (name, num, count, rows, seconds) VALUES (?, ?, ?, ?, ?)"
+        for num, stage in enumerate(self.stages):
+            stats = stage.query_stats
+            stage_name = '.'.join([stage.__class__.__module__, stage.__class__.__name__])
+            CONN.cursor().execute(sql, (stage_name, num, stats.count, stats.rows, stats.seconds))
+        CONN.commit()
+
+
 def create_profile_db_and_connection():
     """
     Create a profile db from this tasks UUID and a sqlite3 connection to that databases.
 
-    The database produced has three tables with the following SQL format:
+    The database produced has four tables with the following SQL format:
 
     The `stages` table stores info about the pipeline itself and stores 3 fields
     * uuid - the uuid of the stage
@@ -136,6 +247,13 @@ def create_profile_db_and_connection():
     * uuid - The uuid of stage this queue feeds into
     * length - The length of items in this queue, measured just before each arrival.
     * interarrival_time - The amount of time since the last arrival.
+
+    The `queries` table stores 5 fields:
+    * name - the name of the stage
+    * num - the number of the stage starting at 0
+    * count - the number of database queries run by the stage
+    * rows - the number of rows returned or affected by these queries
+    * seconds - the time spent executing these queries
     """
     debug_data_dir = "/var/lib/pulp/debug/"
     pathlib.Path(debug_data_dir).mkdir(parents=True, exist_ok=True)
@@ -163,4 +281,8 @@ def create_profile_db_and_connection():
     c.execute('''CREATE TABLE system
                  (uuid varchar(36), length int, interarrival_time real)''')
 
+    # Create table
+    c.execute('''CREATE TABLE queries
+                 (name text, num int, count int, rows int, seconds real)''')
+
     return CONN
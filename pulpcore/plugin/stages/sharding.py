@@ -0,0 +1,351 @@
+import asyncio
+from contextlib import ExitStack
+from gettext import gettext as _
+import multiprocessing
+import os
+import pickle
+import queue
+import traceback
+import zlib
+
+from django.db import connections
+
+from pulpcore.app.models import ProgressReport
+from pulpcore.plugin.models import ProgressBar
+
+from .api import create_pipeline, EndStage, Stage
+from .models import DeclarativeArtifact, DeclarativeContent
+
+
+def natural_key_shard(d_content, shards):
+    """
+    The default partitioning of :class:`ShardedStages`, by the natural key of the content.
+
+    Units with the same natural key always end up in the same shard, so no two shards save the same
+    unit.
+
+    Args:
+        d_content (:class:`~pulpcore.plugin.stages.DeclarativeContent`): The declared content.
+        shards (int): The number of shards.
+
+    Returns:
+        int: The shard of `d_content`, from 0 to `shards - 1`.
+    """
+    content = d_content.content
+    key = repr((content.__class__.__name__, content.natural_key()))
+    return zlib.crc32(key.encode()) % shards
+
+
+class _RemoteRef:
+    """
+    A picklable reference to a saved remote, resolved again in the shard process.
+    """
+
+    __slots__ = ('model', 'pk')
+
+    def __init__(self, remote):
+        self.model = remote.__class__
+        self.pk = remote.pk
+
+
+def download_share(download_concurrency, num, shards):
+    """
+    The part of the `download_concurrency` of a remote used by shard `num` of `shards`.
+
+    The shares add up to `download_concurrency`, unless there are more shards than that, in which
+    case every shard downloads one artifact at a time.
+
+    Args:
+        download_concurrency (int): The download concurrency of the remote.
+        num (int): The number of the shard, from 0 to `shards - 1`.
+        shards (int): The number of shards.
+
+    Returns:
+        int: The download concurrency of the remote in the shard.
+    """
+    share, remainder = divmod(download_concurrency, shards)
+    return max(share + (num < remainder), 1)
+
+
+def _detach(d_content):
+    """
+    Copy `d_content` into a picklable form, without its future and with references to the remotes.
+    """
+    d_artifacts = [
+        DeclarativeArtifact(artifact=d_artifact.artifact, url=d_artifact.url,
+                            relative_path=d_artifact.relative_path,
+                            remote=_RemoteRef(d_artifact.remote), extra_data=d_artifact.extra_data)
+        for d_artifact in d_content.d_artifacts
+    ]
+    return DeclarativeContent(content=d_content.content, d_artifacts=d_artifacts,
+                              extra_data=d_content.extra_data, does_batch=d_content.does_batch)
+
+
+class _ShardSource(Stage):
+    """
+    The first stage of a shard, receiving the declared content from the parent process.
+    """
+
+    def __init__(self, in_q, num, shards, parent_pid):
+        super().__init__()
+        self.shard_in_q = in_q
+        self.num = num
+        self.shards = shards
+        self.parent_pid = parent_pid
+        self.remotes = {}
+
+    def _attach(self, d_artifact):
+        ref = d_artifact.remote
+        try:
+            d_artifact.remote = self.remotes[ref.model, ref.pk]
+        except KeyError:
+            remote = ref.model.objects.get(pk=ref.pk)
+            # all shards together download as much in parallel as the remote allows
+            remote.download_concurrency = download_share(remote.download_concurrency, self.num,
+                                                         self.shards)
+            d_artifact.remote = self.remotes[ref.model, ref.pk] = remote
+
+    def _get(self):
+        while True:
+            try:
+                return self.shard_in_q.get(True, 1)
+            except queue.Empty:
+                if os.getppid() != self.parent_pid:
+                    raise RuntimeError(_('The parent process of the shard exited.'))
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await loop.run_in_executor(None, self._get)
+            if message is None:
+                break
+            index, d_content = pickle.loads(message)
+            for d_artifact in d_content.d_artifacts:
+                self._attach(d_artifact)
+            d_content.extra_data['shard_index'] = index
+            await self.put(d_content)
+
+
+class _ShardSink(EndStage):
+    """
+    The last stage of a shard, sending the saved content back to the parent process.
+    """
+
+    def __init__(self, out_q):
+        super().__init__()
+        self.shard_out_q = out_q
+
+    async def __call__(self):
+        async for d_content in self.items():
+            index = d_content.extra_data.pop('shard_index')
+            self.shard_out_q.put(('content', index, pickle.dumps(d_content.content)))
+
+
+def _forward_progress(num, out_q):
+    """
+    Send the progress reports of shard `num` to the parent process instead of saving them.
+
+    The reports are still rate limited by :meth:`ProgressReport.save` when they are used as
+    context managers.
+    """
+    def save_base(report, *args, **kwargs):
+        out_q.put(('progress', num,
+                   (id(report), report.message, report.done, report.total)))
+    ProgressReport.save_base = save_base
+
+
+def _run_shard(num, shards, parent_pid, in_q, out_q, make_stages):
+    """
+    Run the pipeline of shard `num` in a child process.
+    """
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    _forward_progress(num, out_q)
+    try:
+        stages = [_ShardSource(in_q, num, shards, parent_pid)] + make_stages() + \
+            [_ShardSink(out_q)]
+        asyncio.get_event_loop().run_until_complete(create_pipeline(stages))
+    except BaseException:
+        out_q.put(('error', num, traceback.format_exc()))
+        raise
+    finally:
+        connections.close_all()
+    out_q.put(('done', num, None))
+
+
+class ShardedStages(Stage):
+    """
+    A Stages API stage running a list of stages in several processes in parallel.
+
+    The pipeline of a single :class:`~pulpcore.plugin.stages.DeclarativeVersion` runs in one event
+    loop, so parsing, hashing and database queries of all stages share a single core. This stage
+    partitions the :class:`~pulpcore.plugin.stages.DeclarativeContent` it receives into `shards`
+    child processes with `partition`, by default by the natural key of the content. Each child runs
+    its own pipeline of the stages returned by `make_stages`, usually the artifact downloading and
+    the content saving stages, and sends the saved content back to this stage, which replaces the
+    content of the declared unit with it and passes the unit on. The stages after this one, like
+    the :class:`~pulpcore.plugin.stages.ContentAssociation` stage, run in the task process.
+
+    Units marked as `unchanged` are passed on without being sent to a shard. Futures of units are
+    not resolved in the shards, add a :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage
+    after this stage to resolve them. The :class:`~pulpcore.plugin.stages.DeclarativeArtifact`
+    objects of the units passed on are the ones declared, the artifacts saved by the shards are
+    not sent back.
+
+    The units are pickled to send them to the shards. The remotes of the artifacts are sent by
+    primary key and fetched again by the shards, everything else, including `extra_data`, must be
+    picklable. The child processes are forked, so `make_stages` can be any callable.
+
+    If a shard fails, the remaining shards are terminated and a `RuntimeError` with the traceback
+    of the failure is raised.
+
+    The shards share the limits of the task process: each one downloads from a remote with its
+    part of the `download_concurrency` of the remote, see :func:`download_share`, and their
+    progress reports are summed up into one progress report per message in the task process.
+
+    The shards are started when the pipeline is created, before any of its stages runs, so no
+    thread of the task process is forked in an inconsistent state. They are not daemons, so their
+    stages can start processes of their own, e.g. a
+    :class:`~pulpcore.plugin.stages.ProcessPoolStage`.
+
+    Args:
+        shards (int): The number of child processes.
+        make_stages (callable): Called in each child process without arguments to build the list
+            of :class:`~pulpcore.plugin.stages.Stage` instances of its pipeline.
+        partition (callable): Called with a
+            :class:`~pulpcore.plugin.stages.DeclarativeContent` and `shards`, returns the shard of
+            the unit from 0 to `shards - 1`. Defaults to :func:`natural_key_shard`.
+        maxsize (int): The maximum number of units waiting to be handled by a shard. Defaults to
+            1000.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, shards, make_stages, *args, partition=natural_key_shard, maxsize=1000,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shards = shards
+        self.make_stages = make_stages
+        self.partition = partition
+        self.maxsize = maxsize
+
+    def _connect(self, in_q, out_q):
+        """
+        Connect to queues within a pipeline and start the shards.
+
+        Args:
+            in_q (asyncio.Queue): The stage input queue.
+            out_q (asyncio.Queue): The stage output queue.
+        """
+        super()._connect(in_q, out_q)
+        self._start_shards()
+
+    def _start_shards(self):
+        context = multiprocessing.get_context('fork')
+        self._shard_in_qs = [context.Queue(self.maxsize) for num in range(self.shards)]
+        self._shard_out_q = context.Queue()
+        # the children must not share the database connections of this process
+        connections.close_all()
+        self._processes = []
+        for num, in_q in enumerate(self._shard_in_qs):
+            process = context.Process(
+                target=_run_shard,
+                args=(num, self.shards, os.getpid(), in_q, self._shard_out_q, self.make_stages),
+                name='shard-{num}'.format(num=num),
+            )
+            process.start()
+            self._processes.append(process)
+
+    async def _put(self, in_q, message):
+        loop = asyncio.get_event_loop()
+        while True:
+            # time out to notice the cancellation when a shard failed
+            try:
+                return await loop.run_in_executor(None, in_q.put, message, True, 1)
+            except queue.Full:
+                pass
+
+    async def _send(self, pending):
+        index = 0
+        async for d_content in self.items():
+            if d_content.unchanged:
+                await self.put(d_content)
+                continue
+            message = pickle.dumps((index, _detach(d_content)))
+            in_q = self._shard_in_qs[self.partition(d_content, self.shards)]
+            pending[index] = d_content
+            index += 1
+            await self._put(in_q, message)
+        for in_q in self._shard_in_qs:
+            await self._put(in_q, None)
+
+    def _progress(self, progress_bars, num, report):
+        """
+        Update the progress report of the task process summing up a progress report of a shard.
+        """
+        key, message, done, total = report
+        try:
+            progress_bar, reports = self._progress_bars[message]
+        except KeyError:
+            progress_bar = progress_bars.enter_context(ProgressBar(message=message))
+            reports = {}
+            self._progress_bars[message] = progress_bar, reports
+        reports[num, key] = (done, total)
+        progress_bar.done = sum(done for done, total in reports.values())
+        totals = [total for done, total in reports.values()]
+        progress_bar.total = None if None in totals else sum(totals)
+        progress_bar.save()
+
+    async def _receive(self, pending, progress_bars):
+        loop = asyncio.get_event_loop()
+        running = set(range(self.shards))
+        while running:
+            try:
+                kind, key, data = await loop.run_in_executor(None, self._shard_out_q.get, True, 1)
+            except queue.Empty:
+                for num in running:
+                    exitcode = self._processes[num].exitcode
+                    if exitcode:
+                        raise RuntimeError(_('Shard {num} exited with code {code}.').format(
+                            num=num, code=exitcode))
+                continue
+            if kind == 'content':
+                d_content = pending.pop(key)
+                d_content.content = pickle.loads(data)
+                await self.put(d_content)
+            elif kind == 'progress':
+                self._progress(progress_bars, key, data)
+            elif kind == 'done':
+                running.discard(key)
+            else:
+                raise RuntimeError(_('Shard {num} failed:\n{traceback}').format(
+                    num=key, traceback=data))
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        pending = {}
+        self._progress_bars = {}
+        with ExitStack() as progress_bars:
+            send = asyncio.ensure_future(self._send(pending))
+            receive = asyncio.ensure_future(self._receive(pending, progress_bars))
+            try:
+                await asyncio.gather(send, receive)
+            except BaseException:
+                send.cancel()
+                receive.cancel()
+                for process in self._processes:
+                    process.terminate()
+                raise
+            finally:
+                for process in self._processes:
+                    process.join()
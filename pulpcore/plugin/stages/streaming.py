@@ -0,0 +1,206 @@
+import asyncio
+from gettext import gettext as _
+import zlib
+from xml.etree import ElementTree
+
+import aiofiles
+
+from .api import Stage
+
+
+async def read_chunks(path, chunk_size=1048576):
+    """
+    Asynchronous iterator yielding the content of a file in chunks.
+
+    Args:
+        path (str): The path of the file to read, e.g. the `path` of a
+            :class:`~pulpcore.plugin.download.DownloadResult`.
+        chunk_size (int): The maximum size of each chunk in bytes. Defaults to 1 megabyte.
+
+    Yields:
+        bytes: The next chunk of the file.
+    """
+    async with aiofiles.open(path, 'rb') as f_handle:
+        while True:
+            chunk = await f_handle.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def decompress(chunks):
+    """
+    Asynchronous iterator decompressing gzip or zlib compressed chunks.
+
+    Args:
+        chunks: An asynchronous iterable of compressed chunks of bytes.
+
+    Yields:
+        bytes: The next decompressed chunk.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)  # detect the gzip or zlib header
+    async for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+async def read_lines(chunks, encoding='utf-8'):
+    """
+    Asynchronous iterator yielding the lines of chunked text.
+
+    Args:
+        chunks: An asynchronous iterable of chunks of bytes.
+        encoding (str): The encoding of the text. Defaults to 'utf-8'.
+
+    Yields:
+        str: The next line without its line terminator.
+    """
+    rest = b''
+    async for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r').decode(encoding)
+    if rest:
+        yield rest.rstrip(b'\r').decode(encoding)
+
+
+async def iterparse(chunks, tag):
+    """
+    Asynchronous iterator yielding the XML elements with the name `tag` of chunked XML.
+
+    Each element is complete, including its children, when it is yielded. It is cleared and removed
+    from its parent when the next element is requested, so the memory used doesn't grow with the
+    size of the document. Copy everything needed from an element before requesting the next one.
+
+    Example:
+
+        >>> tag = '{http://linux.duke.edu/metadata/common}package'
+        >>> async for element in iterparse(decompress(read_chunks(result.path)), tag):
+        >>>     name = element.findtext('{http://linux.duke.edu/metadata/common}name')
+
+    Args:
+        chunks: An asynchronous iterable of chunks of bytes.
+        tag (str): The name of the elements to yield, including the namespace in braces if the
+            elements have one.
+
+    Yields:
+        :class:`xml.etree.ElementTree.Element`: The next element named `tag`.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    ancestors = []
+
+    def elements():
+        for event, element in parser.read_events():
+            if event == 'start':
+                ancestors.append(element)
+                continue
+            ancestors.pop()
+            if element.tag == tag:
+                yield element
+                element.clear()
+                if ancestors and ancestors[-1][-1] is element:
+                    del ancestors[-1][-1]
+
+    async for chunk in chunks:
+        parser.feed(chunk)
+        for element in elements():
+            yield element
+    parser.close()
+    for element in elements():
+        yield element
+
+
+class StreamingStage(Stage):
+    """
+    A first stage that sends the :class:`~pulpcore.plugin.stages.DeclarativeContent` objects of an
+    asynchronous iterator down the pipeline.
+
+    Subclasses implement :meth:`stream` as an asynchronous generator, e.g. parsing metadata with
+    :func:`~pulpcore.plugin.stages.iterparse` or :func:`~pulpcore.plugin.stages.read_lines` while
+    reading it with :func:`~pulpcore.plugin.stages.read_chunks`. The generator runs ahead of the
+    pipeline by at most `lookahead` objects. It is suspended while that many objects are waiting
+    for the next stage, so the memory used by this stage depends on `lookahead` and the queue
+    sizes of the pipeline, not on the size of the metadata.
+
+    Example:
+
+        >>> class MyFirstStage(StreamingStage):
+        >>>
+        >>>     def __init__(self, remote, *args, **kwargs):
+        >>>         super().__init__(*args, **kwargs)
+        >>>         self.remote = remote
+        >>>
+        >>>     async def stream(self):
+        >>>         result = await self.remote.get_downloader(url=self.remote.url).run()
+        >>>         async for line in read_lines(read_chunks(result.path)):
+        >>>             entry = parse_my_metadata_line_somehow(line)
+        >>>             unit = MyContent(entry)  # make the content unit in memory-only
+        >>>             artifact = Artifact(entry)  # make Artifact in memory-only
+        >>>             da = DeclarativeArtifact(artifact, url, entry.relative_path, self.remote)
+        >>>             yield DeclarativeContent(content=unit, d_artifacts=[da])
+
+    Args:
+        lookahead (int): The maximum number of objects produced by :meth:`stream` that wait to be
+            sent to the next stage. Defaults to 100.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, lookahead=100, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookahead = lookahead
+
+    def stream(self):
+        """
+        The asynchronous generator of the objects to send down the pipeline.
+
+        A plugin writer must implement this method as an asynchronous generator, i.e. with
+        `async def` and `yield`.
+
+        Yields:
+            An instance of :class:`~pulpcore.plugin.stages.DeclarativeContent`
+        """
+        raise NotImplementedError(_('A plugin writer must implement this method'))
+
+    async def _produce(self, lookahead):
+        """
+        Put the objects of :meth:`stream` into the `lookahead` queue.
+
+        Args:
+            lookahead (asyncio.Queue): The bounded queue between :meth:`stream` and :meth:`run`.
+        """
+        async for d_content in self.stream():
+            await lookahead.put(d_content)
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        lookahead = asyncio.Queue(maxsize=self.lookahead)
+        producer = asyncio.ensure_future(self._produce(lookahead))
+        try:
+            while True:
+                try:
+                    d_content = lookahead.get_nowait()
+                except asyncio.QueueEmpty:
+                    if producer.done():
+                        producer.result()  # raises the exception of stream(), if any
+                        break
+                    getter = asyncio.ensure_future(lookahead.get())
+                    await asyncio.wait([getter, producer], return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        getter.cancel()
+                        continue
+                    d_content = getter.result()
+                await self.put(d_content)
+        finally:
+            if not producer.done():
+                producer.cancel()
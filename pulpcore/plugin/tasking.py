@@ -1,7 +1,19 @@
+import asyncio
+from collections import Counter, OrderedDict
+import functools
+from gettext import gettext as _
+import logging
+import time
+from urllib.parse import urlparse
+import uuid
+
+from django.db.models import Sum
 from rq.job import get_current_job
 
 from pulpcore.app import models
 from pulpcore.exceptions import exception_to_dict
+from pulpcore.plugin.download import DownloaderFactory, RedisSemaphore
+from pulpcore.tasking.connection import get_redis_connection
 
 # Support plugins dispatching tasks
 from pulpcore.tasking.tasks import enqueue_with_reservation  # noqa
@@ -10,6 +22,9 @@ from pulpcore.tasking.tasks import enqueue_with_reservation  # noqa
 from pulpcore.tasking.services.storage import WorkingDirectory  # noqa
 
 
+log = logging.getLogger(__name__)
+
+
 class Task:
     """
     The task which is currently executing.
@@ -42,3 +57,440 @@ class Task:
         serialized_error = exception_to_dict(error)
         task.non_fatal_errors.append(serialized_error)
         task.save()
+
+
+class NonFatalErrorCollector:
+    """
+    Collect non-fatal errors of the currently executing task in memory and save them in batches.
+
+    :meth:`Task.append_non_fatal_error` reads and writes the task for each error, and the list of
+    errors written grows with every error. This collector aggregates errors with the same type and
+    message into one entry with a `count`, keeps at most `max_errors` distinct entries and counts
+    the remaining errors in a final entry. The errors are saved with a single update of the task at
+    most every `flush_interval` seconds, and when the collector is used as a context manager, once
+    more when the context exits. Errors collected after the last save are not saved on their own
+    when the task ends, so use the collector as a context manager or call :meth:`flush` at the
+    end.
+
+    Errors already saved on the task before the first flush are kept. Errors saved by other means
+    while the collector is in use are overwritten, so use one collector per task.
+
+    Example:
+
+        >>> with NonFatalErrorCollector() as errors:
+        >>>     for url in urls:
+        >>>         try:
+        >>>             download(url)
+        >>>         except DownloadError as error:
+        >>>             errors.append(error)
+
+    Args:
+        max_errors (int): The maximum number of distinct errors saved. Defaults to 100.
+        flush_interval (float): The minimum number of seconds between two saves. Defaults to 10.
+
+    Raises:
+        pulpcore.app.models.Task.DoesNotExist: On flush, if not currently running inside a task.
+    """
+
+    def __init__(self, max_errors=100, flush_interval=10):
+        self.job = get_current_job()
+        self.max_errors = max_errors
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._errors = OrderedDict()
+        self._saved_errors = None
+        self._last_flush = time.monotonic()
+        self._dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def append(self, error):
+        """
+        Collect a non-fatal error, saving the collected errors if `flush_interval` has passed.
+
+        Args:
+            error (Exception): The non fatal error to be collected.
+        """
+        key = (error.__class__.__name__, str(error))
+        serialized_error = self._errors.get(key)
+        if serialized_error is not None:
+            serialized_error['count'] += 1
+        elif len(self._errors) < self.max_errors:
+            serialized_error = exception_to_dict(error)
+            serialized_error['count'] = 1
+            self._errors[key] = serialized_error
+        else:
+            self.dropped += 1
+        self._dirty = True
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Save the collected errors to the currently executing task if there are new ones.
+
+        Raises:
+            pulpcore.app.models.Task.DoesNotExist: If not currently running inside a task.
+        """
+        if not self._dirty:
+            return
+        if self.job is None:
+            raise models.Task.DoesNotExist(_('Non-fatal errors can only be saved in a task.'))
+        tasks = models.Task.objects.filter(job_id=self.job.id)
+        if self._saved_errors is None:
+            self._saved_errors = tasks.values_list('non_fatal_errors', flat=True).get()
+        errors = self._saved_errors + list(self._errors.values())
+        if self.dropped:
+            errors.append({
+                'code': None,
+                'description': _('{count} more non-fatal errors were not recorded.').format(
+                    count=self.dropped),
+                'traceback': None,
+                'count': self.dropped,
+            })
+        tasks.update(non_fatal_errors=errors)
+        self._last_flush = time.monotonic()
+        self._dirty = False
+
+
+# Delete or extend the claim of an artifact only if it is still held with the token.
+RELEASE_CLAIM_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+REFRESH_CLAIM_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class SyncGroup:
+    """
+    A batch of sync tasks sharing download limits per upstream host and artifact downloads.
+
+    Syncing many repositories from the same upstream with independent tasks exceeds the limits of
+    the upstream as soon as several workers run them, and downloads the artifacts the repositories
+    have in common once per repository. The tasks enqueued with :meth:`enqueue` are members of the
+    group while they run:
+
+    * The :meth:`~pulpcore.plugin.models.Remote.download_factory` of every remote used by a member
+      limits the downloads of all members from the host of the remote url together, to
+      `downloads_per_host` or, if it is not set, to the `download_concurrency` of the remote.
+
+    * The :class:`~pulpcore.plugin.stages.ArtifactDownloader` stage of a member downloads an
+      artifact with a sha256 digest only if no other member is downloading it, otherwise it waits
+      for the artifact to be saved by the other member. The member downloading an artifact saves it
+      right away. If that member fails to download it or stops refreshing its claim for
+      `claim_lease` seconds, e.g. because it was killed, the artifact is downloaded by one of the
+      waiting members. A member waiting for more than `max_wait` seconds downloads the artifact
+      itself.
+
+    :meth:`progress` aggregates the states and progress reports of all members. The group is stored
+    in Redis for `ttl` seconds, so it can be looked up with :meth:`get` from other processes.
+
+    Example:
+
+        >>> group = SyncGroup(downloads_per_host=20)
+        >>> for repository in repositories:
+        >>>     group.enqueue(tasks.synchronize, [repository, remote],
+        >>>                   kwargs={'remote_pk': remote.pk, 'repository_pk': repository.pk})
+        >>> group.progress()
+
+    Args:
+        downloads_per_host (int): The maximum number of downloads of all members from one host.
+            Defaults to the `download_concurrency` of the remote.
+        group_id (str): The id of the group. Defaults to a new random id.
+        ttl (int): The seconds the group is stored in Redis after the last member was enqueued.
+            Defaults to 7 days.
+        poll_interval (float): The seconds between two checks whether an artifact downloaded by
+            another member was saved. Defaults to 1.
+        claim_lease (float): The seconds after which the claim of an artifact download expires if
+            its member stops refreshing it. Defaults to 60.
+        max_wait (float): The seconds a member waits for an artifact downloaded by another member
+            before downloading it itself. Defaults to 600.
+    """
+
+    # the claims of artifact downloads held by this process, by sha256
+    _claims = {}
+    # the futures of the downloads of the claimed artifacts, by sha256
+    _downloads = {}
+    _refresher = None
+
+    def __init__(self, downloads_per_host=None, group_id=None, ttl=7 * 24 * 3600,
+                 poll_interval=1, claim_lease=60, max_wait=600):
+        self.downloads_per_host = downloads_per_host
+        self.group_id = group_id or str(uuid.uuid4())
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.claim_lease = claim_lease
+        self.max_wait = max_wait
+        self._semaphores = {}
+
+    @staticmethod
+    def _key(*parts):
+        return ':'.join(('pulp:sync-group',) + parts)
+
+    @classmethod
+    def get(cls, group_id):
+        """
+        Returns:
+            :class:`SyncGroup`: The group with `group_id`, or None if it does not exist (anymore).
+        """
+        options = get_redis_connection().hgetall(cls._key(group_id))
+        if not options:
+            return None
+        downloads_per_host = int(options[b'downloads_per_host']) or None
+        return cls(downloads_per_host=downloads_per_host, group_id=group_id,
+                   ttl=int(options[b'ttl']), poll_interval=float(options[b'poll_interval']),
+                   claim_lease=float(options[b'claim_lease']),
+                   max_wait=float(options[b'max_wait']))
+
+    @classmethod
+    def current(cls):
+        """
+        Returns:
+            :class:`SyncGroup`: The group of the currently executing task, or None if not running
+                in a task or the task is not a member of a group.
+        """
+        job = get_current_job()
+        # the group is only looked up in Redis for jobs enqueued through a group
+        group_id = job.meta.get('sync_group') if job is not None else None
+        if group_id is None:
+            return None
+        return cls.get(group_id)
+
+    def enqueue(self, func, resources, args=None, kwargs=None, options=None):
+        """
+        Enqueue a member of the group with :func:`enqueue_with_reservation`.
+
+        Args:
+            func (callable): The function to be run by RQ when the necessary locks are acquired.
+            resources (list): The resources to reserve.
+            args (tuple): The positional arguments to pass on to the task.
+            kwargs (dict): The keyword arguments to pass on to the task.
+            options (dict): The options to be passed on to the task.
+
+        Returns:
+            rq.job.Job: The job of the member.
+        """
+        connection = get_redis_connection()
+        group_key = self._key(self.group_id)
+        connection.hmset(group_key, {
+            'downloads_per_host': self.downloads_per_host or 0,
+            'ttl': self.ttl,
+            'poll_interval': self.poll_interval,
+            'claim_lease': self.claim_lease,
+            'max_wait': self.max_wait,
+        })
+        connection.expire(group_key, self.ttl)
+        options = dict(options or {})
+        options['meta'] = dict(options.get('meta') or {}, sync_group=self.group_id)
+        job = enqueue_with_reservation(func, resources, args=args, kwargs=kwargs, options=options)
+        connection.rpush(self._key(self.group_id, 'members'), str(job.id))
+        connection.expire(self._key(self.group_id, 'members'), self.ttl)
+        return job
+
+    def member_job_ids(self):
+        """
+        Returns:
+            list: The job ids of the members of the group.
+        """
+        connection = get_redis_connection()
+        return [job_id.decode() for job_id in
+                connection.lrange(self._key(self.group_id, 'members'), 0, -1)]
+
+    def progress(self):
+        """
+        Aggregate the progress of the members.
+
+        Returns:
+            dict: The number of members in each task state in `tasks`, and the sums of `done` and
+                `total` of the progress reports of all members by message in `progress_reports`.
+        """
+        job_ids = self.member_job_ids()
+        tasks = models.Task.objects.filter(job_id__in=job_ids)
+        reports = models.ProgressReport.objects.filter(task__job_id__in=job_ids)
+        return {
+            'tasks': dict(Counter(tasks.values_list('state', flat=True))),
+            'progress_reports': {
+                report['message']: {'done': report['done'], 'total': report['total']}
+                for report in reports.values('message').annotate(done=Sum('done'),
+                                                                 total=Sum('total'))
+            },
+        }
+
+    def semaphore(self, remote):
+        """
+        Returns:
+            :class:`~pulpcore.plugin.download.RedisSemaphore`: The semaphore limiting the downloads
+                of all members from the host of the url of `remote`.
+        """
+        host = urlparse(remote.url).netloc
+        try:
+            return self._semaphores[host]
+        except KeyError:
+            semaphore = RedisSemaphore(self._key(self.group_id, 'host', host),
+                                       self.downloads_per_host or remote.download_concurrency)
+            self._semaphores[host] = semaphore
+            return semaphore
+
+    def downloader_factory(self, remote, **kwargs):
+        """
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloaderFactory`: A factory for `remote` whose
+                downloaders share the download limit of the group.
+        """
+        return DownloaderFactory(remote, semaphore=self.semaphore(remote), **kwargs)
+
+    def claim_artifact(self, sha256):
+        """
+        Claim the download of the artifact with `sha256` for the currently executing task.
+
+        The claim is a lease of `claim_lease` seconds, refreshed while this process holds it, i.e.
+        until the artifact is downloaded and saved or the download failed. Other members take the
+        download over once the lease expired, e.g. if this process was killed.
+
+        Returns:
+            bool: True if the current task should download the artifact, False if another member
+                claimed it.
+        """
+        key = self._key(self.group_id, 'artifact', sha256)
+        token = uuid.uuid4().hex
+        lease = int(self.claim_lease * 1000)
+        if not get_redis_connection().set(key, token, nx=True, px=lease):
+            return False
+        SyncGroup._claims[sha256] = (key, token, lease)
+        return True
+
+    def release_artifact(self, sha256):
+        """
+        Release the claim of the artifact with `sha256`, e.g. if the download failed.
+        """
+        SyncGroup.release_claims([sha256])
+
+    @classmethod
+    def release_claims(cls, sha256s=None):
+        """
+        Release the claims of artifacts held by this process.
+
+        This is called by :meth:`download` once an artifact is saved, and without `sha256s` by the
+        :class:`~pulpcore.plugin.stages.ArtifactSaver` stage when it finishes. It does nothing for
+        the artifacts not claimed by this process, so it costs nothing outside a group.
+
+        Args:
+            sha256s (iterable): The sha256 digests of the artifacts. Defaults to all claims.
+        """
+        if sha256s is None:
+            claims = list(cls._claims.values())
+            cls._claims.clear()
+        else:
+            claims = [cls._claims.pop(sha256) for sha256 in sha256s if sha256 in cls._claims]
+        if not claims:
+            return
+        connection = get_redis_connection()
+        release = connection.register_script(RELEASE_CLAIM_SCRIPT)
+        for key, token, lease in claims:
+            release(keys=[key], args=[token])
+
+    @classmethod
+    async def _refresh_claims(cls, interval):
+        """
+        Refresh the leases of the claims held by this process until none is left.
+        """
+        loop = asyncio.get_event_loop()
+        refresh = get_redis_connection().register_script(REFRESH_CLAIM_SCRIPT)
+        while cls._claims:
+            await asyncio.sleep(interval)
+            for sha256, (key, token, lease) in list(cls._claims.items()):
+                refreshed = await loop.run_in_executor(
+                    None, functools.partial(refresh, keys=[key], args=[token, lease]))
+                if not refreshed:
+                    # the lease expired and was taken over, the artifact is saved twice at worst
+                    cls._claims.pop(sha256, None)
+
+    @staticmethod
+    def _saved_artifact(sha256):
+        return models.Artifact.objects.filter(sha256=sha256).first()
+
+    @staticmethod
+    def _save_artifact(artifact):
+        artifact.file = str(artifact.file)
+        return models.Artifact.objects.bulk_get_or_create([artifact])[0]
+
+    async def download(self, d_artifact):
+        """
+        Download the artifact of `d_artifact` unless another member is downloading it.
+
+        If another member claimed the artifact, this waits until it is saved and sets it on
+        `d_artifact`, or until the claim is released or its lease expired and downloads it then.
+        After `max_wait` seconds of waiting, the artifact is downloaded without a claim. Downloads
+        of an artifact claimed by this process wait for the download of the claim instead.
+
+        A claimed artifact is saved as soon as it is downloaded and the claim is released then, so
+        a claim never waits for other artifacts or stages. It is released as well if the download
+        fails or is cancelled.
+
+        Args:
+            d_artifact (:class:`~pulpcore.plugin.stages.DeclarativeArtifact`): The artifact to
+                download.
+        """
+        sha256 = d_artifact.artifact.sha256
+        if not sha256:
+            await d_artifact.download()
+            return
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.max_wait
+        while True:
+            running = SyncGroup._downloads.get(sha256)
+            if running is not None:
+                # claimed by this process, the artifact is None if that download failed
+                artifact = await asyncio.shield(running)
+                if artifact is not None:
+                    d_artifact.artifact = artifact
+                    return
+                continue
+            if await loop.run_in_executor(None, self.claim_artifact, sha256):
+                await self._download_claimed(d_artifact)
+                return
+            if loop.time() >= deadline:
+                log.warning(_('Waited {seconds}s for the download of artifact {sha256} by another '
+                              'sync, downloading it.').format(seconds=self.max_wait, sha256=sha256))
+                await d_artifact.download()
+                return
+            await asyncio.sleep(self.poll_interval)
+            artifact = await loop.run_in_executor(None, self._saved_artifact, sha256)
+            if artifact is not None:
+                d_artifact.artifact = artifact
+                return
+
+    async def _download_claimed(self, d_artifact):
+        """
+        Download and save the artifact of `d_artifact` claimed by this process.
+        """
+        sha256 = d_artifact.artifact.sha256
+        loop = asyncio.get_event_loop()
+        running = SyncGroup._downloads[sha256] = loop.create_future()
+        if SyncGroup._refresher is None or SyncGroup._refresher.done():
+            SyncGroup._refresher = asyncio.ensure_future(
+                SyncGroup._refresh_claims(self.claim_lease / 3))
+        artifact = None
+        try:
+            # the previous claim may have been released just after saving the artifact
+            artifact = await loop.run_in_executor(None, self._saved_artifact, sha256)
+            if artifact is None:
+                await d_artifact.download()
+                artifact = await loop.run_in_executor(None, self._save_artifact,
+                                                      d_artifact.artifact)
+            d_artifact.artifact = artifact
+        finally:
+            del SyncGroup._downloads[sha256]
+            running.set_result(artifact)
+            await loop.run_in_executor(None, self.release_artifact, sha256)
@@ -0,0 +1,269 @@
+"""
+Measure download throughput of the :class:`~pulpcore.plugin.download.DownloaderFactory`.
+
+A local aiohttp server is started in a child process. It serves synthetic files of the requested
+size, optionally with latency, a bandwidth cap per response, 429 and 503 error responses, and
+without keep-alive. The files are downloaded with the downloaders built by a
+:class:`~pulpcore.plugin.download.DownloaderFactory` for each of the `--concurrency` values, and the
+throughput, the connections opened, the requests made and the CPU time of this process per GB are
+reported for each. Run this from the root of the repository in an environment where pulpcore is
+installed::
+
+    $ python pulpcore/tests/performance/bench_download.py --files 1000 --concurrency 5 10 20
+"""
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import weakref
+
+import aiohttp
+from aiohttp import web
+
+
+CHUNK_SIZE = 65536
+
+
+class StandInServer:
+    """
+    The request handlers of the stand-in server.
+
+    Files are requested with `/files/<size>/<name>`. `/stats` returns the counters as JSON and
+    `/reset` resets them.
+
+    Args:
+        options (argparse.Namespace): The server options of the command line.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.transports = weakref.WeakSet()
+        self.block = bytes(range(256)) * (CHUNK_SIZE // 256)
+        self.reset()
+
+    def reset(self):
+        self.stats = {'connections': 0, 'requests': 0, '429': 0, '503': 0, 'bytes': 0}
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/files/{size:\\d+}/{name}', self.serve_file)
+        app.router.add_get('/stats', self.serve_stats)
+        app.router.add_post('/reset', self.serve_reset)
+        return app
+
+    def count_request(self, request):
+        self.stats['requests'] += 1
+        if request.transport not in self.transports:
+            self.transports.add(request.transport)
+            self.stats['connections'] += 1
+
+    async def serve_file(self, request):
+        self.count_request(request)
+        options = self.options
+        latency = options.latency + self.random.uniform(-options.jitter, options.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+        roll = self.random.random()
+        status = None
+        if roll < options.rate_429:
+            status = 429
+        elif roll < options.rate_429 + options.rate_503:
+            status = 503
+        if status:
+            self.stats[str(status)] += 1
+            response = web.Response(status=status)
+            if not options.keepalive:
+                response.force_close()
+            return response
+
+        size = int(request.match_info['size'])
+        response = web.StreamResponse()
+        response.content_length = size
+        if not options.keepalive:
+            response.force_close()
+        await response.prepare(request)
+        remaining = size
+        while remaining:
+            chunk = self.block[:min(remaining, CHUNK_SIZE)]
+            await response.write(chunk)
+            remaining -= len(chunk)
+            self.stats['bytes'] += len(chunk)
+            if options.bandwidth:
+                await asyncio.sleep(len(chunk) / options.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def serve_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def serve_reset(self, request):
+        self.reset()
+        return web.json_response(self.stats)
+
+
+def serve(port, options):
+    """
+    Run the stand-in server on `port` of localhost until the process is terminated.
+    """
+    app = StandInServer(options).make_app()
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def free_port():
+    """
+    Returns:
+        int: A TCP port of localhost that is not in use.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def file_sizes(options):
+    """
+    Draw the sizes of the files to download from the size distribution.
+
+    Returns:
+        list: The size of each file in bytes.
+    """
+    rand = random.Random(options.seed)
+    mean = options.size
+    if options.size_distribution == 'fixed':
+        return [mean] * options.files
+    if options.size_distribution == 'uniform':
+        return [rand.randint(0, 2 * mean) for i in range(options.files)]
+    # a log-normal distribution with sigma 1 and the requested mean
+    return [int(rand.lognormvariate(math.log(mean) - 0.5, 1)) for i in range(options.files)]
+
+
+async def server_request(session, method, url):
+    async with session.request(method, url) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def wait_for_server(session, base_url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await server_request(session, 'GET', base_url + '/stats')
+        except aiohttp.ClientConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def download_all(base_url, sizes, concurrency):
+    """
+    Download files of `sizes` with the downloaders of a factory allowing `concurrency` downloads.
+
+    Returns:
+        tuple: The number of bytes downloaded and the number of failed downloads.
+    """
+    from pulpcore.plugin.download import DownloaderFactory
+    from pulpcore.plugin.models import Remote
+
+    factory = DownloaderFactory(Remote(name='bench', url=base_url,
+                                       download_concurrency=concurrency))
+
+    async def download(num, size):
+        url = '{base}/files/{size}/{num}'.format(base=base_url, size=size, num=num)
+        result = await factory.build(url, expected_size=size).run()
+        os.unlink(result.path)
+        return size
+
+    try:
+        results = await asyncio.gather(
+            *[download(num, size) for num, size in enumerate(sizes)], return_exceptions=True
+        )
+    finally:
+        await factory._session.close()
+    failed = [result for result in results if isinstance(result, Exception)]
+    return sum(result for result in results if not isinstance(result, Exception)), len(failed)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def benchmark(base_url, options):
+    """
+    Download the files once for each concurrency and print the results.
+    """
+    sizes = file_sizes(options)
+    print('{files} files, {size:.1f} MB'.format(files=len(sizes), size=sum(sizes) / 10 ** 6))
+    print('{:>11} {:>10} {:>12} {:>9} {:>7} {:>12} {:>7}'.format(
+        'concurrency', 'seconds', 'MB/s', 'requests', 'conns', 'CPU s / GB', 'failed'))
+    async with aiohttp.ClientSession() as session:
+        await wait_for_server(session, base_url)
+        for concurrency in options.concurrency:
+            await server_request(session, 'POST', base_url + '/reset')
+            cpu = cpu_seconds()
+            start = time.perf_counter()
+            downloaded, failed = await download_all(base_url, sizes, concurrency)
+            seconds = time.perf_counter() - start
+            cpu = cpu_seconds() - cpu
+            stats = await server_request(session, 'GET', base_url + '/stats')
+            print('{:>11} {:>10.2f} {:>12.1f} {:>9} {:>7} {:>12.2f} {:>7}'.format(
+                concurrency,
+                seconds,
+                downloaded / seconds / 10 ** 6,
+                stats['requests'],
+                stats['connections'],
+                cpu / downloaded * 10 ** 9 if downloaded else float('nan'),
+                failed,
+            ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000, help='number of files to download')
+    parser.add_argument('--size', type=int, default=1048576, help='mean file size in bytes')
+    parser.add_argument('--size-distribution', choices=('fixed', 'uniform', 'lognormal'),
+                        default='fixed', help='distribution of the file sizes')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10],
+                        help='download_concurrency values of the remote to compare')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='server latency per request in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random deviation of the latency in seconds')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bandwidth cap of each response in bytes per second, 0 for none')
+    parser.add_argument('--rate-429', type=float, default=0.0,
+                        help='ratio of requests answered with 429 Too Many Requests')
+    parser.add_argument('--rate-503', type=float, default=0.0,
+                        help='ratio of requests answered with 503 Service Unavailable')
+    parser.add_argument('--no-keepalive', dest='keepalive', action='store_false',
+                        help='close the connection after each response')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random numbers')
+    options = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pulpcore.app.settings')
+    import django
+    django.setup()
+
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port, options), daemon=True)
+    server.start()
+    try:
+        with tempfile.TemporaryDirectory() as working_dir:
+            os.chdir(working_dir)
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(benchmark('http://127.0.0.1:{port}'.format(port=port), options))
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
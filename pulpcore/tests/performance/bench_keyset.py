@@ -0,0 +1,75 @@
+"""
+Compare memory usage and lookup speed of :class:`~pulpcore.plugin.stages.UUIDSet` with `set`.
+
+Run this from the root of the repository in an environment where pulpcore is installed::
+
+    $ python pulpcore/tests/performance/bench_keyset.py --keys 1000000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+
+def measure(factory, keys, lookups):
+    """
+    Build a key set with `factory` and time lookups of `lookups` in it.
+
+    The key set is built from fresh copies of `keys`, like the keys of a database query, so the
+    memory of the :class:`uuid.UUID` objects kept alive by a `set` is accounted for.
+
+    Args:
+        factory (callable): Builds the key set from an iterable of keys.
+        keys (list): The keys to store.
+        lookups (list): The keys to look up, a mix of stored and missing keys.
+
+    Returns:
+        dict: The build time, lookup time and allocated memory of the key set.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    key_set = factory(uuid.UUID(bytes=key.bytes) for key in keys)
+    build_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for key in lookups:
+        key in key_set
+    lookup_time = time.perf_counter() - start
+    return {
+        'build_seconds': build_time,
+        'lookup_usec': lookup_time / len(lookups) * 10 ** 6,
+        'bytes_per_key': memory / len(keys),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--keys', type=int, default=1000000, help='number of keys to store')
+    parser.add_argument('--lookups', type=int, default=200000, help='number of lookups to time')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pulpcore.app.settings')
+    import django
+    django.setup()
+    from pulpcore.plugin.stages import UUIDSet
+
+    keys = [uuid.uuid4() for i in range(args.keys)]
+    missing = [uuid.uuid4() for i in range(args.lookups // 2)]
+    lookups = keys[:args.lookups - len(missing)] + missing
+
+    print('{keys} keys, {lookups} lookups'.format(keys=args.keys, lookups=len(lookups)))
+    print('{:<8} {:>14} {:>12} {:>14}'.format('type', 'bytes per key', 'build (s)', 'lookup (us)'))
+    for name, factory in (('set', set), ('UUIDSet', UUIDSet)):
+        result = measure(factory, keys, lookups)
+        print('{:<8} {:>14.1f} {:>12.2f} {:>14.2f}'.format(
+            name, result['bytes_per_key'], result['build_seconds'], result['lookup_usec']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
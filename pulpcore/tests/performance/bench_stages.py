@@ -0,0 +1,303 @@
+"""
+Benchmark a :class:`~pulpcore.plugin.stages.DeclarativeVersion` pipeline with synthetic content.
+
+The benchmark syncs `FileContent` of the pulp_file plugin, so it needs an environment where pulpcore
+and pulp_file are installed and the database is migrated. It creates content, artifacts and
+repositories that are not cleaned up, use a disposable database. Run this from the root of the
+repository::
+
+    $ python pulpcore/tests/performance/bench_stages.py --units 10000 --existing-ratio 0.5
+
+Each unit is new to Pulp unless it is pre-existing, and a new repository is used for every run. A
+first, untimed sync adds the pre-existing units and, for the duplicate units, units with the same
+`relative_path` but a different digest to the repository. The timed sync declares all units, so the
+pre-existing units are found by the query stages and the units they duplicate are removed by the
+:class:`~pulpcore.plugin.stages.RemoveDuplicates` stage.
+
+Results are printed and can be saved as a baseline with `--save-baseline`. A later run with
+`--compare` reports the change against the baseline of the same scenario, and exits with 1 if the
+throughput dropped or the queries or the peak RSS grew by more than `--tolerance`. The peak RSS is
+the peak of the whole process, run one benchmark per process to compare it.
+"""
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
+import uuid
+
+
+def make_first_stage(remote, units, artifacts_per_unit, data_dir):
+    """
+    Build a first stage declaring synthetic `FileContent` units.
+
+    Args:
+        remote (:class:`~pulp_file.app.models.FileRemote`): The remote of the artifacts.
+        units (list): Pairs of the relative path and the seed of each unit. The digest of the unit
+            and the data of its artifacts are derived from the seed.
+        artifacts_per_unit (int): The number of artifacts of each unit.
+        data_dir (str): The directory to write the data of the artifacts to, so they can be
+            downloaded from `file://` urls, or None to declare artifacts without data.
+
+    Returns:
+        :class:`~pulpcore.plugin.stages.Stage`: The first stage.
+    """
+    from pulp_file.app.models import FileContent
+    from pulpcore.plugin.models import Artifact
+    from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, Stage
+
+    class SyntheticFirstStage(Stage):
+
+        async def run(self):
+            for relative_path, seed in units:
+                d_artifacts = []
+                for num in range(artifacts_per_unit):
+                    data = '{seed}-{num}'.format(seed=seed, num=num).encode()
+                    artifact_path = '{path}/{num}'.format(path=relative_path, num=num)
+                    url = 'file:///nonexistent/{path}'.format(path=artifact_path)
+                    if data_dir:
+                        url = 'file://' + write_file(data_dir, artifact_path, data)
+                    artifact = Artifact(size=len(data), sha256=hashlib.sha256(data).hexdigest())
+                    d_artifacts.append(DeclarativeArtifact(artifact, url, artifact_path, remote))
+                content = FileContent(
+                    relative_path=relative_path,
+                    digest=hashlib.sha256(seed.encode()).hexdigest(),
+                )
+                await self.put(DeclarativeContent(content=content, d_artifacts=d_artifacts))
+
+    return SyntheticFirstStage()
+
+
+def write_file(data_dir, relative_path, data):
+    """
+    Write `data` to `relative_path` below `data_dir`.
+
+    Returns:
+        str: The absolute path of the file.
+    """
+    path = os.path.join(data_dir, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f_handle:
+        f_handle.write(data)
+    return path
+
+
+@contextmanager
+def task_context():
+    """
+    Run the benchmark like a task, which the stages and the working directory expect.
+
+    A task is created in the database and made the current RQ job, without running a worker.
+    """
+    from pulpcore.app.models import Task
+
+    task = Task.objects.create(name='bench_stages', state='running')
+    job = SimpleNamespace(id=str(task.job_id), origin='bench-stages')
+    with mock.patch('pulpcore.app.models.task.get_current_job', return_value=job), \
+            mock.patch('pulpcore.tasking.services.storage.get_current_job', return_value=job):
+        yield task
+
+
+@contextmanager
+def count_queries(counts):
+    """
+    Count the queries of each stage of the pipelines run in this context.
+
+    The queries are recorded by the :class:`~pulpcore.plugin.stages.profiler.QueryRecorder` of
+    each pipeline, enabled with the `PROFILE_STAGES_API_QUERIES` setting. They are counted by the
+    position and the class name of the stage, which are the same in every run of a scenario.
+
+    Args:
+        counts (collections.Counter): The counter to add the query counts to, by stage.
+    """
+    from django.test import override_settings
+    from pulpcore.plugin.stages.profiler import QueryRecorder
+
+    recorders = []
+
+    def make_recorder():
+        recorders.append(QueryRecorder())
+        return recorders[-1]
+
+    with override_settings(PROFILE_STAGES_API_QUERIES=True), \
+            mock.patch('pulpcore.plugin.stages.api.QueryRecorder', side_effect=make_recorder):
+        yield
+    for recorder in recorders:
+        for num, stage in enumerate(recorder.stages):
+            key = '{num} {name}'.format(num=num, name=stage.__class__.__name__)
+            counts[key] += stage.query_stats.count
+
+
+def sync(repository, remote, units, args, data_dir):
+    """
+    Sync `units` into a new version of `repository`.
+
+    Returns:
+        float: The duration of the sync in seconds.
+    """
+    from pulp_file.app.models import FileContent
+    from pulpcore.plugin.stages import DeclarativeVersion
+
+    first_stage = make_first_stage(remote, units, args.artifacts_per_unit, data_dir)
+    declarative_version = DeclarativeVersion(
+        first_stage,
+        repository,
+        download_artifacts=bool(data_dir),
+        remove_duplicates=[{'model': FileContent, 'field_names': ['relative_path']}],
+        incremental=args.incremental,
+    )
+    start = time.perf_counter()
+    declarative_version.create()
+    return time.perf_counter() - start
+
+
+def run_scenario(args):
+    """
+    Run the timed sync of the scenario described by `args`.
+
+    Returns:
+        dict: The results of the scenario.
+    """
+    from pulp_file.app.models import FileRemote
+    from pulpcore.plugin.models import Repository
+
+    run_id = uuid.uuid4().hex
+    existing = int(args.units * args.existing_ratio)
+    duplicates = int(args.units * args.duplicate_ratio)
+    if existing + duplicates > args.units:
+        raise SystemExit('The pre-existing and the duplicate units exceed the number of units.')
+
+    units = [('unit-{num}'.format(num=num), '{run}-{num}'.format(run=run_id, num=num))
+             for num in range(args.units)]
+    replaced = [(relative_path, seed + '-replaced')
+                for relative_path, seed in units[existing:existing + duplicates]]
+
+    name = 'bench-stages-{run}'.format(run=run_id)
+    remote = FileRemote.objects.create(name=name, url='file:///nonexistent/')
+    repository = Repository.objects.create(name=name)
+
+    with task_context(), tempfile.TemporaryDirectory() as data_dir:
+        if not args.download:
+            data_dir = None
+        if existing or duplicates:
+            sync(repository, remote, units[:existing] + replaced, args, data_dir)
+        queries = Counter()
+        with count_queries(queries):
+            duration = sync(repository, remote, units, args, data_dir)
+
+    return {
+        'items_per_second': args.units / duration,
+        'seconds': duration,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'queries': dict(queries),
+    }
+
+
+def scenario_name(args):
+    """
+    Returns:
+        str: The name of the scenario described by `args`, used as the key of its baseline.
+    """
+    return ('units={units} artifacts-per-unit={artifacts} duplicate-ratio={duplicates} '
+            'existing-ratio={existing} download={download} incremental={incremental}').format(
+        units=args.units,
+        artifacts=args.artifacts_per_unit,
+        duplicates=args.duplicate_ratio,
+        existing=args.existing_ratio,
+        download=args.download,
+        incremental=args.incremental,
+    )
+
+
+def report(result, baseline=None, tolerance=0.1):
+    """
+    Print `result`, compared with `baseline` if there is one.
+
+    Args:
+        result (dict): The results of a scenario.
+        baseline (dict): The saved results of the same scenario, or None.
+        tolerance (float): The relative change that is reported as a regression.
+
+    Returns:
+        list: The descriptions of the regressions.
+    """
+    rows = [('items/s', result['items_per_second'], baseline and baseline['items_per_second'], -1),
+            ('peak RSS (KiB)', result['peak_rss_kib'], baseline and baseline['peak_rss_kib'], 1)]
+    stages = sorted(set(result['queries']) | set(baseline['queries'] if baseline else ()))
+    for stage in stages:
+        rows.append(('queries ' + stage, result['queries'].get(stage, 0),
+                     baseline and baseline['queries'].get(stage, 0), 1))
+
+    regressions = []
+    print('{:<60} {:>14} {:>14} {:>9}'.format('measure', 'result', 'baseline', 'change'))
+    for measure, value, base, worse in rows:
+        if baseline is None:
+            print('{:<60} {:>14.1f}'.format(measure, value))
+            continue
+        change = (value - base) / base if base else float(value > 0)
+        print('{:<60} {:>14.1f} {:>14.1f} {:>+8.1%}'.format(measure, value, base, change))
+        if change * worse > tolerance:
+            regressions.append(measure)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--units', type=int, default=10000, help='number of units to sync')
+    parser.add_argument('--artifacts-per-unit', type=int, default=1,
+                        help='number of artifacts of each unit')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0,
+                        help='ratio of units replacing a unit with the same relative_path')
+    parser.add_argument('--existing-ratio', type=float, default=0.0,
+                        help='ratio of units already in the repository')
+    parser.add_argument('--download', action='store_true',
+                        help='download the artifacts from files instead of deferring them')
+    parser.add_argument('--incremental', action='store_true',
+                        help='sync with the incremental mode of DeclarativeVersion')
+    parser.add_argument('--save-baseline', metavar='PATH',
+                        help='save the results as the baseline of the scenario to a JSON file')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare the results with the baseline of the scenario in a JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change reported as a regression, defaults to 0.1')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pulpcore.app.settings')
+    import django
+    django.setup()
+
+    name = scenario_name(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f_handle:
+            baseline = json.load(f_handle).get(name)
+        if baseline is None:
+            print('No baseline for {name} in {path}.'.format(name=name, path=args.compare))
+
+    result = run_scenario(args)
+    print(name)
+    regressions = report(result, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baselines = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline) as f_handle:
+                baselines = json.load(f_handle)
+        baselines[name] = result
+        with open(args.save_baseline, 'w') as f_handle:
+            json.dump(baselines, f_handle, indent=2, sort_keys=True)
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
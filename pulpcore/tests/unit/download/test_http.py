@@ -0,0 +1,189 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import aiohttp
+import asynctest
+import mock
+
+from pulpcore.plugin.download import (
+    http_giveup,
+    HttpDownloader,
+    MirrorSet,
+    RetryBudget,
+    RetryPolicy,
+)
+
+
+class FakeResponse:
+    """A response with a body of `chunks`, failing with `error` after them if set."""
+
+    def __init__(self, status=200, chunks=(), error=None, headers=None):
+        self.status = status
+        self.chunks = list(chunks)
+        self.error = error
+        self.headers = headers or {}
+        self.content = self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status, headers=self.headers)
+
+    async def read(self, size):
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.error:
+            raise self.error
+        return b''
+
+    async def release(self):
+        pass
+
+
+class FakeSession:
+    """A session answering each request with the next of `responses`."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def get(self, url):
+        self.requests += 1
+        return self.responses.pop(0)
+
+
+def response_error(status, headers=None):
+    return aiohttp.ClientResponseError(None, (), status=status, headers=headers)
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_transient_errors(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_transient(response_error(503)))
+        self.assertTrue(policy.is_transient(aiohttp.ServerDisconnectedError()))
+        self.assertTrue(policy.is_transient(aiohttp.ServerTimeoutError()))
+        self.assertTrue(policy.is_transient(aiohttp.ClientPayloadError()))
+        self.assertFalse(policy.is_transient(response_error(404)))
+        self.assertFalse(policy.is_transient(ValueError()))
+
+    def test_wait_is_jittered_exponential_backoff(self):
+        policy = RetryPolicy(backoff_factor=1, max_backoff=5)
+        for tries, limit in [(1, 1), (2, 2), (3, 4), (4, 5), (9, 5)]:
+            wait = policy.wait(response_error(503), tries)
+            self.assertGreaterEqual(wait, 0)
+            self.assertLessEqual(wait, limit)
+        self.assertEqual(RetryPolicy(jitter=False).wait(response_error(503), 3), 4)
+
+    def test_wait_honors_retry_after(self):
+        policy = RetryPolicy(max_retry_after=60)
+        self.assertEqual(policy.wait(response_error(429, {'Retry-After': '30'}), 1), 30)
+        self.assertIsNone(policy.wait(response_error(429, {'Retry-After': '120'}), 1))
+        past = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        self.assertEqual(policy.wait(response_error(503, {'Retry-After': past}), 1), 0)
+
+    def test_give_up(self):
+        policy = RetryPolicy(max_tries=3, jitter=False)
+        self.assertIsNone(policy.wait(response_error(503), 3))
+        self.assertIsNone(policy.wait(response_error(403), 1))
+        self.assertIsNone(policy.wait(response_error(503), 2, remaining=1))
+        self.assertEqual(policy.wait(response_error(503), 2, remaining=10), 2)
+
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, min_retries=1)
+        for i in range(4):
+            budget.deposit()
+        self.assertEqual([budget.withdraw() for i in range(4)], [True, True, True, False])
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_http_giveup_is_deprecated(self):
+        with self.assertWarns(DeprecationWarning):
+            self.assertFalse(http_giveup(mock.Mock(code=503)))
+
+
+class TestHttpDownloaderRetry(asynctest.TestCase):
+
+    def setUp(self):
+        cwd = os.getcwd()
+        working_dir = tempfile.TemporaryDirectory()
+        os.chdir(working_dir.name)
+        self.addCleanup(working_dir.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        self.policy = RetryPolicy(backoff_factor=0)
+
+    async def test_retry_discards_partial_data(self):
+        session = FakeSession(
+            FakeResponse(503),
+            FakeResponse(chunks=[b'par'], error=aiohttp.ClientPayloadError()),
+            FakeResponse(chunks=[b'data']),
+        )
+        downloader = HttpDownloader('http://example.com/', session=session,
+                                    retry_policy=self.policy, expected_size=4)
+        result = await downloader.run()
+        self.assertEqual(session.requests, 3)
+        self.assertEqual(result.artifact_attributes['size'], 4)
+        with open(result.path, 'rb') as f_handle:
+            self.assertEqual(f_handle.read(), b'data')
+
+    async def test_fatal_error_is_not_retried(self):
+        session = FakeSession(FakeResponse(404), FakeResponse(chunks=[b'data']))
+        downloader = HttpDownloader('http://example.com/', session=session,
+                                    retry_policy=self.policy)
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await downloader.run()
+        self.assertEqual(session.requests, 1)
+
+    async def test_spent_budget_is_not_retried(self):
+        self.policy.budget = RetryBudget(ratio=0, min_retries=1)
+        session = FakeSession(FakeResponse(503), FakeResponse(503), FakeResponse(200))
+        downloader = HttpDownloader('http://example.com/', session=session,
+                                    retry_policy=self.policy)
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await downloader.run()
+        self.assertEqual(session.requests, 2)
+
+    async def test_streamed_data_is_not_retried(self):
+        session = FakeSession(
+            FakeResponse(chunks=[b'par'], error=aiohttp.ClientPayloadError()),
+            FakeResponse(chunks=[b'data']),
+        )
+        downloader = HttpDownloader('http://example.com/', session=session,
+                                    retry_policy=self.policy)
+        received = []
+        with self.assertRaises(aiohttp.ClientPayloadError):
+            async for chunk in downloader.stream():
+                received.append(chunk)
+        self.assertEqual(received, [b'par'])
+        self.assertEqual(session.requests, 1)
+
+    async def test_retry_fails_over_to_another_mirror(self):
+        mirrors = MirrorSet(['http://a.example.com/', 'http://b.example.com/'])
+        session = FakeSession(FakeResponse(503), FakeResponse(chunks=[b'data']))
+        session.get = mock.Mock(side_effect=session.get)
+        downloader = HttpDownloader('http://a.example.com/x.iso', session=session,
+                                    retry_policy=self.policy, mirrors=mirrors)
+        result = await downloader.run()
+        self.assertEqual(session.get.call_args_list, [
+            mock.call('http://a.example.com/x.iso'), mock.call('http://b.example.com/x.iso')])
+        self.assertEqual(result.url, 'http://a.example.com/x.iso')
+        self.assertEqual(mirrors.choose(), 'http://b.example.com/')
+
+    async def test_failed_body_is_no_mirror_success(self):
+        mirrors = MirrorSet(['http://a.example.com/'])
+        mirrors.record_success = mock.Mock()
+        mirrors.record_failure = mock.Mock()
+        session = FakeSession(FakeResponse(chunks=[b'par'], error=aiohttp.ClientPayloadError()))
+        downloader = HttpDownloader('http://a.example.com/x.iso', session=session,
+                                    retry_policy=RetryPolicy(max_tries=1), mirrors=mirrors)
+        with self.assertRaises(aiohttp.ClientPayloadError):
+            await downloader.run()
+        mirrors.record_success.assert_not_called()
+        mirrors.record_failure.assert_called_once_with('http://a.example.com/')
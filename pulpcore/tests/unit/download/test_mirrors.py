@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+import mock
+
+from pulpcore.plugin.download import MirrorSet
+
+
+A = 'http://a.example.com/repo/'
+B = 'http://b.example.com/pub/repo/'
+C = 'http://c.example.com/'
+
+
+class TestMirrorSet(TestCase):
+
+    def setUp(self):
+        self.mirrors = MirrorSet([A, B, C], min_requests=2, reset_timeout=30)
+        patcher = mock.patch('pulpcore.plugin.download.mirrors.time')
+        self.addCleanup(patcher.stop)
+        self.time = patcher.start()
+        self.time.monotonic.return_value = 100
+
+    def test_rewrite(self):
+        self.assertEqual(self.mirrors.rewrite(A + 'x/y.rpm', B), B + 'x/y.rpm')
+        self.assertEqual(self.mirrors.rewrite('http://d.example.com/y.rpm', B),
+                         'http://d.example.com/y.rpm')
+        self.assertIsNone(self.mirrors.base_url_of('http://d.example.com/y.rpm'))
+
+    def test_choose_untried_in_order_then_fastest(self):
+        self.assertEqual(self.mirrors.choose(), A)
+        self.mirrors.record_success(A, 0.5)
+        self.assertEqual(self.mirrors.choose(), B)
+        self.mirrors.record_success(B, 0.1)
+        self.mirrors.record_success(C, 0.3)
+        self.assertEqual(self.mirrors.choose(), B)
+        self.assertEqual(self.mirrors.choose(exclude={B}), C)
+
+    def test_circuit_opens_and_recovers(self):
+        for base_url, latency in [(A, 0.1), (B, 0.2), (C, 0.3)]:
+            self.mirrors.record_success(base_url, latency)
+        self.mirrors.record_failure(A)
+        self.assertTrue(self.mirrors.is_available(A))
+        for i in range(3):
+            self.mirrors.record_failure(A)
+        self.assertFalse(self.mirrors.is_available(A))
+        self.assertEqual(self.mirrors.choose(), B)
+
+        # half-open after the reset timeout, a failure opens the circuit again
+        self.time.monotonic.return_value = 130
+        self.assertEqual(self.mirrors.choose(), A)
+        self.mirrors.record_failure(A)
+        self.assertFalse(self.mirrors.is_available(A))
+
+        # a success closes it
+        self.time.monotonic.return_value = 160
+        self.mirrors.record_success(A, 0.1)
+        self.mirrors.record_failure(A)
+        self.assertTrue(self.mirrors.is_available(A))
+
+    def test_all_circuits_open(self):
+        for now, base_url in [(100, B), (101, A), (102, C)]:
+            self.time.monotonic.return_value = now
+            for i in range(2):
+                self.mirrors.record_failure(base_url)
+        self.assertEqual(self.mirrors.choose(), B)
@@ -0,0 +1,58 @@
+import asyncio
+
+import asynctest
+
+from pulpcore.plugin.download import RedisSemaphore
+
+
+class FakeRedis:
+    """The sorted set commands of the semaphore, with the script run in Python."""
+
+    def __init__(self):
+        self.sets = {}
+
+    def register_script(self, script):
+        def acquire(keys, args):
+            leases = self.sets.setdefault(keys[0], {})
+            now, lease, value, token = args[:4]
+            for expired in [token for token, score in leases.items() if score <= now - lease]:
+                del leases[expired]
+            if len(leases) < value:
+                leases[token] = now
+                return 1
+            return 0
+        return acquire
+
+    def zrem(self, key, token):
+        self.sets[key].pop(token)
+
+
+class TestRedisSemaphore(asynctest.TestCase):
+
+    async def test_shared_limit(self):
+        connection = FakeRedis()
+        semaphores = [RedisSemaphore('test', 2, poll_interval=0.001, connection=connection)
+                      for i in range(2)]
+        running = 0
+        max_running = 0
+
+        async def hold(semaphore):
+            nonlocal running, max_running
+            async with semaphore:
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.005)
+                running -= 1
+
+        await asyncio.gather(*[hold(semaphores[i % 2]) for i in range(6)])
+
+        self.assertEqual(max_running, 2)
+        self.assertEqual(connection.sets['pulp:semaphore:test'], {})
+
+    async def test_expired_leases_are_dropped(self):
+        connection = FakeRedis()
+        connection.sets['pulp:semaphore:test'] = {'crashed': 0}
+        semaphore = RedisSemaphore('test', 1, lease=10, connection=connection)
+
+        await asyncio.wait_for(semaphore.acquire(), 1)
+        self.assertNotIn('crashed', connection.sets['pulp:semaphore:test'])
@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+
+import asynctest
+
+from pulpcore.exceptions import DigestValidationError
+from pulpcore.plugin.download import BaseDownloader, DownloadResult, FileDownloader
+
+
+class ChunkDownloader(BaseDownloader):
+    """A downloader passing the chunks of its `url` list to `handle_data`."""
+
+    async def _run(self, extra_data=None):
+        self.handled = 0
+        for chunk in self.url:
+            await self.handle_data(chunk)
+            self.handled += 1
+        await self.finalize()
+        return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
+                              url=self.url, headers=None)
+
+
+class TestStream(asynctest.TestCase):
+
+    def setUp(self):
+        cwd = os.getcwd()
+        working_dir = tempfile.TemporaryDirectory()
+        os.chdir(working_dir.name)
+        self.addCleanup(working_dir.cleanup)
+        self.addCleanup(os.chdir, cwd)
+
+    async def test_chunks_are_yielded_while_downloading(self):
+        chunks = [str(i).encode() for i in range(20)]
+        downloader = ChunkDownloader(chunks)
+        received = []
+        async for chunk in downloader.stream(max_chunks=2):
+            await asyncio.sleep(0)
+            # the download is at most max_chunks + 1 chunks ahead
+            self.assertLessEqual(downloader.handled - len(received), 3)
+            received.append(chunk)
+        self.assertEqual(received, chunks)
+        with open(downloader.path, 'rb') as f_handle:
+            self.assertEqual(f_handle.read(), b''.join(chunks))
+
+    async def test_digest_validation(self):
+        downloader = ChunkDownloader([b'data'], expected_digests={'sha256': 'invalid'})
+        received = []
+        with self.assertRaises(DigestValidationError):
+            async for chunk in downloader.stream():
+                received.append(chunk)
+        self.assertEqual(received, [b'data'])
+
+    async def test_file_downloader(self):
+        data = os.urandom(3 * 1048576 + 1)
+        with tempfile.NamedTemporaryFile() as f_handle:
+            f_handle.write(data)
+            f_handle.flush()
+            downloader = FileDownloader(
+                'file://' + f_handle.name,
+                expected_digests={'sha256': hashlib.sha256(data).hexdigest()}
+            )
+            received = [chunk async for chunk in downloader.stream()]
+        self.assertEqual(len(received), 4)
+        self.assertEqual(b''.join(received), data)
@@ -0,0 +1,239 @@
+"""
+A toolkit to test the performance of stages deterministically with simulated time.
+
+Tests derive from :class:`SimulationTestCase`, whose event loop clock only advances with
+:meth:`SimulationTestCase.advance_to`. Downloads take time with :class:`SimulatedDownloaders` and
+database queries block the event loop with :class:`SimulatedDatabase`, both with latencies drawn
+from the distributions of this module. A pipeline of many simulated minutes runs in milliseconds.
+"""
+import asyncio
+import random
+
+import asynctest
+from unittest import mock
+
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, EndStage, Stage
+
+
+class SimulatedError(Exception):
+    """
+    The exception raised by a failing simulated download.
+    """
+    pass
+
+
+def constant(seconds):
+    """
+    Returns:
+        callable: A latency distribution that always takes `seconds`.
+    """
+    return lambda key=None: seconds
+
+
+def uniform(low, high, seed=0):
+    """
+    Returns:
+        callable: A latency distribution drawing uniformly between `low` and `high` seconds.
+    """
+    rand = random.Random(seed)
+    return lambda key=None: rand.uniform(low, high)
+
+
+def exponential(mean, seed=0):
+    """
+    Returns:
+        callable: A latency distribution drawing from an exponential distribution with `mean`.
+    """
+    rand = random.Random(seed)
+    return lambda key=None: rand.expovariate(1 / mean)
+
+
+def from_url(url):
+    """
+    A latency distribution reading the latency from the url of a download.
+
+    The url is the number of seconds the download takes, e.g. `url='5'` takes 5 seconds. A
+    negative number fails after the absolute value, e.g. `url='-5'` fails after 5 seconds.
+    """
+    return int(url)
+
+
+class SimulatedDownloaders:
+    """
+    A factory of downloaders that take simulated time, usable as `remote.get_downloader`.
+
+    It keeps statistics about all downloaders it built.
+
+    Args:
+        latency (callable): Returns the seconds a download takes given its url, negative
+            values make the download fail. Defaults to :func:`from_url`.
+    """
+
+    def __init__(self, latency=from_url):
+        self.latency = latency
+        self.running = 0
+        self.max_running = 0
+        self.downloads = 0
+        self.canceled = 0
+        self.busy = 0
+
+    def __call__(self, url=None, **kwargs):
+        return SimulatedDownloader(self, url)
+
+
+class SimulatedDownloader:
+    """
+    A downloader built by :class:`SimulatedDownloaders`.
+    """
+
+    def __init__(self, downloaders, url):
+        self.downloaders = downloaders
+        self.url = url
+
+    async def run(self, extra_data=None):
+        stats = self.downloaders
+        stats.running += 1
+        stats.max_running = max(stats.max_running, stats.running)
+        try:
+            duration = stats.latency(self.url)
+            stats.busy += abs(duration)
+            await asyncio.sleep(abs(duration))
+            if duration < 0:
+                raise SimulatedError('Download Failed')
+        except asyncio.CancelledError:
+            stats.canceled += 1
+            raise
+        finally:
+            stats.running -= 1
+        stats.downloads += 1
+        result = mock.Mock()
+        result.url = self.url
+        result.artifact_attributes = {}
+        return result
+
+
+class SimulatedDatabase:
+    """
+    A database stub whose queries block the event loop for simulated time.
+
+    Stages query the database synchronously, so nothing else runs on the event loop during a query.
+    The stub models that by advancing the clock of `test_case` without running the loop.
+
+    Args:
+        test_case (:class:`SimulationTestCase`): The test case owning the clock.
+        latency (callable): Returns the seconds a query takes given the number of rows.
+    """
+
+    def __init__(self, test_case, latency):
+        self.test_case = test_case
+        self.latency = latency
+        self.queries = 0
+        self.busy = 0
+
+    def query(self, rows=1):
+        """
+        Run a query of `rows` rows, blocking the event loop.
+        """
+        self.queries += 1
+        duration = self.latency(rows)
+        self.busy += duration
+        self.test_case._time += duration
+
+
+class SimulatedQueryStage(Stage):
+    """
+    A stage running one query per batch, like the query and saver stages.
+
+    Args:
+        database (:class:`SimulatedDatabase`): The database to query.
+        minsize (int): The minimum batch size passed to :meth:`batches`.
+    """
+
+    def __init__(self, database, minsize=50):
+        super().__init__()
+        self.database = database
+        self.minsize = minsize
+        self.batch_sizes = []
+
+    async def run(self):
+        async for batch in self.batches(self.minsize):
+            self.batch_sizes.append(len(batch))
+            self.database.query(len(batch))
+            for d_content in batch:
+                await self.put(d_content)
+
+
+class RecordingEndStage(EndStage):
+    """
+    A last stage recording the simulated time each item arrived at.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+    async def __call__(self):
+        loop = asyncio.get_event_loop()
+        async for d_content in self.items():
+            self.times.append(loop.time())
+
+
+class SimulationTestCase(asynctest.ClockedTestCase):
+    """
+    A test case with a simulated clock starting at 0.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.now = 0
+
+    async def advance_to(self, now):
+        """
+        Advance the clock to `now`, running everything scheduled until then.
+
+        The clock may end up later than `now` if a :class:`SimulatedDatabase` query was running.
+        """
+        await self.advance(max(now - self.now, 0))
+
+    async def advance(self, seconds):
+        """
+        Advance the clock by `seconds`, running everything scheduled until then.
+
+        Unlike :meth:`asynctest.ClockedTestCase.advance`, the clock never goes back if a
+        :class:`SimulatedDatabase` query advanced it in the meantime.
+        """
+        target_time = self._time + seconds
+        await self._drain_loop()
+        while True:
+            next_time = self._next_scheduled()
+            if next_time is None or next_time > target_time:
+                break
+            self._time = max(self._time, next_time)
+            await self._drain_loop()
+        self._time = max(self._time, target_time)
+        await self._drain_loop()
+        self.now = self._time
+
+    def make_content(self, downloaders, delays=()):
+        """
+        Make a DeclarativeContent with a DeclarativeArtifact for each delay in `delays`.
+
+        Args:
+            downloaders (:class:`SimulatedDownloaders`): Builds the downloaders of the artifacts.
+            delays (iterable): The url of each artifact, which the default latency distribution of
+                `downloaders` reads the download duration from. `None` means the artifact is
+                already present (pk is set) and no download is required.
+
+        Returns:
+            :class:`~pulpcore.plugin.stages.DeclarativeContent`: The content.
+        """
+        d_artifacts = []
+        for delay in delays:
+            artifact = mock.Mock()
+            artifact.pk = True if delay is None else None
+            artifact.DIGEST_FIELDS = []
+            remote = mock.Mock()
+            remote.get_downloader = downloaders
+            d_artifacts.append(DeclarativeArtifact(artifact=artifact, url=str(delay),
+                                                   relative_path='path', remote=remote))
+        return DeclarativeContent(content=mock.Mock(), d_artifacts=d_artifacts)
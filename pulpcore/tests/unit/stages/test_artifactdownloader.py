@@ -1,79 +1,20 @@
 import asyncio
 
-import asynctest
 from unittest import mock
 
-from pulpcore.plugin.stages import DeclarativeContent, DeclarativeArtifact
 from pulpcore.plugin.stages.artifact_stages import ArtifactDownloader
 
+from .simulation import exponential, SimulatedDownloaders, SimulatedError, SimulationTestCase
 
-class MockException(Exception):
-    """
-    A tracer exception.
-    """
-    pass
-
-
-class DownloaderMock:
-    """Mock for a Downloader.
-
-    URLs are expected to be the delay to wait to simulate downloading,
-    e.g `url='5'` will wait for 5 seconds. Negative numbers will raise
-    an exception after waiting for the absolute value, e.g. `url=-5` fails
-    after 5 seconds. `DownloaderMock` manages _global_ statistics about the
-    downloads.
-    """
-    running = 0
-    downloads = 0
-    canceled = 0
-
-    def __init__(self, url, **kwargs):
-        self.url = url
-
-    @classmethod
-    def reset(cls):
-        cls.running = 0
-        cls.downloads = 0
-        cls.canceled = 0
-
-    async def run(self, extra_data=None):
-        DownloaderMock.running += 1
-        try:
-            duration = int(self.url)
-            await asyncio.sleep(abs(duration))
-            if duration < 0:
-                raise MockException("Download Failed")
-        except asyncio.CancelledError:
-            DownloaderMock.running -= 1
-            DownloaderMock.canceled += 1
-            raise
-        DownloaderMock.running -= 1
-        DownloaderMock.downloads += 1
-        result = mock.Mock()
-        result.url = self.url
-        result.artifact_attributes = {}
-        return result
-
-
-class TestArtifactDownloader(asynctest.ClockedTestCase):
+
+class TestArtifactDownloader(SimulationTestCase):
 
     def setUp(self):
         super().setUp()
-        DownloaderMock.reset()
-        self.now = 0
+        self.downloaders = SimulatedDownloaders()
         self.in_q = asyncio.Queue()
         self.out_q = asyncio.Queue()
 
-    async def advance_to(self, now):
-        delta = now - self.now
-        assert delta >= 0
-        await self.advance(delta)
-        self.now = now
-
-    async def advance(self, delta):
-        await super().advance(delta)
-        self.now += delta
-
     def queue_dc(self, delays=[]):
         """Put a DeclarativeContent instance into `in_q`
 
@@ -82,17 +23,7 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         None` means that the artifact is already present (pk is set)
         and no download is required.
         """
-        das = []
-        for delay in delays:
-            artifact = mock.Mock()
-            artifact.pk = True if delay is None else None
-            artifact.DIGEST_FIELDS = []
-            remote = mock.Mock()
-            remote.get_downloader = DownloaderMock
-            das.append(DeclarativeArtifact(artifact=artifact, url=str(delay),
-                                           relative_path='path', remote=remote))
-        dc = DeclarativeContent(content=mock.Mock(), d_artifacts=das)
-        self.in_q.put_nowait(dc)
+        self.in_q.put_nowait(self.make_content(self.downloaders, delays))
 
     async def download_task(self, max_concurrent_content=3):
         """
@@ -127,7 +58,7 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         # At 0.5 seconds
         await self.advance_to(0.5)
         # 3, 6 and 9 are running. 0 is finished
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
         # non-downloads 1, 2, 4, 5, 7, 8 are forwarded
         self.assertHandled(7)
         # 9 - 26 + None are waiting to be picked up
@@ -140,13 +71,13 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         # 9 + 18 + 27: finished after 54 seconds
         for t in range(1, 36):  # until 35.5 seconds three downloads must run
             await self.advance_to(t + 0.5)
-            self.assertEqual(DownloaderMock.running, 3)
+            self.assertEqual(self.downloaders.running, 3)
 
         # At 54.5 seconds, the stage is done at the latest
         await self.advance_to(54.5)
-        self.assertEqual(DownloaderMock.running, 0)
-        self.assertEqual(DownloaderMock.downloads, 10)
-        self.assertEqual(download_task.result(), DownloaderMock.downloads)
+        self.assertEqual(self.downloaders.running, 0)
+        self.assertEqual(self.downloaders.downloads, 10)
+        self.assertEqual(download_task.result(), self.downloaders.downloads)
         self.assertQueued(0)
         self.assertHandled(29)
 
@@ -173,27 +104,48 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         # At 0.5 seconds, three content units are downloading with four
         # downloads overall
         await self.advance_to(0.5)
-        self.assertEqual(DownloaderMock.running, 4)
+        self.assertEqual(self.downloaders.running, 4)
         self.assertHandled(1)
         # At 1.5 seconds, the download for the first content unit has completed.
         # At 1 second, the download of the forth content unit is started
         await self.advance_to(1.5)
-        self.assertEqual(DownloaderMock.running, 4)
+        self.assertEqual(self.downloaders.running, 4)
         self.assertHandled(2)
         # At 2.5 seconds, the downloads for the second and the third content unit
         # have completed
         await self.advance_to(2.5)
-        self.assertEqual(DownloaderMock.running, 1)
+        self.assertEqual(self.downloaders.running, 1)
         self.assertHandled(4)
 
         # At 3.5 seconds, stage must de done
         await self.advance_to(3.5)
-        self.assertEqual(DownloaderMock.running, 0)
-        self.assertEqual(DownloaderMock.downloads, 5)
-        self.assertEqual(download_task.result(), DownloaderMock.downloads)
+        self.assertEqual(self.downloaders.running, 0)
+        self.assertEqual(self.downloaders.downloads, 5)
+        self.assertEqual(download_task.result(), self.downloaders.downloads)
         self.assertQueued(0)
         self.assertHandled(6)
 
+    async def test_throughput_with_random_latencies(self):
+        self.downloaders = SimulatedDownloaders(latency=exponential(mean=1, seed=0))
+        draw = exponential(mean=1, seed=0)
+        latencies = [draw() for i in range(100)]
+        download_task = self.loop.create_task(self.download_task(max_concurrent_content=10))
+        for i in range(100):
+            self.queue_dc(delays=[0])
+        self.in_q.put_nowait(None)
+
+        while not download_task.done():
+            await self.advance(0.1)
+
+        # All slots are used and no slot stays idle while downloads are waiting, so the stage
+        # needs at most the time of the longest download more than a perfect schedule.
+        self.assertEqual(self.downloaders.max_running, 10)
+        self.assertEqual(self.downloaders.downloads, 100)
+        self.assertAlmostEqual(self.downloaders.busy, sum(latencies))
+        self.assertGreaterEqual(self.now, sum(latencies) / 10)
+        self.assertLessEqual(self.now, sum(latencies) / 10 + max(latencies) + 0.1)
+        self.assertHandled(101)
+
     async def test_sparse_batches_dont_block_stage(self):
         """Regression test for issue https://pulp.plan.io/issues/4018."""
 
@@ -212,7 +164,7 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
 
         # At 0.5 seconds, the first content unit is downloading
         await self.advance_to(0.5)
-        self.assertEqual(DownloaderMock.running, 1)
+        self.assertEqual(self.downloaders.running, 1)
         self.assertHandled(99)
 
         # at 0.5 seconds next batch arrives (last batch)
@@ -221,15 +173,15 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
 
         # at 1.0 seconds, two downloads are running
         await self.advance_to(1)
-        self.assertEqual(DownloaderMock.running, 2)
+        self.assertEqual(self.downloaders.running, 2)
         self.assertHandled(2 * 99)
 
         # at 101 seconds, stage should have completed
         await self.advance_to(101)
 
-        self.assertEqual(DownloaderMock.running, 0)
-        self.assertEqual(DownloaderMock.downloads, 2)
-        self.assertEqual(download_task.result(), DownloaderMock.downloads)
+        self.assertEqual(self.downloaders.running, 0)
+        self.assertEqual(self.downloaders.downloads, 2)
+        self.assertEqual(download_task.result(), self.downloaders.downloads)
         self.assertQueued(0)
         self.assertHandled(201)
 
@@ -241,7 +193,7 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
 
         # After 0.5 seconds, the three downloads must have started
         await self.advance_to(0.5)
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
 
         download_task.cancel()
 
@@ -249,8 +201,8 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
 
         with self.assertRaises(asyncio.CancelledError):
             download_task.result()
-        self.assertEqual(DownloaderMock.running, 0)
-        self.assertEqual(DownloaderMock.canceled, 3)
+        self.assertEqual(self.downloaders.running, 0)
+        self.assertEqual(self.downloaders.canceled, 3)
 
     async def test_exception_with_empty_in_q(self):
         download_task = self.loop.create_task(self.download_task())
@@ -264,21 +216,21 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         # At 0.5 seconds
         await self.advance_to(0.5)
         # 3 downloads are running. No unit is finished
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
         self.assertHandled(0)
         self.assertQueued(1)
 
         # At 1.5 seconds
         await self.advance_to(1.5)
         # 3 downloads are running. One unit is finished.
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
         self.assertHandled(1)
         self.assertQueued(0)
 
         # At 2.5 seconds, the exception must have been triggered
         await self.advance_to(2.5)
         self.assertTrue(download_task.done())
-        self.assertIsInstance(download_task.exception(), MockException)
+        self.assertIsInstance(download_task.exception(), SimulatedError)
 
     async def test_exception_finished_in_q(self):
         download_task = self.loop.create_task(self.download_task())
@@ -293,21 +245,21 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         # At 0.5 seconds
         await self.advance_to(0.5)
         # 3 downloads are running. No unit is finished
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
         self.assertHandled(0)
         self.assertQueued(2)
 
         # At 1.5 seconds
         await self.advance_to(1.5)
         # 3 downloads are running. One unit is finished.
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
         self.assertHandled(1)
         self.assertQueued(1)
 
         # At 2.5 seconds, the exception must have been triggered
         await self.advance_to(2.5)
         self.assertTrue(download_task.done())
-        self.assertIsInstance(download_task.exception(), MockException)
+        self.assertIsInstance(download_task.exception(), SimulatedError)
 
     async def test_exception_with_saturated_content_slots(self):
         download_task = self.loop.create_task(self.download_task())
@@ -322,18 +274,18 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         # At 0.5 seconds
         await self.advance_to(0.5)
         # 3 downloads are running. No unit is finished
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
         self.assertHandled(0)
         self.assertQueued(2)
 
         # At 1.5 seconds
         await self.advance_to(1.5)
         # 3 downloads are running. One unit is finished.
-        self.assertEqual(DownloaderMock.running, 3)
+        self.assertEqual(self.downloaders.running, 3)
         self.assertHandled(1)
         self.assertQueued(1)
 
         # At 2.5 seconds, the exception must have been triggered
         await self.advance_to(2.5)
         self.assertTrue(download_task.done())
-        self.assertIsInstance(download_task.exception(), MockException)
+        self.assertIsInstance(download_task.exception(), SimulatedError)
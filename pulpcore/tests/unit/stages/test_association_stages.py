@@ -0,0 +1,120 @@
+import asyncio
+from itertools import chain
+import uuid
+
+import asynctest
+from django.db.models import QuerySet
+import mock
+
+from pulpcore.plugin.stages import (
+    ContentAssociation,
+    ContentUnassociation,
+    DeclarativeContent,
+    UUIDSet,
+)
+
+
+class TestContentUnassociation(asynctest.TestCase):
+
+    def setUp(self):
+        self.new_version = mock.Mock()
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+
+    async def unassociate(self, *items, chunk_size=2):
+        """
+        Run the stage on `items` with a mocked ProgressBar and Content model.
+
+        Returns:
+            A tuple of the done counts of the ProgressBar at each save and the mocked Content model.
+        """
+        for item in items:
+            self.in_q.put_nowait(item)
+        self.in_q.put_nowait(None)
+        with mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar') as pb, \
+                mock.patch('pulpcore.plugin.stages.association_stages.Content') as content:
+            progress = pb.return_value.__enter__.return_value
+            progress.done = 0
+            saved = []
+            progress.save.side_effect = lambda: saved.append(progress.done)
+            stage = ContentUnassociation(self.new_version, chunk_size=chunk_size)
+            stage._connect(self.in_q, self.out_q)
+            await stage()
+        return saved, content
+
+    def unassociated_chunks(self, content):
+        return [kwargs['pk__in'] for args, kwargs in content.objects.filter.call_args_list]
+
+    async def test_pk_collection(self):
+        pks = UUIDSet(uuid.uuid4() for i in range(5))
+        saved, content = await self.unassociate(pks)
+
+        self.assertEqual(saved, [2, 4, 5])
+        chunks = self.unassociated_chunks(content)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(set(chain.from_iterable(chunks)), set(pks))
+        self.assertEqual(self.new_version.remove_content.call_count, 3)
+        self.assertIs(self.out_q.get_nowait(), pks)
+
+    async def test_integer_pk_collection(self):
+        pks = UUIDSet(range(1, 6))
+        saved, content = await self.unassociate(pks)
+
+        self.assertEqual(saved, [2, 4, 5])
+        self.assertEqual(self.unassociated_chunks(content), [[1, 2], [3, 4], [5]])
+        self.assertIs(self.out_q.get_nowait(), pks)
+
+    async def test_queryset(self):
+        # the primary keys of Content are integers of an AutoField
+        pks = [7, 3, 5]
+        queryset = mock.Mock(spec=QuerySet)
+        queryset.values_list.return_value.iterator.return_value = pks
+        saved, content = await self.unassociate(queryset)
+
+        self.assertEqual(saved, [2, 3])
+        queryset.values_list.assert_called_once_with('pk', flat=True)
+        self.assertEqual(set(chain.from_iterable(self.unassociated_chunks(content))), set(pks))
+        self.assertIs(self.out_q.get_nowait(), queryset)
+
+
+class TestContentAssociation(asynctest.TestCase):
+
+    async def test_unassociated_pks_are_sent_in_chunks(self):
+        kept = mock.Mock(pk=uuid.uuid4())
+        pks = [uuid.uuid4() for i in range(4)] + [kept.pk]
+        new_version = mock.Mock()
+        new_version.content.values_list.return_value.iterator.return_value = pks
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        in_q.put_nowait(DeclarativeContent(content=kept))
+        in_q.put_nowait(None)
+        with mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar'):
+            stage = ContentAssociation(new_version, chunk_size=3)
+            stage._connect(in_q, out_q)
+            await stage()
+
+        new_version.add_content.assert_not_called()
+        chunks = [out_q.get_nowait() for i in range(out_q.qsize() - 1)]
+        self.assertIsNone(out_q.get_nowait())
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 1])
+        self.assertEqual(set(chain.from_iterable(chunks)), set(pks[:4]))
+
+    async def test_integer_pks(self):
+        kept = mock.Mock(pk=3)
+        added = mock.Mock(pk=7)
+        new_version = mock.Mock()
+        new_version.content.values_list.return_value.iterator.return_value = [1, 2, 3]
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        in_q.put_nowait(DeclarativeContent(content=kept))
+        in_q.put_nowait(DeclarativeContent(content=added))
+        in_q.put_nowait(None)
+        with mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar'), \
+                mock.patch('pulpcore.plugin.stages.association_stages.Content') as content:
+            stage = ContentAssociation(new_version)
+            stage._connect(in_q, out_q)
+            await stage()
+
+        content.objects.filter.assert_called_once_with(pk__in=[7])
+        self.assertEqual(sorted(out_q.get_nowait()), [1, 2])
+        self.assertIsNone(out_q.get_nowait())
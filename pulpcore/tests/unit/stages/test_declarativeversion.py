@@ -0,0 +1,164 @@
+import uuid
+
+from unittest import TestCase
+import mock
+
+from pulpcore.plugin.stages import DeclarativeVersion, QueryUnchangedContents
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+        self.ttl = ex
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+@mock.patch('pulpcore.plugin.stages.declarative_version.create_pipeline', mock.MagicMock())
+@mock.patch('pulpcore.plugin.stages.declarative_version.WorkingDirectory', mock.MagicMock())
+class TestUpstreamToken(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('pulpcore.plugin.stages.declarative_version.connection')
+        self.addCleanup(patcher.stop)
+        patcher.start().get_redis_connection.return_value = self.redis
+        patcher = mock.patch('pulpcore.plugin.stages.declarative_version.RepositoryVersion')
+        self.addCleanup(patcher.stop)
+        self.repository_version = patcher.start()
+        self.repository_version.latest.return_value = None
+        self.repository_version.objects.filter.return_value.order_by.return_value.first \
+            .return_value = None
+        self.repository_version.create.side_effect = self.create_version
+        self.loop = mock.Mock()
+        patcher = mock.patch('asyncio.get_event_loop', return_value=self.loop)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.repository = mock.Mock(pk=uuid.uuid4())
+
+    def create_version(self, repository):
+        version = mock.MagicMock(pk=uuid.uuid4())
+        version.__enter__.return_value = version
+        self.repository_version.latest.return_value = version
+        return version
+
+    def sync(self, **kwargs):
+        DeclarativeVersion(mock.Mock(), self.repository, **kwargs).create()
+
+    def test_same_token_creates_no_version(self):
+        self.sync(upstream_token='abc')
+        self.sync(upstream_token='abc')
+        self.assertEqual(self.repository_version.create.call_count, 1)
+        self.assertEqual(self.loop.run_until_complete.call_count, 1)
+
+    def test_changed_token(self):
+        self.sync(upstream_token='abc')
+        self.sync(upstream_token='def')
+        self.assertEqual(self.repository_version.create.call_count, 2)
+
+    def test_changed_options(self):
+        self.sync(upstream_token='abc')
+        self.sync(upstream_token='abc', mirror=False)
+        self.assertEqual(self.repository_version.create.call_count, 2)
+
+    def test_changed_remote(self):
+        remote = mock.Mock(pk=uuid.uuid4(), url='http://example.com/', _last_updated='1')
+        self.sync(upstream_token='abc', remote=remote)
+        remote._last_updated = '2'
+        self.sync(upstream_token='abc', remote=remote)
+        self.sync(upstream_token='abc', remote=remote)
+        self.assertEqual(self.repository_version.create.call_count, 2)
+
+    def test_changed_remove_duplicates(self):
+        model = mock.Mock(_meta=mock.Mock(label='file.FileContent'))
+        self.sync(upstream_token='abc')
+        self.sync(upstream_token='abc',
+                  remove_duplicates=[{'model': model, 'field_names': ['relative_path']}])
+        self.assertEqual(self.repository_version.create.call_count, 2)
+
+    def test_upstream_state_expires(self):
+        self.sync(upstream_token='abc')
+        self.assertGreater(self.redis.ttl, 0)
+
+    def test_version_created_without_token(self):
+        self.sync(upstream_token='abc')
+        self.sync()
+        self.sync(upstream_token='abc')
+        self.assertEqual(self.repository_version.create.call_count, 3)
+
+    def test_failed_sync_stores_no_token(self):
+        self.loop.run_until_complete.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.sync(upstream_token='abc')
+        self.assertEqual(self.redis.data, {})
+
+
+@mock.patch('pulpcore.plugin.stages.declarative_version.create_pipeline', mock.MagicMock())
+@mock.patch('pulpcore.plugin.stages.declarative_version.WorkingDirectory', mock.MagicMock())
+class TestResumable(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pulpcore.plugin.stages.declarative_version.RepositoryVersion')
+        self.addCleanup(patcher.stop)
+        self.repository_version = patcher.start()
+        self.incomplete = \
+            self.repository_version.objects.filter.return_value.order_by.return_value.first
+        self.incomplete.return_value = None
+        self.loop = mock.Mock()
+        patcher = mock.patch('asyncio.get_event_loop', return_value=self.loop)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.repository = mock.Mock(last_version=3)
+        self.declarative_version = DeclarativeVersion(mock.Mock(), self.repository,
+                                                      resumable=True)
+
+    def test_failed_version_is_kept(self):
+        self.loop.run_until_complete.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.declarative_version.create()
+        new_version = self.repository_version.create.return_value
+        new_version.__exit__.assert_not_called()
+        new_version.delete.assert_not_called()
+
+    def test_incomplete_version_is_resumed(self):
+        incomplete = mock.MagicMock(number=3)
+        self.incomplete.return_value = incomplete
+        with mock.patch.object(DeclarativeVersion, 'pipeline_stages', return_value=[]) as stages:
+            self.declarative_version.create()
+        self.repository_version.create.assert_not_called()
+        stages.assert_called_once_with(incomplete)
+        incomplete.__exit__.assert_called_once_with(None, None, None)
+        incomplete.delete.assert_not_called()
+
+    def test_outdated_incomplete_version_is_deleted(self):
+        incomplete = mock.MagicMock(number=2)
+        self.incomplete.return_value = incomplete
+        self.declarative_version.create()
+        incomplete.delete.assert_called_once_with()
+        self.assertEqual(self.repository.last_version, 3)
+        self.repository_version.objects.filter.assert_called_with(
+            repository=self.repository, complete=False)
+        self.repository_version.create.assert_called_once_with(self.repository)
+
+    def test_incomplete_version_is_deleted_by_non_resumable_sync(self):
+        incomplete = mock.MagicMock(number=3)
+        self.incomplete.return_value = incomplete
+        self.declarative_version.resumable = False
+        self.declarative_version.create()
+        incomplete.delete.assert_called_once_with()
+        self.assertEqual(self.repository.last_version, 2)
+        self.repository_version.create.assert_called_once_with(self.repository)
+        self.repository_version.create.return_value.__exit__.assert_called_once_with(
+            None, None, None)
+
+    def test_pipeline_skips_unchanged_content(self):
+        stages = self.declarative_version.pipeline_stages(mock.Mock())
+        self.assertIsInstance(stages[1], QueryUnchangedContents)
@@ -0,0 +1,88 @@
+import unittest
+import uuid
+
+from pulpcore.plugin.stages import BloomFilter, UUIDSet
+
+
+class TestUUIDSet(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = [uuid.uuid4() for i in range(100)]
+
+    def test_contains(self):
+        keys = UUIDSet(self.keys[:50], buffer_size=10)
+        for key in self.keys[:50]:
+            self.assertIn(key, keys)
+        for key in self.keys[50:]:
+            self.assertNotIn(key, keys)
+        self.assertEqual(len(keys), 50)
+
+    def test_contains_str(self):
+        keys = UUIDSet(self.keys, buffer_size=10)
+        self.assertIn(str(self.keys[0]), keys)
+
+    def test_add_existing(self):
+        keys = UUIDSet(self.keys, buffer_size=10)
+        keys.update(self.keys)
+        self.assertEqual(len(keys), 100)
+
+    def test_remove(self):
+        keys = UUIDSet(self.keys, buffer_size=10)
+        for key in self.keys[::2]:
+            keys.remove(key)
+        self.assertEqual(len(keys), 50)
+        self.assertEqual(set(keys), set(self.keys[1::2]))
+        with self.assertRaises(KeyError):
+            keys.remove(self.keys[0])
+
+    def test_remove_and_add_again(self):
+        keys = UUIDSet(self.keys, buffer_size=1000)
+        keys.remove(self.keys[0])
+        self.assertNotIn(self.keys[0], keys)
+        keys.add(self.keys[0])
+        self.assertIn(self.keys[0], keys)
+        self.assertEqual(len(keys), 100)
+
+    def test_discard(self):
+        keys = UUIDSet(self.keys[:10])
+        self.assertTrue(keys.discard(self.keys[0]))
+        self.assertFalse(keys.discard(self.keys[0]))
+        self.assertFalse(keys.discard(self.keys[50]))
+        self.assertEqual(len(keys), 9)
+
+    def test_iter(self):
+        keys = UUIDSet(self.keys, buffer_size=7)
+        self.assertEqual(sorted(keys), sorted(self.keys))
+
+    def test_empty(self):
+        keys = UUIDSet()
+        self.assertFalse(keys)
+        self.assertEqual(list(keys), [])
+        self.assertNotIn(self.keys[0], keys)
+
+    def test_integer_keys(self):
+        keys = UUIDSet([3, 1, 2], buffer_size=2)
+        keys.add(5)
+        keys.remove(1)
+        self.assertIn(2, keys)
+        self.assertIn('2', keys)
+        self.assertNotIn(1, keys)
+        self.assertEqual(sorted(keys), [2, 3, 5])
+        with self.assertRaises(KeyError):
+            keys.remove(4)
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        keys = [('path-{num}'.format(num=num), num) for num in range(1000)]
+        bloom_filter = BloomFilter(len(keys))
+        bloom_filter.update(keys)
+        self.assertTrue(all(key in bloom_filter for key in keys))
+        self.assertEqual(len(bloom_filter), 1000)
+
+    def test_false_positive_rate(self):
+        bloom_filter = BloomFilter(10000, error_rate=0.01)
+        bloom_filter.update(range(10000))
+        false_positives = sum(key in bloom_filter for key in range(10000, 20000))
+        self.assertLess(false_positives, 200)
@@ -0,0 +1,95 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import create_pipeline, EndStage, ProcessPoolStage, Stage
+
+
+def square_and_pid(number):
+    return number * number, os.getpid()
+
+
+def square_all(numbers):
+    return [number * number for number in numbers]
+
+
+class FirstStage(Stage):
+
+    def __init__(self, items):
+        super().__init__()
+        self.items_to_put = items
+
+    async def run(self):
+        for item in self.items_to_put:
+            await self.put(item)
+
+
+class CollectingEndStage(EndStage):
+
+    async def __call__(self):
+        self.collected = [item async for item in self.items()]
+
+
+class TestProcessPoolStage(asynctest.TestCase):
+
+    async def test_map_in_processes(self):
+        end = CollectingEndStage()
+        stage = ProcessPoolStage(square_and_pid, max_workers=2)
+        await create_pipeline([FirstStage(range(20)), stage, end])
+
+        self.assertEqual([square for square, pid in end.collected], [n * n for n in range(20)])
+        self.assertNotIn(os.getpid(), [pid for square, pid in end.collected])
+
+    async def test_batches(self):
+        class Squares(ProcessPoolStage):
+            def prepare(self, item):
+                return item.number
+
+            def finish(self, item, result):
+                item.square = result
+                return item
+
+        end = CollectingEndStage()
+        items = [SimpleNamespace(number=n, does_batch=True) for n in range(10)]
+        await create_pipeline([FirstStage(items), Squares(square_all, batch=True, minsize=3), end])
+
+        self.assertEqual(end.collected, items)
+        self.assertEqual([item.square for item in items], [n * n for n in range(10)])
+
+    async def test_in_flight_is_bounded(self):
+        lock = threading.Lock()
+        running = 0
+        max_running = 0
+
+        def slow_identity(item):
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            time.sleep(0.01 if item % 2 else 0.02)
+            with lock:
+                running -= 1
+            return item
+
+        end = CollectingEndStage()
+        with ThreadPoolExecutor(10) as executor:
+            stage = ProcessPoolStage(slow_identity, max_in_flight=3, ordered=False,
+                                     executor=executor)
+            await asyncio.wait_for(create_pipeline([FirstStage(range(12)), stage, end]), 5)
+
+        self.assertEqual(max_running, 3)
+        self.assertCountEqual(end.collected, range(12))
+
+    async def test_own_pool_is_shut_down(self):
+        executor = mock.Mock(wraps=ThreadPoolExecutor(2))
+        with mock.patch('pulpcore.plugin.stages.process_pool.ProcessPoolExecutor',
+                        return_value=executor):
+            await create_pipeline([FirstStage(range(5)), ProcessPoolStage(abs), EndStage()])
+
+        executor.shutdown.assert_called_once_with()
@@ -0,0 +1,68 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, QueryExistingArtifacts
+
+
+def mock_artifact(pk=None, **digests):
+    fields = dict.fromkeys(Artifact.DIGEST_FIELDS)
+    fields.update(digests)
+    artifact = mock.Mock(pk=pk, DIGEST_FIELDS=Artifact.DIGEST_FIELDS, **fields)
+    artifact.q.return_value = mock.MagicMock(name='Q')
+    return artifact
+
+
+class TestQueryExistingArtifacts(asynctest.TestCase):
+
+    def setUp(self):
+        self.saved = mock_artifact(pk=1, sha256='abc')
+        patcher = mock.patch('pulpcore.plugin.stages.artifact_stages.Artifact')
+        self.addCleanup(patcher.stop)
+        self.objects = patcher.start().objects
+        self.objects.filter.return_value = [self.saved]
+        digests = self.objects.values_list.return_value
+        digests.count.return_value = 1
+        digests.iterator.return_value = ['abc']
+        patcher = mock.patch('pulpcore.plugin.stages.artifact_stages.Q')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    async def query(self, digests, **kwargs):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        d_contents = []
+        for digest in digests:
+            d_artifact = DeclarativeArtifact(artifact=mock_artifact(sha256=digest), url='http://a',
+                                             relative_path='a', remote=mock.Mock())
+            d_contents.append(DeclarativeContent(content=mock.Mock(), d_artifacts=[d_artifact]))
+            in_q.put_nowait(d_contents[-1])
+        in_q.put_nowait(None)
+        stage = QueryExistingArtifacts(**kwargs)
+        stage._connect(in_q, out_q)
+        await stage()
+        return [d_content.d_artifacts[0].artifact for d_content in d_contents]
+
+    async def test_existing_artifact(self):
+        artifacts = await self.query(['abc', 'def'])
+        self.assertIs(artifacts[0], self.saved)
+        self.assertIsNot(artifacts[1], self.saved)
+        self.objects.filter.assert_called_once_with(mock.ANY)
+
+    async def test_digest_filter_skips_new_artifacts(self):
+        artifacts = await self.query(['def', 'ghi'], digest_filter=True)
+        self.objects.values_list.assert_called_once_with('sha256', flat=True)
+        self.objects.filter.assert_not_called()
+        self.assertNotIn(self.saved, artifacts)
+
+    async def test_digest_filter_searches_probable_artifacts(self):
+        artifacts = await self.query(['abc', 'def'], digest_filter=True)
+        self.objects.filter.assert_called_once_with(mock.ANY)
+        self.assertIs(artifacts[0], self.saved)
+
+    def test_digest_filter_prefers_sha256(self):
+        stage = QueryExistingArtifacts(digest_filter=True)
+        self.assertFalse(stage._may_exist(mock_artifact(sha512='x', sha256='def', md5='y')))
+        self.objects.values_list.assert_called_once_with('sha256', flat=True)
@@ -0,0 +1,146 @@
+import asyncio
+import uuid
+
+import asynctest
+from django.db import models
+import mock
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, QueryUnchangedContents
+
+
+class MockContent:
+    """A content unit with a single `relative_path` natural key field."""
+
+    objects = None
+    _meta = mock.Mock(get_field={'relative_path': models.TextField(name='relative_path')}.get)
+    _meta.get_field('relative_path').set_attributes_from_name('relative_path')
+
+    def __init__(self, relative_path, pk=None):
+        self.pk = pk
+        self.relative_path = relative_path
+
+    @classmethod
+    def natural_key_fields(cls):
+        return ('relative_path',)
+
+
+class Rows(list):
+    """The rows of a `values_list()` queryset."""
+
+    def iterator(self):
+        return iter(self)
+
+
+def mock_artifact(**digests):
+    fields = dict.fromkeys(('size',) + Artifact.DIGEST_FIELDS)
+    fields.update(digests)
+    return mock.Mock(**fields)
+
+
+class TestQueryUnchangedContents(asynctest.TestCase):
+
+    def setUp(self):
+        self.new_version = mock.Mock()
+        self.remote = mock.Mock(pk=uuid.uuid4())
+        self.saved = MockContent('a.iso', pk=uuid.uuid4())
+        self.content_artifact = mock.Mock(
+            pk=uuid.uuid4(),
+            content_id=self.saved.pk,
+            relative_path='a.iso',
+            artifact=mock_artifact(size=3, sha256='abc'),
+        )
+        self.remote_artifact = mock_artifact(
+            size=3,
+            sha256='abc',
+            url='http://example.com/a.iso',
+            content_artifact_id=self.content_artifact.pk,
+            remote_id=self.remote.pk,
+        )
+
+        def values_list(*fields):
+            row = {'pk': self.saved.pk, 'relative_path': self.saved.relative_path}
+            return Rows([tuple(row[field] for field in fields)])
+
+        def filter(pk__in):
+            if pk__in is self.new_version.content:
+                contents = mock.Mock()
+                contents.count.return_value = 1
+                contents.values_list.side_effect = values_list
+                contents.filter.return_value = contents
+                return contents
+            return [self.saved]
+
+        MockContent.objects = mock.Mock()
+        MockContent.objects.filter.side_effect = filter
+
+        patcher = mock.patch('pulpcore.plugin.stages.content_stages.ContentArtifact')
+        self.addCleanup(patcher.stop)
+        patcher.start().objects.filter.return_value.select_related.return_value = [
+            self.content_artifact]
+        patcher = mock.patch('pulpcore.plugin.stages.content_stages.RemoteArtifact')
+        self.addCleanup(patcher.stop)
+        patcher.start().objects.filter.return_value = [self.remote_artifact]
+
+    def declare(self, relative_path='a.iso', url='http://example.com/a.iso', sha256='abc'):
+        d_artifact = DeclarativeArtifact(
+            artifact=mock_artifact(sha256=sha256),
+            url=url,
+            relative_path=relative_path,
+            remote=self.remote,
+        )
+        return DeclarativeContent(content=MockContent(relative_path), d_artifacts=[d_artifact])
+
+    async def query(self, d_content, download_artifacts=True):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        in_q.put_nowait(d_content)
+        in_q.put_nowait(None)
+        stage = QueryUnchangedContents(self.new_version, download_artifacts)
+        stage._connect(in_q, out_q)
+        await stage()
+        self.assertIs(out_q.get_nowait(), d_content)
+        return d_content
+
+    async def test_unchanged(self):
+        d_content = await self.query(self.declare())
+        self.assertTrue(d_content.unchanged)
+        self.assertIs(d_content.content, self.saved)
+        self.assertIs(d_content.d_artifacts[0].artifact, self.content_artifact.artifact)
+
+    async def test_new_natural_key(self):
+        d_content = await self.query(self.declare(relative_path='b.iso'))
+        self.assertFalse(d_content.unchanged)
+        self.assertEqual(MockContent.objects.filter.call_count, 1)
+
+    async def test_changed_url(self):
+        d_content = await self.query(self.declare(url='http://example.org/a.iso'))
+        self.assertFalse(d_content.unchanged)
+        self.assertIsNone(d_content.content.pk)
+
+    async def test_changed_digest(self):
+        d_content = await self.query(self.declare(sha256='def'))
+        self.assertFalse(d_content.unchanged)
+
+    async def test_missing_artifact(self):
+        self.content_artifact.artifact = None
+        d_content = await self.query(self.declare())
+        self.assertFalse(d_content.unchanged)
+
+    async def test_missing_artifact_without_download(self):
+        self.content_artifact.artifact = None
+        d_content = await self.query(self.declare(), download_artifacts=False)
+        self.assertTrue(d_content.unchanged)
+
+    async def test_unchanged_with_bloom_filter(self):
+        with mock.patch.object(QueryUnchangedContents, 'bloom_filter_threshold', 0):
+            d_content = await self.query(self.declare())
+        self.assertTrue(d_content.unchanged)
+        self.assertIs(d_content.content, self.saved)
+
+    async def test_new_natural_key_with_bloom_filter(self):
+        with mock.patch.object(QueryUnchangedContents, 'bloom_filter_threshold', 0):
+            d_content = await self.query(self.declare(relative_path='b.iso'))
+        self.assertFalse(d_content.unchanged)
+        self.assertEqual(MockContent.objects.filter.call_count, 1)
+        MockContent.objects.filter.return_value.filter.assert_not_called()
@@ -0,0 +1,194 @@
+import asyncio
+import uuid
+
+import asynctest
+from django.db import connection, models
+from django.db.models import Q
+import mock
+
+from pulpcore.plugin.stages import DeclarativeContent, RemoveDuplicates
+
+
+def make_field(field_class, name):
+    field = field_class()
+    field.set_attributes_from_name(name)
+    return field
+
+
+class MockContent:
+    """A content unit with a single `relative_path` uniqueness field."""
+
+    objects = None
+    _meta = mock.Mock(
+        db_table='mock_content',
+        pk=make_field(models.UUIDField, 'content_ptr_id'),
+        get_field={'relative_path': make_field(models.TextField, 'relative_path')}.get,
+    )
+
+    def __init__(self, relative_path):
+        self.pk = uuid.uuid4()
+        self.relative_path = relative_path
+
+
+class OtherMockContent:
+    """A content unit of a type the stage doesn't handle."""
+
+    def __init__(self, relative_path):
+        self.pk = uuid.uuid4()
+        self.relative_path = relative_path
+
+
+def q_size(q):
+    """Return the number of leaf clauses in the Q object `q`."""
+    return sum(q_size(child) if isinstance(child, Q) else 1 for child in q.children)
+
+
+class RemoveDuplicatesTestCase(asynctest.TestCase):
+
+    vendor = None
+
+    def setUp(self):
+        patcher = mock.patch('pulpcore.plugin.stages.association_stages.connection.vendor',
+                             self.vendor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        MockContent.objects = mock.Mock()
+        self.new_version = mock.Mock()
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        self.stage = RemoveDuplicates(self.new_version, MockContent, ['relative_path'])
+        self.stage._connect(self.in_q, self.out_q)
+
+    def queue_batch(self, size, model=MockContent):
+        for i in range(size):
+            content = model('path/{}'.format(uuid.uuid4()))
+            self.in_q.put_nowait(DeclarativeContent(content=content))
+
+
+class TestRemoveDuplicates(RemoveDuplicatesTestCase):
+
+    vendor = 'sqlite'
+
+    async def test_query_size_per_batch_is_constant(self):
+        self.queue_batch(50)
+        stage_task = self.loop.create_task(self.stage())
+        await asyncio.sleep(0)
+        self.assertEqual(self.out_q.qsize(), 50)
+        self.queue_batch(50)
+        self.in_q.put_nowait(None)
+        await stage_task
+
+        filter_calls = MockContent.objects.filter.call_args_list
+        self.assertEqual(len(filter_calls), 2)
+        q_sizes = [q_size(args[0]) for args, kwargs in filter_calls]
+        self.assertEqual(q_sizes, [100, 100])
+        self.assertEqual(self.new_version.remove_content.call_count, 2)
+        self.assertEqual(self.out_q.qsize(), 101)
+
+    async def test_unit_pks_are_excluded(self):
+        self.queue_batch(2)
+        self.in_q.put_nowait(None)
+        await self.stage()
+
+        units = [self.out_q.get_nowait().content for i in range(2)]
+        expected = Q()
+        for unit in units:
+            expected |= Q(relative_path=unit.relative_path) & ~Q(pk=unit.pk)
+        MockContent.objects.filter.assert_called_once_with(expected)
+
+    async def test_conflicting_units_in_batch_are_collapsed(self):
+        first = MockContent('same/path')
+        last = MockContent('same/path')
+        other = MockContent('other/path')
+        for content in (first, other, last):
+            self.in_q.put_nowait(DeclarativeContent(content=content))
+        self.in_q.put_nowait(None)
+        await self.stage()
+
+        expected = Q()
+        for unit in (last, other):
+            expected |= Q(relative_path=unit.relative_path) & ~Q(pk=unit.pk)
+        MockContent.objects.filter.assert_called_once_with(expected)
+        passed = [self.out_q.get_nowait().content for i in range(2)]
+        self.assertEqual(passed, [other, last])
+        self.assertIsNone(self.out_q.get_nowait())
+
+    async def test_batch_without_model_units(self):
+        self.queue_batch(3, model=OtherMockContent)
+        self.in_q.put_nowait(None)
+        await self.stage()
+
+        MockContent.objects.filter.assert_not_called()
+        self.new_version.remove_content.assert_not_called()
+        self.assertEqual(self.out_q.qsize(), 4)
+
+
+class TestRemoveDuplicatesValuesJoin(RemoveDuplicatesTestCase):
+
+    vendor = 'postgresql'
+
+    def prep_params(self, units):
+        """Return the database values of the VALUES rows of `units`."""
+        pk_field = MockContent._meta.pk
+        field = MockContent._meta.get_field('relative_path')
+        params = []
+        for unit in units:
+            params.append(pk_field.get_db_prep_value(unit.pk, connection))
+            params.append(field.get_db_prep_value(unit.relative_path, connection))
+        return params
+
+    def removed_raw_sql(self):
+        """Return the RawSQL subqueries of all querysets passed to `remove_content`."""
+        return [args[0].query.where.children[0].rhs
+                for args, kwargs in self.new_version.remove_content.call_args_list]
+
+    async def test_one_values_join_per_batch(self):
+        self.queue_batch(50)
+        stage_task = self.loop.create_task(self.stage())
+        await asyncio.sleep(0)
+        self.queue_batch(50)
+        self.in_q.put_nowait(None)
+        await stage_task
+
+        MockContent.objects.filter.assert_not_called()
+        raw_sqls = self.removed_raw_sql()
+        self.assertEqual(len(raw_sqls), 2)
+        for raw_sql in raw_sqls:
+            self.assertEqual(raw_sql.sql.count('VALUES'), 1)
+            self.assertEqual(raw_sql.sql.count('(%s, %s)'), 50)
+            self.assertEqual(len(raw_sql.params), 100)
+        self.assertEqual(raw_sqls[0].sql, raw_sqls[1].sql)
+
+    async def test_values_join_params(self):
+        self.queue_batch(2)
+        self.in_q.put_nowait(None)
+        await self.stage()
+
+        units = [self.out_q.get_nowait().content for i in range(2)]
+        raw_sql, = self.removed_raw_sql()
+        self.assertIn('INNER JOIN (VALUES (%s, %s), (%s, %s)) AS batch (pk, f0)', raw_sql.sql)
+        self.assertIn('"relative_path" = batch.f0', raw_sql.sql)
+        self.assertIn('"content_ptr_id" <> batch.pk', raw_sql.sql)
+        self.assertEqual(raw_sql.params, self.prep_params(units))
+
+    async def test_conflicting_units_in_batch_are_collapsed(self):
+        first = MockContent('same/path')
+        last = MockContent('same/path')
+        self.in_q.put_nowait(DeclarativeContent(content=first))
+        self.in_q.put_nowait(DeclarativeContent(content=last))
+        self.in_q.put_nowait(None)
+        await self.stage()
+
+        raw_sql, = self.removed_raw_sql()
+        self.assertIn('(VALUES (%s, %s)) AS batch', raw_sql.sql)
+        self.assertEqual(raw_sql.params, self.prep_params([last]))
+        self.assertIs(self.out_q.get_nowait().content, last)
+        self.assertIsNone(self.out_q.get_nowait())
+
+    async def test_null_values_use_or_query(self):
+        self.in_q.put_nowait(DeclarativeContent(content=MockContent(None)))
+        self.queue_batch(1)
+        self.in_q.put_nowait(None)
+        await self.stage()
+
+        MockContent.objects.filter.assert_called_once()
@@ -0,0 +1,124 @@
+import os
+
+import asynctest
+import mock
+
+from pulpcore.plugin.models import ProgressBar
+from pulpcore.plugin.stages import (
+    create_pipeline,
+    DeclarativeContent,
+    download_share,
+    EndStage,
+    natural_key_shard,
+    ShardedStages,
+    Stage,
+)
+
+
+class Unit:
+    """A picklable stand-in for a content unit."""
+
+    def __init__(self, name):
+        self.name = name
+        self.pk = None
+
+    def natural_key(self):
+        return (self.name,)
+
+
+class FirstStage(Stage):
+
+    def __init__(self, names, unchanged=()):
+        super().__init__()
+        self.names = names
+        self.unchanged = unchanged
+
+    async def run(self):
+        for name in self.names:
+            d_content = DeclarativeContent(content=Unit(name))
+            d_content.unchanged = name in self.unchanged
+            await self.put(d_content)
+
+
+class SaveStage(Stage):
+    """Record the process handling each unit in its pk, like saving it."""
+
+    async def run(self):
+        async for d_content in self.items():
+            d_content.content.pk = os.getpid()
+            await self.put(d_content)
+
+
+class ProgressStage(Stage):
+    """Count the units of each shard in a progress bar."""
+
+    async def run(self):
+        with ProgressBar(message='Saving units') as progress_bar:
+            async for d_content in self.items():
+                progress_bar.increment()
+                await self.put(d_content)
+
+
+class FailingStage(Stage):
+
+    async def run(self):
+        async for d_content in self.items():
+            raise ValueError('broken unit')
+
+
+class CollectingEndStage(EndStage):
+
+    async def __call__(self):
+        self.d_contents = [d_content async for d_content in self.items()]
+
+
+class TestShardedStages(asynctest.TestCase):
+
+    async def test_units_are_handled_by_their_shard(self):
+        names = ['unit-{num}'.format(num=num) for num in range(50)]
+        end = CollectingEndStage()
+        await create_pipeline([
+            FirstStage(names, unchanged=['unit-0']),
+            ShardedStages(3, lambda: [SaveStage()]),
+            end,
+        ])
+
+        self.assertCountEqual([d_content.content.name for d_content in end.d_contents], names)
+        pids = {}
+        for d_content in end.d_contents:
+            if d_content.content.name == 'unit-0':
+                self.assertIsNone(d_content.content.pk)
+                continue
+            self.assertNotEqual(d_content.content.pk, os.getpid())
+            pids.setdefault(natural_key_shard(d_content, 3), set()).add(d_content.content.pk)
+        self.assertEqual(len(pids), 3)
+        self.assertEqual(len(set.union(*pids.values())), 3)
+        self.assertTrue(all(len(shard_pids) == 1 for shard_pids in pids.values()))
+
+    async def test_failing_shard(self):
+        with self.assertRaisesRegex(RuntimeError, 'broken unit'):
+            await create_pipeline([
+                FirstStage(['a', 'b', 'c']),
+                ShardedStages(2, lambda: [FailingStage()]),
+                EndStage(),
+            ])
+
+    async def test_progress_is_summed_up(self):
+        names = ['unit-{num}'.format(num=num) for num in range(20)]
+        progress_bar = mock.MagicMock()
+        progress_bar.__enter__.return_value = progress_bar
+        with mock.patch('pulpcore.plugin.stages.sharding.ProgressBar',
+                        return_value=progress_bar) as progress_bar_class:
+            await create_pipeline([
+                FirstStage(names),
+                ShardedStages(3, lambda: [ProgressStage()]),
+                EndStage(),
+            ])
+        progress_bar_class.assert_called_once_with(message='Saving units')
+        self.assertEqual(progress_bar.done, 20)
+        self.assertEqual(progress_bar.total, 20)
+        self.assertEqual(progress_bar.__exit__.call_args[0][-3:], (None, None, None))
+
+    def test_download_share(self):
+        self.assertEqual([download_share(10, num, 3) for num in range(3)], [4, 3, 3])
+        self.assertEqual([download_share(2, num, 3) for num in range(3)], [1, 1, 1])
@@ -1,9 +1,28 @@
 import asyncio
+import functools
+import warnings
 
 import asynctest
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.test import override_settings
 import mock
 
-from pulpcore.plugin.stages import Stage, EndStage
+from pulpcore.plugin.stages import (
+    ArtifactDownloader,
+    create_pipeline,
+    DeclarativeContent,
+    EndStage,
+    Stage,
+)
+
+from .simulation import (
+    constant,
+    RecordingEndStage,
+    SimulatedDatabase,
+    SimulatedDownloaders,
+    SimulatedQueryStage,
+    SimulationTestCase,
+)
 
 
 class TestStage(asynctest.TestCase):
@@ -58,6 +77,42 @@ class TestStage(asynctest.TestCase):
             await batch_it.__anext__()
 
 
+class TestSkipUnchanged(asynctest.TestCase):
+
+    class SkippingStage(Stage):
+        skip_unchanged = True
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        self.stage = self.SkippingStage()
+        self.stage._connect(self.in_q, self.out_q)
+        self.changed = mock.Mock(does_batch=True, unchanged=False)
+        self.unchanged = mock.Mock(does_batch=True, unchanged=True)
+        self.in_q.put_nowait(self.changed)
+        self.in_q.put_nowait(self.unchanged)
+        self.in_q.put_nowait(None)
+
+    async def test_batches(self):
+        batches = [batch async for batch in self.stage.batches(minsize=1)]
+        self.assertEqual(batches, [[self.changed]])
+        self.assertIs(self.out_q.get_nowait(), self.unchanged)
+
+    async def test_items(self):
+        items = [item async for item in self.stage.items()]
+        self.assertEqual(items, [self.changed])
+        self.assertIs(self.out_q.get_nowait(), self.unchanged)
+
+    async def test_only_unchanged(self):
+        self.in_q = asyncio.Queue()
+        self.stage._connect(self.in_q, self.out_q)
+        self.in_q.put_nowait(self.unchanged)
+        self.in_q.put_nowait(None)
+        batches = [batch async for batch in self.stage.batches(minsize=1)]
+        self.assertEqual(batches, [])
+        self.assertIs(self.out_q.get_nowait(), self.unchanged)
+
+
 class TestMultipleStages(asynctest.TestCase):
 
     class FirstStage(Stage):
@@ -122,3 +177,227 @@ class TestMultipleStages(asynctest.TestCase):
                         first_stage(),
                         end_stage(),
                     )
+
+
+class SizedItem:
+
+    def __init__(self, size):
+        self.size = size
+        self.does_batch = True
+
+    def approximate_size(self):
+        return self.size
+
+
+class TestByteBudget(asynctest.TestCase):
+
+    class Producer(Stage):
+        def __init__(self, sizes):
+            super().__init__()
+            self.sizes = sizes
+            self.produced = 0
+
+        async def run(self):
+            for size in self.sizes:
+                await self.put(SizedItem(size))
+                self.produced += 1
+
+    class Holder(Stage):
+        """Hold all items until `release` is set."""
+
+        def __init__(self):
+            super().__init__()
+            self.held = []
+            self.release = asyncio.Event()
+
+        async def run(self):
+            flusher = asyncio.ensure_future(self.flush())
+            async for item in self.items():
+                if self.release.is_set():
+                    await self.put(item)
+                else:
+                    self.held.append(item)
+            await flusher
+
+        async def flush(self):
+            await self.release.wait()
+            while self.held:
+                await self.put(self.held.pop(0))
+
+    async def run_pipeline(self, sizes, max_bytes):
+        producer = self.Producer(sizes)
+        holder = self.Holder()
+        pipeline = asyncio.ensure_future(
+            create_pipeline([producer, holder, EndStage()], maxsize=100, max_bytes=max_bytes)
+        )
+        for i in range(10):
+            await asyncio.sleep(0)
+        produced = producer.produced
+        holder.release.set()
+        await pipeline
+        return produced, producer.produced
+
+    async def test_producer_waits_for_budget(self):
+        produced, total = await self.run_pipeline([100] * 10, max_bytes=300)
+        self.assertEqual(produced, 3)
+        self.assertEqual(total, 10)
+
+    async def test_without_budget(self):
+        produced, total = await self.run_pipeline([100] * 10, max_bytes=None)
+        self.assertEqual(produced, 10)
+
+    async def test_oversized_item_is_admitted(self):
+        produced, total = await self.run_pipeline([1000, 100], max_bytes=300)
+        self.assertEqual(produced, 1)
+        self.assertEqual(total, 2)
+
+    async def test_budget_is_released_when_items_leave(self):
+        items = [SizedItem(100) for i in range(10)]
+        kept = []
+
+        class Producer(Stage):
+            async def run(self):
+                for item in items:
+                    await self.put(item)
+
+        class Keeper(Stage):
+            """Keep a reference to every item, so only the explicit release frees the budget."""
+
+            async def run(self):
+                async for item in self.items():
+                    kept.append(item)
+                    await self.put(item)
+
+        await asyncio.wait_for(
+            create_pipeline([Producer(), Keeper(), EndStage()], max_bytes=300), 1)
+        self.assertEqual(len(kept), 10)
+
+    async def test_batches_do_not_wait_for_exhausted_budget(self):
+        batch_sizes = []
+
+        class Batcher(Stage):
+            async def run(self):
+                async for batch in self.batches(minsize=50):
+                    batch_sizes.append(len(batch))
+                    for item in batch:
+                        await self.put(item)
+
+        await asyncio.wait_for(create_pipeline(
+            [self.Producer([100] * 10), Batcher(), EndStage()], max_bytes=300), 1)
+        self.assertEqual(sum(batch_sizes), 10)
+        self.assertLessEqual(max(batch_sizes), 3)
+
+    def test_declarative_content_size(self):
+        content = mock.Mock()
+        small = DeclarativeContent(content=content)
+        large = DeclarativeContent(content=content, extra_data={'metadata': 'x' * 10000})
+        self.assertGreater(large.approximate_size() - small.approximate_size(), 10000)
+
+
+class FakeConnection:
+    """A database connection running queries through its execute wrappers."""
+
+    execute_wrapper = BaseDatabaseWrapper.execute_wrapper
+
+    def __init__(self):
+        self.execute_wrappers = []
+
+    def query(self, rows):
+        executor = mock.Mock()
+        for wrapper in reversed(self.execute_wrappers):
+            executor = functools.partial(wrapper, executor)
+        executor('SELECT 1', None, False, {'cursor': mock.Mock(rowcount=rows)})
+
+
+class TestQueryInstrumentation(asynctest.TestCase):
+
+    class QueryingStage(Stage):
+        def __init__(self, connection, queries):
+            super().__init__()
+            self.connection = connection
+            self.queries = queries
+
+        async def run(self):
+            for rows in self.queries:
+                self.connection.query(rows)
+                await asyncio.sleep(0)
+
+    def setUp(self):
+        self.connection = FakeConnection()
+        patcher = mock.patch('pulpcore.plugin.stages.api.connection', self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def run_pipeline(self):
+        self.stages = [
+            self.QueryingStage(self.connection, [1, 2, 3]),
+            self.QueryingStage(self.connection, [10, -1]),
+            EndStage(),
+        ]
+        with mock.patch('pulpcore.plugin.stages.profiler.ProgressBar') as progress_bar:
+            await create_pipeline(self.stages)
+        return progress_bar
+
+    async def test_queries_are_attributed_to_stages(self):
+        with override_settings(PROFILE_STAGES_API_QUERIES=True):
+            progress_bar = await self.run_pipeline()
+
+        counts = [(stage.query_stats.count, stage.query_stats.rows) for stage in self.stages]
+        self.assertEqual(counts, [(3, 6), (2, 10), (0, 0)])
+        self.assertEqual(self.connection.execute_wrappers, [])
+        self.assertEqual(progress_bar.call_count, 3)
+        report = progress_bar.call_args_list[1][1]
+        self.assertEqual(report['message'], 'Queries of stage 1 (QueryingStage)')
+        self.assertEqual(report['done'], 2)
+        progress_bar.return_value.save.assert_called()
+
+    async def test_no_deprecation_warnings(self):
+        with override_settings(PROFILE_STAGES_API_QUERIES=True):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                await self.run_pipeline()
+
+        categories = [warning.category for warning in caught]
+        self.assertNotIn(DeprecationWarning, categories)
+        self.assertNotIn(PendingDeprecationWarning, categories)
+
+    async def test_disabled_by_default(self):
+        progress_bar = await self.run_pipeline()
+
+        self.assertIsNone(self.stages[0].query_stats)
+        progress_bar.assert_not_called()
+
+
+class TestSimulatedPipeline(SimulationTestCase):
+
+    class FirstStage(Stage):
+        def __init__(self, contents):
+            super().__init__()
+            self.contents = contents
+
+        async def run(self):
+            for d_content in self.contents:
+                await self.put(d_content)
+
+    @mock.patch('pulpcore.plugin.stages.artifact_stages.ProgressBar')
+    async def test_queries_block_downloads(self, pb):
+        downloaders = SimulatedDownloaders(latency=constant(1))
+        database = SimulatedDatabase(self, latency=constant(0.5))
+        query_stage = SimulatedQueryStage(database, minsize=1)
+        end_stage = RecordingEndStage()
+        contents = [self.make_content(downloaders, delays=[1]) for i in range(100)]
+        pipeline = self.loop.create_task(create_pipeline([
+            self.FirstStage(contents),
+            ArtifactDownloader(max_concurrent_content=10),
+            query_stage,
+            end_stage,
+        ]))
+        while not pipeline.done():
+            await self.advance(0.1)
+        pipeline.result()
+
+        self.assertEqual(downloaders.max_running, 10)
+        # Downloads finishing together are queried in one batch...
+        self.assertEqual(query_stage.batch_sizes, [10] * 10)
+        # ...but no download makes progress while the database blocks the event loop.
+        self.assertEqual(end_stage.times[-1], 10 * 1 + 10 * 0.5)
@@ -0,0 +1,107 @@
+import asyncio
+import gzip
+import os
+import tempfile
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import (
+    decompress,
+    iterparse,
+    read_chunks,
+    read_lines,
+    StreamingStage,
+)
+
+
+async def as_chunks(data, chunk_size):
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+async def collect(aiterable):
+    return [item async for item in aiterable]
+
+
+class TestHelpers(asynctest.TestCase):
+
+    async def test_read_chunks(self):
+        with tempfile.NamedTemporaryFile() as f_handle:
+            f_handle.write(b'x' * 10)
+            f_handle.flush()
+            chunks = await collect(read_chunks(f_handle.name, chunk_size=4))
+        self.assertEqual(chunks, [b'xxxx', b'xxxx', b'xx'])
+
+    async def test_read_lines(self):
+        lines = await collect(read_lines(as_chunks(b'one\r\ntwo\n\nthree', 3)))
+        self.assertEqual(lines, ['one', 'two', '', 'three'])
+
+    async def test_decompress(self):
+        data = os.urandom(1000)
+        chunks = await collect(decompress(as_chunks(gzip.compress(data), 7)))
+        self.assertEqual(b''.join(chunks), data)
+
+    async def test_iterparse(self):
+        xml = b'<metadata><packages>' + b''.join(
+            '<package><name>p{}</name></package>'.format(i).encode() for i in range(100)
+        ) + b'</packages></metadata>'
+        names = []
+        parents = []
+        async for element in iterparse(as_chunks(xml, 10), 'package'):
+            names.append(element.findtext('name'))
+            parents.append(element)
+        self.assertEqual(names, ['p{}'.format(i) for i in range(100)])
+        self.assertTrue(all(len(element) == 0 for element in parents))
+
+
+class ListStage(StreamingStage):
+
+    def __init__(self, items, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.items_ = items
+        self.produced = 0
+
+    async def stream(self):
+        for item in self.items_:
+            if isinstance(item, Exception):
+                raise item
+            self.produced += 1
+            yield item
+
+
+class TestStreamingStage(asynctest.TestCase):
+
+    async def test_lookahead_is_bounded(self):
+        out_q = asyncio.Queue(maxsize=2)
+        stage = ListStage([mock.Mock() for i in range(20)], lookahead=3)
+        stage._connect(None, out_q)
+        stage_task = self.loop.create_task(stage())
+        for i in range(5):
+            await asyncio.sleep(0)
+        # 2 items in out_q, 1 waiting to be put into it, 3 in the lookahead queue and 1 waiting to
+        # be put into it
+        self.assertEqual(stage.produced, 7)
+
+        received = []
+        while True:
+            item = await out_q.get()
+            if item is None:
+                break
+            received.append(item)
+        await stage_task
+        self.assertEqual(received, stage.items_)
+
+    async def test_exception(self):
+        out_q = asyncio.Queue()
+        stage = ListStage([mock.Mock(), ValueError()])
+        stage._connect(None, out_q)
+        with self.assertRaises(ValueError):
+            await stage()
+        self.assertEqual(out_q.qsize(), 1)
+
+    async def test_not_implemented(self):
+        stage = StreamingStage()
+        stage._connect(None, asyncio.Queue())
+        with self.assertRaises(NotImplementedError):
+            await stage()
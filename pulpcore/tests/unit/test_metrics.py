@@ -0,0 +1,114 @@
+import os
+import tempfile
+
+import asynctest
+from django.test import override_settings
+
+from pulpcore.plugin import metrics
+from pulpcore.plugin.download import BaseDownloader, DownloadResult
+from pulpcore.plugin.stages import create_pipeline, EndStage, Stage
+
+
+class TestRegistry(asynctest.TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('items', 'Items seen.', ('stage',), registry=registry)
+        gauge = metrics.Gauge('running', 'Running "things".', registry=registry)
+        histogram = metrics.Histogram('sizes', 'Sizes.', buckets=(1, 10), registry=registry)
+        counter.labels('b').inc(2)
+        counter.labels('a').inc()
+        gauge.inc(3)
+        gauge.dec()
+        for size in (1, 5, 50):
+            histogram.labels().observe(size)
+
+        self.assertEqual(registry.render({'worker': 'w1'}).splitlines(), [
+            '# TYPE items counter',
+            '# HELP items Items seen.',
+            'items_total{stage="a",worker="w1"} 1',
+            'items_total{stage="b",worker="w1"} 2',
+            '# TYPE running gauge',
+            '# HELP running Running \\"things\\".',
+            'running{worker="w1"} 2',
+            '# TYPE sizes histogram',
+            '# HELP sizes Sizes.',
+            'sizes_bucket{le="1",worker="w1"} 1',
+            'sizes_bucket{le="10",worker="w1"} 2',
+            'sizes_bucket{le="+Inf",worker="w1"} 3',
+            'sizes_count{worker="w1"} 3',
+            'sizes_sum{worker="w1"} 56',
+            '# EOF',
+        ])
+
+    def test_wrong_labels(self):
+        counter = metrics.Counter('items', 'Items seen.', ('stage',), registry=metrics.Registry())
+        with self.assertRaises(ValueError):
+            counter.labels()
+
+
+class TestPipelineMetrics(asynctest.TestCase):
+
+    class Producer(Stage):
+        async def run(self):
+            for i in range(5):
+                await self.put(asynctest.Mock(does_batch=True))
+
+    class Batcher(Stage):
+        async def run(self):
+            async for batch in self.batches(minsize=5):
+                for item in batch:
+                    await self.put(item)
+
+    async def test_stage_metrics_are_exported(self):
+        out = metrics.STAGE_ITEMS_OUT.labels('1', 'Batcher')
+        items_in = metrics.STAGE_ITEMS_IN.labels('1', 'Batcher')
+        batch_size = metrics.STAGE_BATCH_SIZE.labels('1', 'Batcher')
+        before = out.value, items_in.value, batch_size.count
+
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(METRICS_TEXTFILE_DIRECTORY=directory), \
+                    asynctest.patch.object(metrics.TextfileExporter, 'remove',
+                                           autospec=True) as remove:
+                await create_pipeline([self.Producer(), self.Batcher(), EndStage()])
+            exporter, = remove.call_args[0]
+            exporter.write()
+            path, = [os.path.join(directory, name) for name in os.listdir(directory)]
+            self.assertTrue(path.endswith('.prom'))
+            with open(path) as f_handle:
+                text = f_handle.read()
+
+        self.assertEqual((out.value, items_in.value, batch_size.count),
+                         (before[0] + 5, before[1] + 5, before[2] + 1))
+        self.assertIn('pulp_stage_items_out_total{num="1",stage="Batcher",worker="', text)
+        self.assertIn('pulp_stage_queue_depth{num="2",stage="EndStage",worker="', text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+    async def test_file_is_removed_when_finished(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(METRICS_TEXTFILE_DIRECTORY=directory):
+                await create_pipeline([self.Producer(), self.Batcher(), EndStage()])
+            self.assertEqual(os.listdir(directory), [])
+
+
+class TestDownloadMetrics(asynctest.TestCase):
+
+    class ChunkDownloader(BaseDownloader):
+        async def _run(self, extra_data=None):
+            self.active = metrics.DOWNLOADS_ACTIVE.labels().value
+            for chunk in self.url:
+                await self.handle_data(chunk)
+            await self.finalize()
+            return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
+                                  url=self.url, headers=None)
+
+    async def test_download_bytes(self):
+        bytes_before = metrics.DOWNLOAD_BYTES.labels().value
+        active_before = metrics.DOWNLOADS_ACTIVE.labels().value
+        with tempfile.NamedTemporaryFile() as f_handle:
+            downloader = self.ChunkDownloader([b'abc', b'de'], custom_file_object=f_handle)
+            await downloader.run()
+
+        self.assertEqual(downloader.active, active_before + 1)
+        self.assertEqual(metrics.DOWNLOADS_ACTIVE.labels().value, active_before)
+        self.assertEqual(metrics.DOWNLOAD_BYTES.labels().value, bytes_before + 5)
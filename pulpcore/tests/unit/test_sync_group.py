@@ -0,0 +1,184 @@
+import asyncio
+from unittest import mock
+
+import asynctest
+
+from pulpcore.plugin.tasking import SyncGroup
+
+
+class FakeRedis:
+    """The key commands of the sync group."""
+
+    def __init__(self):
+        self.keys = {}
+
+    def set(self, key, value, nx=False, ex=None, px=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = str(value).encode()
+        return True
+
+    def register_script(self, script):
+        def release_or_refresh(keys, args):
+            if self.keys.get(keys[0]) != args[0].encode():
+                return 0
+            if 'del' in script:
+                del self.keys[keys[0]]
+            return 1
+        return release_or_refresh
+
+    def get(self, key):
+        return self.keys.get(key)
+
+    def delete(self, key):
+        self.keys.pop(key, None)
+
+    def hmset(self, key, mapping):
+        self.keys[key] = {name.encode(): str(value).encode() for name, value in mapping.items()}
+
+    def hgetall(self, key):
+        return self.keys.get(key, {})
+
+    def rpush(self, key, value):
+        self.keys.setdefault(key, []).append(value.encode())
+
+    def lrange(self, key, start, end):
+        return self.keys.get(key, [])
+
+    def expire(self, key, seconds):
+        pass
+
+
+class TestSyncGroup(asynctest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('pulpcore.plugin.tasking.get_redis_connection',
+                             return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(SyncGroup._claims.clear)
+
+    def tearDown(self):
+        if SyncGroup._refresher is not None:
+            SyncGroup._refresher.cancel()
+
+    @mock.patch('pulpcore.plugin.tasking.get_current_job')
+    @mock.patch('pulpcore.plugin.tasking.enqueue_with_reservation')
+    def test_members_find_their_group(self, enqueue_with_reservation, get_current_job):
+        group = SyncGroup(downloads_per_host=3, poll_interval=0.5)
+        job = group.enqueue(mock.sentinel.func, ['repository'], kwargs={'a': 1})
+
+        enqueue_with_reservation.assert_called_once_with(
+            mock.sentinel.func, ['repository'], args=None, kwargs={'a': 1},
+            options={'meta': {'sync_group': group.group_id}})
+        self.assertEqual(group.member_job_ids(), [str(job.id)])
+
+        get_current_job.return_value = mock.Mock(meta={'sync_group': group.group_id})
+        current = SyncGroup.current()
+        self.assertEqual((current.group_id, current.downloads_per_host, current.poll_interval),
+                         (group.group_id, 3, 0.5))
+
+        self.redis.hgetall = mock.Mock()
+        get_current_job.return_value = mock.Mock(meta={})
+        self.assertIsNone(SyncGroup.current())
+        self.redis.hgetall.assert_not_called()
+
+    def test_semaphore_per_host(self):
+        group = SyncGroup()
+        remote = mock.Mock(url='https://example.com/repo/', download_concurrency=5)
+        semaphore = group.semaphore(remote)
+
+        self.assertEqual(semaphore.value, 5)
+        self.assertIs(group.semaphore(mock.Mock(url='https://example.com/other/')), semaphore)
+        other_host = mock.Mock(url='https://example.org/', download_concurrency=5)
+        self.assertIsNot(group.semaphore(other_host), semaphore)
+
+    def declared(self, sha256='abc', download=None):
+        d_artifact = mock.Mock()
+        d_artifact.artifact.sha256 = sha256
+        d_artifact.download = download or asynctest.CoroutineMock()
+        return d_artifact
+
+    def claim_key(self, group, sha256='abc'):
+        return 'pulp:sync-group:{id}:artifact:{sha256}'.format(id=group.group_id, sha256=sha256)
+
+    @asynctest.patch('pulpcore.plugin.tasking.models.Artifact.objects')
+    async def test_artifact_is_downloaded_once(self, artifact_objects):
+        artifact_objects.filter.return_value.first.return_value = None
+        saved = mock.Mock()
+        artifact_objects.bulk_get_or_create.return_value = [saved]
+        group = SyncGroup(poll_interval=0.001)
+        downloads = []
+
+        async def download():
+            downloads.append(None)
+            await asyncio.sleep(0.01)
+        d_artifacts = [self.declared(download=download) for i in range(3)]
+        await asyncio.gather(*[group.download(d_artifact) for d_artifact in d_artifacts])
+
+        self.assertEqual(len(downloads), 1)
+        self.assertEqual([d_artifact.artifact for d_artifact in d_artifacts], [saved] * 3)
+        artifact_objects.filter.assert_called_with(sha256='abc')
+
+    @asynctest.patch('pulpcore.plugin.tasking.models.Artifact.objects')
+    async def test_failed_download_is_taken_over(self, artifact_objects):
+        artifact_objects.filter.return_value.first.return_value = None
+        artifact_objects.bulk_get_or_create.return_value = [mock.Mock()]
+        group = SyncGroup(poll_interval=0.001)
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError()
+        failing = self.declared(download=fail)
+        waiting = self.declared()
+
+        failing_download = asyncio.ensure_future(group.download(failing))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(group.download(waiting), 1)
+
+        waiting.download.assert_called_once_with()
+        with self.assertRaises(ValueError):
+            await failing_download
+
+    @asynctest.patch('pulpcore.plugin.tasking.models.Artifact.objects')
+    async def test_claim_is_released_once_saved(self, artifact_objects):
+        artifact_objects.filter.return_value.first.return_value = None
+        saved = mock.Mock()
+        artifact_objects.bulk_get_or_create.return_value = [saved]
+        group = SyncGroup(poll_interval=0.001)
+        downloaded = self.declared()
+
+        await group.download(downloaded)
+
+        self.assertIs(downloaded.artifact, saved)
+        self.assertNotIn(self.claim_key(group), self.redis.keys)
+        self.assertEqual(SyncGroup._claims, {})
+
+    @asynctest.patch('pulpcore.plugin.tasking.models.Artifact.objects')
+    async def test_expired_claim_is_taken_over(self, artifact_objects):
+        artifact_objects.filter.return_value.first.return_value = None
+        artifact_objects.bulk_get_or_create.return_value = [mock.Mock()]
+        group = SyncGroup(poll_interval=0.001)
+        self.redis.keys[self.claim_key(group)] = b'killed member'
+        waiting = self.declared()
+
+        download = asyncio.ensure_future(group.download(waiting))
+        await asyncio.sleep(0.01)
+        waiting.download.assert_not_called()
+
+        del self.redis.keys[self.claim_key(group)]  # the lease expired
+        await asyncio.wait_for(download, 1)
+        waiting.download.assert_called_once_with()
+
+    @asynctest.patch('pulpcore.plugin.tasking.models.Artifact.objects')
+    async def test_wait_is_bounded(self, artifact_objects):
+        artifact_objects.filter.return_value.first.return_value = None
+        group = SyncGroup(poll_interval=0.001, max_wait=0.01)
+        self.redis.keys[self.claim_key(group)] = b'stuck member'
+        waiting = self.declared()
+
+        await asyncio.wait_for(group.download(waiting), 1)
+
+        waiting.download.assert_called_once_with()
+        artifact_objects.bulk_get_or_create.assert_not_called()
@@ -0,0 +1,51 @@
+from unittest import TestCase, mock
+
+from pulpcore.app.models import Task
+from pulpcore.plugin.tasking import NonFatalErrorCollector
+
+
+@mock.patch('pulpcore.plugin.tasking.models.Task.objects')
+@mock.patch('pulpcore.plugin.tasking.get_current_job')
+class TestNonFatalErrorCollector(TestCase):
+
+    def saved_errors(self, objects):
+        return objects.filter.return_value.update.call_args[1]['non_fatal_errors']
+
+    def test_errors_are_aggregated(self, get_current_job, objects):
+        objects.filter.return_value.values_list.return_value.get.return_value = [{'code': 'old'}]
+        with NonFatalErrorCollector(max_errors=2) as errors:
+            for error in [ValueError('a'), ValueError('a'), KeyError('a'), ValueError('b'),
+                          ValueError('c'), ValueError('c')]:
+                errors.append(error)
+
+        objects.filter.assert_called_once_with(job_id=get_current_job.return_value.id)
+        saved = self.saved_errors(objects)
+        self.assertEqual([error.get('code') for error in saved], ['old', None, None, None])
+        self.assertEqual([error.get('count') for error in saved], [None, 2, 1, 3])
+        self.assertEqual(saved[1]['description'], 'a')
+        self.assertEqual(saved[3]['description'], '3 more non-fatal errors were not recorded.')
+
+    def test_flush_interval(self, get_current_job, objects):
+        objects.filter.return_value.values_list.return_value.get.return_value = []
+        update = objects.filter.return_value.update
+        with mock.patch('pulpcore.plugin.tasking.time.monotonic', return_value=0):
+            errors = NonFatalErrorCollector(flush_interval=10)
+        with mock.patch('pulpcore.plugin.tasking.time.monotonic', return_value=5):
+            errors.append(ValueError('a'))
+        update.assert_not_called()
+
+        with mock.patch('pulpcore.plugin.tasking.time.monotonic', return_value=10):
+            errors.append(ValueError('a'))
+        self.assertEqual(self.saved_errors(objects)[0]['count'], 2)
+
+        errors.flush()
+        self.assertEqual(update.call_count, 1)
+        objects.filter.return_value.values_list.return_value.get.assert_called_once_with()
+
+    def test_flush_outside_a_task(self, get_current_job, objects):
+        get_current_job.return_value = None
+        errors = NonFatalErrorCollector()
+        errors.append(ValueError('a'))
+        with self.assertRaises(Task.DoesNotExist):
+            errors.flush()
+        objects.filter.assert_not_called()
@@ -4,7 +4,6 @@ requirements = [
     'pulpcore>=3.0.0b20',
     'aiohttp',
     'aiofiles',
-    'backoff',
 ]
 
 with open('README.rst') as f: